@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A CLI to benchmark the client-side cost of submitting notebook builds.
+
+Builds are submitted to a stubbed Cloud Build client, either through a fresh
+BuildSession per build (parsing the template and creating a client every
+time, as before sessions existed) or through one shared session. Run it from
+the repository root, which the build template path is relative to.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import execute_notebook_remote
+
+parser = argparse.ArgumentParser(description="Benchmark build submission.")
+parser.add_argument(
+    "--num_builds",
+    type=int,
+    help="The number of builds to submit.",
+    default=500,
+    required=False,
+)
+parser.add_argument(
+    "--private_pool_id",
+    type=str,
+    help="Submit to a private pool, which uses the regional endpoint.",
+    default=None,
+    required=False,
+)
+
+args = parser.parse_args()
+
+
+class StubCloudBuildClient:
+    """Accepts builds without sending them anywhere"""
+
+    def __init__(self, credentials, region):
+        self.builds = []
+
+    def create_build(self, project_id, build):
+        self.builds.append(build)
+
+
+def create_session() -> execute_notebook_remote.BuildSession:
+    return execute_notebook_remote.BuildSession(
+        credentials=object(),
+        project_id="sample-project",
+        client_factory=StubCloudBuildClient,
+    )
+
+
+def submit(session: execute_notebook_remote.BuildSession, index: int):
+    session.create_build(
+        code_archive_uri="gs://staging/code_archives/source_archived.tar.gz",
+        overlay_archive_uri=f"gs://staging/code_archives/overlays/{index}.tar.gz",
+        notebook_uri=f"notebooks/official/notebook_{index}.ipynb",
+        notebook_output_uri=f"gs://artifacts/notebook_{index}.ipynb",
+        container_uri="gcr.io/cloud-devrel-public-resources/python-samples-testing-docker:latest",
+        private_pool_id=args.private_pool_id,
+        private_pool_region="us-central1",
+        tag=f"notebook-{index}",
+        timeout_in_seconds=86400,
+        python_version="3.9",
+    )
+
+
+def submit_with_fresh_sessions():
+    for index in range(args.num_builds):
+        submit(create_session(), index)
+
+
+def submit_with_shared_session():
+    session = create_session()
+    for index in range(args.num_builds):
+        submit(session, index)
+
+
+timings = {}
+for name, submit_builds in [
+    ("fresh session", submit_with_fresh_sessions),
+    ("shared session", submit_with_shared_session),
+]:
+    tracemalloc.start()
+    time_start = time.perf_counter()
+    submit_builds()
+    timings[name] = (time.perf_counter() - time_start) / args.num_builds
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name}: {timings[name] * 1000:.2f} ms per build, peak memory {peak / 1024:.0f} KB"
+    )
+
+print(f"Speedup: {timings['fresh session'] / timings['shared session']:.2f}x")
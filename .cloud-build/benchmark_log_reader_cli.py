@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A CLI to benchmark locating the notebook execution step in a build log.
+
+A synthetic log is written to a local directory standing in for GCS. The step
+is located both by downloading the whole log and searching it with a regex,
+and by the chunked scanner of LogReader. Both must agree on the offset.
+"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from utils import log_reader, storage
+
+# The step the single-notebook summary starts printing from
+STEP_MARKER = "starting Step #5"
+
+parser = argparse.ArgumentParser(description="Benchmark build log scanning.")
+parser.add_argument(
+    "--log_size_in_mb",
+    type=int,
+    help="The approximate size of the synthetic log.",
+    default=300,
+    required=False,
+)
+parser.add_argument(
+    "--chunk_size_in_mb",
+    type=int,
+    help="The size of each ranged read.",
+    default=log_reader.DEFAULT_CHUNK_SIZE // (1024 * 1024),
+    required=False,
+)
+
+args = parser.parse_args()
+
+
+def measure(name, function):
+    tracemalloc.start()
+    time_start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - time_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name}: {duration:.2f} s, peak memory {peak / (1024 * 1024):.1f} MB")
+    return result
+
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    local_storage = storage.LocalStorage(os.path.join(temp_dir, "gcs"))
+    local_file = os.path.join(temp_dir, "log.txt")
+
+    # Most of a long log is dependency installation before the notebook runs
+    line = b"Step #4: Collecting some-package==1.0.0 from requirements.txt\n"
+    num_lines = args.log_size_in_mb * 1024 * 1024 // len(line)
+    with open(local_file, "wb") as f:
+        for _ in range(num_lines // 10000):
+            f.write(line * 10000)
+        f.write(b"Step #5: Already have image: python\n")
+        f.write(b"Starting Step #5\n")
+        f.write(b"Step #5: Executing notebook\n" * 1000)
+
+    uri = local_storage.upload_file(local_file, "gs://logs/log-benchmark.txt")
+    print(f"Wrote a {local_storage.size(uri) / (1024 * 1024):.0f} MB log.")
+
+    def search_whole_log():
+        log_contents = local_storage.read(uri)
+        match = re.search(STEP_MARKER.encode("utf-8"), log_contents, flags=re.IGNORECASE)
+        return match.span()[0] if match else None
+
+    def scan_chunks():
+        return log_reader.LogReader(
+            uri, local_storage, chunk_size=args.chunk_size_in_mb * 1024 * 1024
+        ).find(STEP_MARKER)
+
+    expected = measure("whole log", search_whole_log)
+    actual = measure("chunked", scan_chunks)
+
+    if expected != actual:
+        print(f"Offsets differ: {expected} != {actual}")
+        sys.exit(1)
+
+    print(f"Both found the step at offset {actual}.")
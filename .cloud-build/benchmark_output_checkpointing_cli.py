@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A CLI to measure the output I/O of checkpointing executed notebooks.
+
+Execution of every notebook under the given folder is replayed: its outputs
+are cleared, then restored cell by cell. The notebook is saved the way
+papermill does with request_save_on_cell_execute (when execution starts and
+when every cell starts and completes) and, separately, through a
+NotebookCheckpointer. Both end with a final write of the whole notebook.
+"""
+
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import nbformat
+
+from utils import notebook_checkpoint
+
+parser = argparse.ArgumentParser(description="Benchmark output checkpointing.")
+parser.add_argument(
+    "--notebook_dir",
+    type=pathlib.Path,
+    help="The folder to search for notebooks recursively.",
+    default="notebooks",
+    required=False,
+)
+parser.add_argument(
+    "--cell_seconds",
+    type=float,
+    help="The simulated duration of each cell.",
+    default=2,
+    required=False,
+)
+parser.add_argument(
+    "--synthetic_output_bytes",
+    type=int,
+    help="Add an output of this size to code cells, to model plots and tables.",
+    default=0,
+    required=False,
+)
+parser.add_argument(
+    "--synthetic_output_every",
+    type=int,
+    help="Add the synthetic output to every n-th code cell.",
+    default=5,
+    required=False,
+)
+
+args = parser.parse_args()
+
+notebooks = []
+for notebook_path in sorted(args.notebook_dir.rglob("*.ipynb")):
+    try:
+        with open(notebook_path, encoding="utf-8") as f:
+            nb = nbformat.read(f, as_version=4)
+    except Exception:
+        print(f"Skipping corrupted notebook: {notebook_path}")
+        continue
+
+    if args.synthetic_output_bytes:
+        code_cells = [cell for cell in nb.cells if cell.cell_type == "code"]
+        for cell in code_cells[:: args.synthetic_output_every]:
+            cell.outputs.append(
+                nbformat.v4.new_output(
+                    "display_data",
+                    data={"image/png": "A" * args.synthetic_output_bytes},
+                )
+            )
+
+    notebooks.append(nb)
+
+print(f"Replaying {len(notebooks)} notebooks.")
+
+
+def replay(nb, save, cell_completed=lambda: None):
+    """Calls save at the points papermill saves, while restoring outputs"""
+    outputs = [cell.get("outputs") for cell in nb.cells]
+    for cell in nb.cells:
+        if cell.cell_type == "code":
+            cell.outputs = []
+
+    save(nb)
+    for cell, cell_outputs in zip(nb.cells, outputs):
+        save(nb)
+        if cell_outputs is not None:
+            cell.outputs = cell_outputs
+        cell_completed()
+        save(nb)
+
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    notebook_path = os.path.join(temp_dir, "executed.ipynb")
+
+    def save_every_cell():
+        totals = {"writes": 0, "bytes": 0}
+
+        def save(nb):
+            content = notebook_checkpoint.serialize_notebook(nb)
+            with open(notebook_path, "wb") as f:
+                f.write(content)
+            totals["writes"] += 1
+            totals["bytes"] += len(content)
+
+        for nb in notebooks:
+            replay(nb, save)
+            save(nb)
+
+        return totals
+
+    def save_checkpoints():
+        totals = {"writes": 0, "bytes": 0}
+        for nb in notebooks:
+            now = [0.0]
+
+            def cell_completed():
+                now[0] += args.cell_seconds
+                checkpointer.cell_completed()
+
+            checkpointer = notebook_checkpoint.NotebookCheckpointer(
+                notebook_path, clock=lambda: now[0]
+            )
+            replay(nb, checkpointer.checkpoint, cell_completed)
+            checkpointer.write(nb)
+            totals["writes"] += checkpointer.num_writes
+            totals["bytes"] += checkpointer.bytes_written
+
+        return totals
+
+    results = {}
+    for name, run in [
+        ("every cell", save_every_cell),
+        ("checkpoints", save_checkpoints),
+    ]:
+        time_start = time.perf_counter()
+        results[name] = run()
+        duration = time.perf_counter() - time_start
+        print(
+            f"{name}: {results[name]['writes']} writes, "
+            f"{results[name]['bytes'] / (1024 * 1024):.1f} MB in {duration:.2f} s"
+        )
+
+reduction = 1 - results["checkpoints"]["bytes"] / results["every cell"]["bytes"]
+print(f"Bytes written reduced by {reduction:.1%}")
@@ -1,5 +1,9 @@
-from typing import List
-from ratemate import RateLimit
+import argparse
+import os
+import tempfile
+from typing import List, Optional
+from cleanup_engine import plan_cleanup, run_cleanup
+from cleanup_inventory import Inventory
 from resource_cleanup_manager import (
     DatasetResourceCleanupManager,
     ModelResourceCleanupManager,
@@ -7,34 +11,67 @@ from resource_cleanup_manager import (
     ResourceCleanupManager,
 )
 
-rate_limit = RateLimit(max_count=25, per=60, greedy=False)
 
+def run_cleanup_managers(
+    managers: List[ResourceCleanupManager],
+    is_dry_run: bool,
+    inventory_file: Optional[str] = None,
+    rate_limit_dir: Optional[str] = None,
+):
+    inventory = Inventory.load(inventory_file) if inventory_file else None
 
-def run_cleanup_managers(managers: List[ResourceCleanupManager], is_dry_run: bool):
-    for manager in managers:
-        type_name = manager.type_name
+    # Managers run concurrently, each after the managers it depends on
+    stats = run_cleanup(
+        managers=managers,
+        is_dry_run=is_dry_run,
+        inventory=inventory,
+        rate_limit_dir=rate_limit_dir,
+    )
 
-        print(f"Fetching {type_name}'s...")
-        resources = manager.list()
-        print(f"Found {len(resources)} {type_name}'s")
-        for resource in resources:
-            try:
-                if not manager.is_deletable(resource):
-                    continue
-
-                if is_dry_run:
-                    resource_name = manager.resource_name(resource)
-                    print(f"Will delete '{type_name}': {resource_name}")
-                else:
-                    rate_limit.wait()  # wait before deleting
-                    manager.delete(resource)
-            except Exception as exception:
-                print(exception)
+    print("")
+    for stat in stats:
+        print(
+            f"{stat.type_name}: listed {stat.listed}, skipped {stat.skipped} ({stat.unchanged} unchanged), deleted {stat.deleted}, failed {stat.failed}, throttled {stat.throttled} in {stat.duration}"
+        )
 
+    if is_dry_run:
+        plan = plan_cleanup(managers=managers, stats=stats)
         print("")
+        for entry in plan:
+            print(
+                f"Plan for {entry.type_name}: delete {entry.deletions} in about {entry.estimated_duration}, finishing after {entry.estimated_finish}"
+            )
+        print(
+            f"Estimated wall time: {max(entry.estimated_finish for entry in plan)}"
+        )
 
+    if inventory:
+        inventory.save(inventory_file)
 
-is_dry_run = False
+
+parser = argparse.ArgumentParser(description="Clean up stale Vertex AI resources.")
+parser.add_argument(
+    "--dry_run",
+    action="store_true",
+    help="Plan the deletions and estimate their duration without deleting anything.",
+)
+parser.add_argument(
+    "--inventory_file",
+    type=str,
+    help="A local snapshot of earlier runs' decisions, so that unchanged resources are not evaluated again.",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cleanup_inventory.json"),
+    required=False,
+)
+parser.add_argument(
+    "--rate_limit_dir",
+    type=str,
+    help="A local folder for the deletion rate budgets, shared by the cleanup processes using it.",
+    default=tempfile.gettempdir(),
+    required=False,
+)
+
+args = parser.parse_args()
+is_dry_run = args.dry_run
 
 if is_dry_run:
     print("Starting cleanup in dry run mode...")
@@ -43,7 +80,12 @@ if is_dry_run:
 managers = [
     DatasetResourceCleanupManager(),
     EndpointResourceCleanupManager(),
-    ModelResourceCleanupManager(),  # ModelResourceCleanupManager must follow EndpointResourceCleanupManager due to deployed models blocking model deletion.
+    ModelResourceCleanupManager(),  # ModelResourceCleanupManager depends on EndpointResourceCleanupManager due to deployed models blocking model deletion.
 ]
 
-run_cleanup_managers(managers=managers, is_dry_run=is_dry_run)
+run_cleanup_managers(
+    managers=managers,
+    is_dry_run=is_dry_run,
+    inventory_file=args.inventory_file,
+    rate_limit_dir=args.rate_limit_dir,
+)
@@ -0,0 +1,489 @@
+"""
+A concurrent cleanup engine for ResourceCleanupManagers.
+
+Each manager runs as soon as the managers it depends on have finished, e.g.
+models after endpoints, since deployed models block model deletion, while
+datasets are cleaned up alongside both. Resources are deleted while listing
+is still in progress. Deletions run in worker threads, each waiting on its
+long-running operation, under a per resource type budget of deletions per
+minute and of deletions in flight. The rate adapts to quota errors, and
+processes given the same rate limit directory share it.
+
+With an inventory, unchanged resources that an earlier run decided to keep
+are not evaluated again. A dry run plans the deletions, and plan_cleanup
+estimates how long they would take under the budgets.
+"""
+
+import asyncio
+import dataclasses
+import datetime
+import math
+import os
+import sys
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional
+
+import cleanup_inventory
+from cleanup_inventory import Inventory
+from resource_cleanup_manager import ResourceCleanupManager
+
+# The shared rate limiter lives in the utils package next to this folder
+_CLOUD_BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _CLOUD_BUILD_DIR not in sys.path:
+    sys.path.append(_CLOUD_BUILD_DIR)
+
+from utils import rate_limiter  # noqa: E402
+
+# Resources listed ahead of deletion, which bounds memory for large backlogs
+LIST_BUFFER_SIZE = 100
+
+
+@dataclasses.dataclass
+class CleanupBudget:
+    deletes_per_minute: float
+    max_concurrent_deletes: int
+
+
+# Endpoints take the longest to delete, since their models are undeployed first
+DEFAULT_BUDGETS = {
+    "endpoints": CleanupBudget(deletes_per_minute=30, max_concurrent_deletes=10),
+    "models": CleanupBudget(deletes_per_minute=60, max_concurrent_deletes=20),
+    "datasets": CleanupBudget(deletes_per_minute=60, max_concurrent_deletes=20),
+}
+
+# The budget of resource types without an entry in the budgets
+DEFAULT_BUDGET = CleanupBudget(deletes_per_minute=25, max_concurrent_deletes=5)
+
+# Rough seconds per deletion, used to estimate plans. Endpoints include
+# undeploying their models.
+ESTIMATED_DELETE_SECONDS = {
+    "endpoints": 300,
+    "models": 60,
+    "datasets": 30,
+}
+
+DEFAULT_ESTIMATED_DELETE_SECONDS = 60
+
+
+@dataclasses.dataclass
+class CleanupStats:
+    type_name: str
+    listed: int = 0
+    skipped: int = 0
+    # Skipped without evaluation, as the inventory already decided to keep them
+    unchanged: int = 0
+    planned: int = 0
+    deleted: int = 0
+    failed: int = 0
+    throttled: int = 0
+    duration: datetime.timedelta = datetime.timedelta(seconds=0)
+
+
+@dataclasses.dataclass
+class CleanupPlanEntry:
+    type_name: str
+    deletions: int
+    estimated_duration: datetime.timedelta
+    # Includes waiting for the managers it depends on
+    estimated_finish: datetime.timedelta
+
+
+async def _iterate_in_thread(iterable: Iterable) -> AsyncIterator:
+    """
+    Iterates a blocking iterable in a thread, buffering at most
+    LIST_BUFFER_SIZE items ahead of the consumer
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=LIST_BUFFER_SIZE)
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                asyncio.run_coroutine_threadsafe(queue.put((item, None)), loop).result()
+        except Exception as error:
+            asyncio.run_coroutine_threadsafe(queue.put((end, error)), loop).result()
+        else:
+            asyncio.run_coroutine_threadsafe(queue.put((end, None)), loop).result()
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item, error = await queue.get()
+        if error is not None:
+            raise error
+        if item is end:
+            return
+        yield item
+
+
+async def _delete(
+    manager: ResourceCleanupManager,
+    resource,
+    stats: CleanupStats,
+    concurrency: asyncio.Semaphore,
+    rate: rate_limiter.AdaptiveRateLimiter,
+    record: Callable[[str], None],
+):
+    try:
+        # The token for the first attempt was taken before this task started
+        await asyncio.to_thread(rate.call, manager.delete, resource, is_acquired=True)
+        stats.deleted += 1
+        record(cleanup_inventory.DELETED)
+    except Exception as exception:
+        stats.failed += 1
+        record(cleanup_inventory.FAILED)
+        print(f"Failed to delete '{manager.type_name}' {manager.resource_name(resource)}: {exception}")
+    finally:
+        concurrency.release()
+
+
+async def _run_manager(
+    manager: ResourceCleanupManager,
+    is_dry_run: bool,
+    budget: CleanupBudget,
+    finished: Dict[str, asyncio.Event],
+    inventory: Optional[Inventory] = None,
+    rate_limit_dir: Optional[str] = None,
+) -> CleanupStats:
+    type_name = manager.type_name
+    stats = CleanupStats(type_name=type_name)
+
+    try:
+        for dependency in manager.dependencies:
+            if dependency in finished:
+                await finished[dependency].wait()
+
+        time_start = datetime.datetime.now()
+        print(f"Cleaning up {type_name}'s...")
+
+        concurrency = asyncio.Semaphore(budget.max_concurrent_deletes)
+        rate = rate_limiter.AdaptiveRateLimiter(
+            per_minute=budget.deletes_per_minute,
+            burst=budget.max_concurrent_deletes,
+            state_file=(
+                os.path.join(rate_limit_dir, f"cleanup-{type_name}.json")
+                if rate_limit_dir
+                else None
+            ),
+        )
+        deletions = set()
+
+        try:
+            async for resource in _iterate_in_thread(manager.list()):
+                stats.listed += 1
+                record: Optional[Callable[[str], None]] = None
+
+                # A resource that cannot be examined is skipped, not the rest of the listing
+                try:
+                    resource_id = manager.resource_id(resource)
+                    update_time = manager.update_time(resource)
+
+                    def record(decision: str, resource=resource, resource_id=resource_id, update_time=update_time):
+                        if inventory:
+                            inventory.record(
+                                type_name,
+                                resource_id,
+                                manager.resource_name(resource),
+                                update_time,
+                                decision,
+                            )
+
+                    if inventory and inventory.final_decision(type_name, resource_id, update_time):
+                        stats.skipped += 1
+                        stats.unchanged += 1
+                        continue
+
+                    if not manager.is_deletable(resource):
+                        stats.skipped += 1
+                        record(
+                            cleanup_inventory.KEPT
+                            if manager.is_permanent(resource)
+                            else cleanup_inventory.SKIPPED
+                        )
+                        continue
+                except Exception as exception:
+                    stats.skipped += 1
+                    if record:
+                        record(cleanup_inventory.SKIPPED)
+                    print(exception)
+                    continue
+
+                if is_dry_run:
+                    stats.planned += 1
+                    record(cleanup_inventory.PLANNED)
+                    print(f"Will delete '{type_name}': {manager.resource_name(resource)}")
+                    continue
+
+                # Waiting for a free slot also stops listing from running ahead
+                await concurrency.acquire()
+                await rate.acquire()
+                deletion = asyncio.create_task(
+                    _delete(manager, resource, stats, concurrency, rate, record)
+                )
+                deletions.add(deletion)
+                deletion.add_done_callback(deletions.discard)
+        except Exception as exception:
+            if inventory:
+                inventory.mark_incomplete(type_name)
+            print(f"Failed to list {type_name}'s: {exception}")
+
+        if deletions:
+            await asyncio.wait(deletions)
+
+        stats.duration = datetime.datetime.now() - time_start
+        stats.throttled = rate.stats().throttled
+        print(
+            f"Found {stats.listed} {type_name}'s, deleted {stats.deleted}, failed to delete {stats.failed}"
+        )
+    finally:
+        finished[type_name].set()
+
+    return stats
+
+
+async def _run_cleanup(
+    managers: List[ResourceCleanupManager],
+    is_dry_run: bool,
+    budgets: Dict[str, CleanupBudget],
+    inventory: Optional[Inventory],
+    rate_limit_dir: Optional[str],
+) -> List[CleanupStats]:
+    finished = {manager.type_name: asyncio.Event() for manager in managers}
+
+    return await asyncio.gather(
+        *[
+            _run_manager(
+                manager,
+                is_dry_run=is_dry_run,
+                budget=budgets.get(manager.type_name, DEFAULT_BUDGET),
+                finished=finished,
+                inventory=inventory,
+                rate_limit_dir=rate_limit_dir,
+            )
+            for manager in managers
+        ]
+    )
+
+
+def run_cleanup(
+    managers: List[ResourceCleanupManager],
+    is_dry_run: bool,
+    budgets: Optional[Dict[str, CleanupBudget]] = None,
+    inventory: Optional[Inventory] = None,
+    rate_limit_dir: Optional[str] = None,
+) -> List[CleanupStats]:
+    """
+    Cleans up the resources of all managers concurrently, honoring their
+    dependencies, and returns statistics per manager. Decisions are recorded
+    in the inventory, if given, and the deletion rates are shared through
+    state files in rate_limit_dir, if given.
+    """
+    return asyncio.run(
+        _run_cleanup(
+            managers,
+            is_dry_run=is_dry_run,
+            budgets=DEFAULT_BUDGETS if budgets is None else budgets,
+            inventory=inventory,
+            rate_limit_dir=rate_limit_dir,
+        )
+    )
+
+
+def estimate_deletion_seconds(
+    deletions: int, budget: CleanupBudget, delete_seconds: float
+) -> float:
+    """Estimates the seconds to delete resources of one type under its budget"""
+    if deletions == 0:
+        return 0.0
+
+    # The rate budget lets a burst of deletions start at once, then spaces them out
+    last_start = max(deletions - budget.max_concurrent_deletes, 0) / (
+        budget.deletes_per_minute / 60
+    )
+    # Each deletion in flight holds a slot until it finishes
+    slot_bound = math.ceil(deletions / budget.max_concurrent_deletes) * delete_seconds
+
+    return max(last_start + delete_seconds, slot_bound)
+
+
+def plan_cleanup(
+    managers: List[ResourceCleanupManager],
+    stats: List[CleanupStats],
+    budgets: Optional[Dict[str, CleanupBudget]] = None,
+    delete_seconds: Optional[Dict[str, float]] = None,
+) -> List[CleanupPlanEntry]:
+    """
+    Estimates how long the deletions planned by a dry run would take, per
+    manager, taking the managers each one waits for into account
+    """
+    budgets = DEFAULT_BUDGETS if budgets is None else budgets
+    delete_seconds = ESTIMATED_DELETE_SECONDS if delete_seconds is None else delete_seconds
+    planned = {stat.type_name: stat.planned for stat in stats}
+    dependencies = {manager.type_name: manager.dependencies for manager in managers}
+
+    durations = {
+        type_name: datetime.timedelta(
+            seconds=estimate_deletion_seconds(
+                deletions,
+                budgets.get(type_name, DEFAULT_BUDGET),
+                delete_seconds.get(type_name, DEFAULT_ESTIMATED_DELETE_SECONDS),
+            )
+        )
+        for type_name, deletions in planned.items()
+    }
+
+    finishes: Dict[str, datetime.timedelta] = {}
+
+    def finish(type_name: str) -> datetime.timedelta:
+        if type_name not in finishes:
+            finishes[type_name] = durations[type_name] + max(
+                [
+                    finish(dependency)
+                    for dependency in dependencies.get(type_name, [])
+                    if dependency in durations
+                ],
+                default=datetime.timedelta(seconds=0),
+            )
+        return finishes[type_name]
+
+    return [
+        CleanupPlanEntry(
+            type_name=type_name,
+            deletions=planned[type_name],
+            estimated_duration=durations[type_name],
+            estimated_finish=finish(type_name),
+        )
+        for type_name in planned
+    ]
+
+
+def _fake_managers(project) -> List[ResourceCleanupManager]:
+    from resource_cleanup_manager import (
+        DatasetResourceCleanupManager,
+        EndpointResourceCleanupManager,
+        ModelResourceCleanupManager,
+    )
+
+    class FakeDatasetManager(DatasetResourceCleanupManager):
+        vertex_ai_resource = project.Dataset
+        dataset_types = project.dataset_types
+
+    class FakeEndpointManager(EndpointResourceCleanupManager):
+        vertex_ai_resource = project.Endpoint
+
+    class FakeModelManager(ModelResourceCleanupManager):
+        vertex_ai_resource = project.Model
+
+    # Listed in the wrong order on purpose, dependencies decide the order
+    return [FakeModelManager(), FakeDatasetManager(), FakeEndpointManager()]
+
+
+def test_run_cleanup_orders_and_overlaps_deletions():
+    import fake_aiplatform
+
+    project = fake_aiplatform.FakeProject(operation_latency_in_seconds=0.05)
+    old = datetime.timedelta(days=1)
+    models = [project.add_model(f"model-{index}", old) for index in range(6)]
+    for index in range(3):
+        project.add_endpoint(f"endpoint-{index}", old, deployed_models=models[index * 2 : index * 2 + 2])
+    project.add_model("perm-model", old)
+    project.add_endpoint("recent-endpoint", datetime.timedelta(minutes=5))
+    for index, schema in enumerate(["image", "tabular", "text", "time_series", "video"] * 2):
+        project.add_dataset(f"dataset-{index}", old, metadata_schema=schema)
+
+    budgets = {
+        type_name: CleanupBudget(deletes_per_minute=6000, max_concurrent_deletes=4)
+        for type_name in ["endpoints", "models", "datasets"]
+    }
+    stats = run_cleanup(_fake_managers(project), is_dry_run=False, budgets=budgets)
+
+    assert {stat.type_name: (stat.deleted, stat.failed) for stat in stats} == {
+        "models": (6, 0),
+        "datasets": (10, 0),
+        "endpoints": (3, 0),
+    }
+    assert project.names("models") == ["perm-model"]
+    assert project.names("endpoints") == ["recent-endpoint"]
+    assert project.names("datasets") == []
+
+    # Deletions overlap up to the budget, and models wait for endpoints
+    assert project.max_in_flight["datasets"] == 4
+    ends = {
+        noun: max(end for _, end, _, name in project.operations if f"/{noun}/" in name)
+        for noun in ["endpoints", "datasets"]
+    }
+    model_starts = [start for start, _, _, name in project.operations if "/models/" in name]
+    assert min(model_starts) >= ends["endpoints"]
+    dataset_starts = [start for start, _, _, name in project.operations if "/datasets/" in name]
+    assert min(dataset_starts) < ends["endpoints"]
+
+
+def test_dry_run_plans_and_inventory_skips_unchanged():
+    import fake_aiplatform
+
+    project = fake_aiplatform.FakeProject()
+    old = datetime.timedelta(days=1)
+    for index in range(3):
+        project.add_endpoint(f"endpoint-{index}", old)
+    for index in range(25):
+        project.add_model(f"model-{index}", old)
+    project.add_model("perm-model", old)
+
+    inventory = Inventory()
+    managers = _fake_managers(project)
+    stats = run_cleanup(managers, is_dry_run=True, inventory=inventory)
+    assert {stat.type_name: stat.planned for stat in stats} == {
+        "models": 25,
+        "datasets": 0,
+        "endpoints": 3,
+    }
+    assert len(project.names("models")) == 26
+
+    plan = {
+        entry.type_name: entry
+        for entry in plan_cleanup(
+            managers,
+            stats,
+            budgets={
+                "endpoints": CleanupBudget(deletes_per_minute=60, max_concurrent_deletes=10),
+                "models": CleanupBudget(deletes_per_minute=60, max_concurrent_deletes=10),
+            },
+            delete_seconds={"endpoints": 100, "models": 1},
+        )
+    }
+    # Endpoints are bound by slots, models by the rate after a burst of 10
+    assert plan["endpoints"].estimated_duration == datetime.timedelta(seconds=100)
+    assert plan["models"].estimated_duration == datetime.timedelta(seconds=16)
+    assert plan["models"].estimated_finish == datetime.timedelta(seconds=116)
+    assert plan["datasets"].estimated_finish == datetime.timedelta(seconds=0)
+
+    # The next run does not evaluate the perm model again
+    inventory = Inventory(inventory.entries())
+    stats = run_cleanup(managers, is_dry_run=True, inventory=inventory)
+    assert {stat.type_name: stat.unchanged for stat in stats}["models"] == 1
+
+
+def test_resources_that_cannot_be_examined_are_skipped():
+    import fake_aiplatform
+
+    project = fake_aiplatform.FakeProject()
+    old = datetime.timedelta(days=1)
+    for index in range(3):
+        project.add_model(f"model-{index}", old)
+
+    managers = _fake_managers(project)
+    model_manager = managers[0]
+    update_time = model_manager.update_time
+
+    def broken_update_time(resource):
+        if resource.display_name == "model-1":
+            raise ValueError("no update time")
+        return update_time(resource)
+
+    model_manager.update_time = broken_update_time
+
+    inventory = Inventory()
+    stats = run_cleanup(managers, is_dry_run=True, inventory=inventory)
+    assert {stat.type_name: (stat.planned, stat.skipped) for stat in stats}["models"] == (2, 1)
+    assert [entry.display_name for entry in inventory.entries()] == ["model-0", "model-2"]
@@ -0,0 +1,138 @@
+"""
+A local snapshot of the resources seen by previous cleanup runs.
+
+Every listed resource is recorded with its update time and the decision the
+run made about it. A later run only re-evaluates resources that are new or
+were updated since, and whose earlier decision could have changed, e.g. a
+resource kept because of its name is not examined again until it changes.
+"""
+
+import dataclasses
+import datetime
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+# Decisions recorded for a resource
+DELETED = "deleted"
+FAILED = "failed"
+# Never deleted, e.g. because of a 'perm' name prefix
+KEPT = "kept"
+# Not deleted this time, e.g. because it was updated too recently
+SKIPPED = "skipped"
+PLANNED = "planned"
+
+# Decisions that stay valid for as long as the resource is unchanged
+FINAL_DECISIONS = [KEPT]
+
+
+@dataclasses.dataclass
+class InventoryEntry:
+    type_name: str
+    resource_id: str
+    display_name: str
+    update_time: Optional[str]
+    decision: str
+
+
+def _format_time(update_time: Optional[datetime.datetime]) -> Optional[str]:
+    return update_time.isoformat() if update_time else None
+
+
+class Inventory:
+    def __init__(self, entries: Optional[List[InventoryEntry]] = None):
+        self._previous: Dict[Tuple[str, str], InventoryEntry] = {
+            (entry.type_name, entry.resource_id): entry for entry in entries or []
+        }
+        self._current: Dict[Tuple[str, str], InventoryEntry] = {}
+        # Types whose listing did not complete, so unseen entries are kept
+        self._incomplete_types: List[str] = []
+
+    @classmethod
+    def load(cls, path: str) -> "Inventory":
+        """Loads a snapshot, or returns an empty inventory if there is none"""
+        if not os.path.exists(path):
+            return cls()
+
+        with open(path) as file:
+            return cls([InventoryEntry(**entry) for entry in json.load(file)])
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            json.dump(
+                [dataclasses.asdict(entry) for entry in self.entries()],
+                file,
+                indent=2,
+            )
+
+    def entries(self) -> List[InventoryEntry]:
+        """The entries seen in this run, and those of types that were not fully listed"""
+        entries = dict(self._current)
+        for key, entry in self._previous.items():
+            if entry.type_name in self._incomplete_types:
+                entries.setdefault(key, entry)
+        return sorted(entries.values(), key=lambda entry: (entry.type_name, entry.resource_id))
+
+    def final_decision(
+        self,
+        type_name: str,
+        resource_id: str,
+        update_time: Optional[datetime.datetime],
+    ) -> Optional[InventoryEntry]:
+        """
+        Returns the previous entry of an unchanged resource whose decision
+        does not need to be re-evaluated, and carries it over to this run
+        """
+        entry = self._previous.get((type_name, resource_id))
+        if (
+            entry is None
+            or update_time is None
+            or entry.update_time != _format_time(update_time)
+            or entry.decision not in FINAL_DECISIONS
+        ):
+            return None
+
+        self._current[(type_name, resource_id)] = entry
+        return entry
+
+    def record(
+        self,
+        type_name: str,
+        resource_id: str,
+        display_name: str,
+        update_time: Optional[datetime.datetime],
+        decision: str,
+    ):
+        self._current[(type_name, resource_id)] = InventoryEntry(
+            type_name=type_name,
+            resource_id=resource_id,
+            display_name=display_name,
+            update_time=_format_time(update_time),
+            decision=decision,
+        )
+
+    def mark_incomplete(self, type_name: str):
+        self._incomplete_types.append(type_name)
+
+
+def test_inventory_carries_over_final_decisions(tmp_path):
+    path = str(tmp_path / "inventory.json")
+    update_time = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+    inventory = Inventory.load(path)
+    inventory.record("models", "models/1", "perm-model", update_time, KEPT)
+    inventory.record("models", "models/2", "model", update_time, FAILED)
+    inventory.record("datasets", "datasets/1", "perm-dataset", update_time, KEPT)
+    inventory.save(path)
+
+    inventory = Inventory.load(path)
+    assert inventory.final_decision("models", "models/1", update_time).decision == KEPT
+    assert inventory.final_decision("models", "models/2", update_time) is None
+    assert (
+        inventory.final_decision("datasets", "datasets/1", update_time + datetime.timedelta(seconds=1))
+        is None
+    )
+
+    # Unseen models are gone, while datasets were not fully listed
+    inventory.mark_incomplete("datasets")
+    assert [entry.resource_id for entry in inventory.entries()] == ["datasets/1", "models/1"]
@@ -0,0 +1,373 @@
+"""
+An in-memory stand-in for the aiplatform resource classes used by cleanup.
+
+A FakeProject holds endpoints, models and datasets, and exposes resource
+classes with the same list, delete and undeploy surface as aiplatform,
+including the paged list API. Every long-running operation sleeps for a
+configurable latency and is recorded, so that ordering and concurrency can
+be checked offline.
+"""
+
+import dataclasses
+import datetime
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from google.api_core import exceptions
+
+DATASET_SCHEMA_URI_FORMAT = "gs://google-cloud-aiplatform/schema/dataset/metadata/{}_1.0.0.yaml"
+
+_FILTER_CLAUSE = re.compile(r'^(\w+)([<=])"([^"]*)"$')
+
+
+class FailedPrecondition(exceptions.FailedPrecondition):
+    """Raised like the API does when a resource is still in use"""
+
+
+@dataclasses.dataclass
+class DeployedModel:
+    id: str
+    model: str
+
+
+@dataclasses.dataclass
+class GcaResource:
+    name: str = ""
+    deployed_models: List[DeployedModel] = dataclasses.field(default_factory=list)
+    traffic_split: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+
+class FakeProject:
+    def __init__(self, operation_latency_in_seconds: float = 0.0):
+        self.operation_latency_in_seconds = operation_latency_in_seconds
+        self._lock = threading.Lock()
+        # Resources by noun, then by resource name
+        self._resources: Dict[str, Dict[str, "FakeResource"]] = {}
+        self._in_flight: Dict[str, int] = {}
+        self.max_in_flight: Dict[str, int] = {}
+        # Operations in flight per resource name, and how many the API accepts
+        self._in_flight_by_resource: Dict[str, int] = {}
+        self.max_operations_per_resource: Optional[int] = None
+        self.traffic_split_updates = 0
+        # (start, end, operation, resource name) of every completed operation
+        self.operations: List[Tuple[float, float, str, str]] = []
+        self._next_id = 0
+
+        # Filter fields the list API rejects with InvalidArgument
+        self.unsupported_filter_fields: Set[str] = set()
+        self.list_requests: List[Dict] = []
+        self.pages_fetched = 0
+        self.api_client = FakeApiClient(self)
+
+        project = self
+
+        class Endpoint(FakeResource):
+            _resource_noun = "endpoints"
+            _project = project
+
+            def delete(self, force: bool = False, sync: bool = True):
+                if self._gca_resource.deployed_models and not force:
+                    raise FailedPrecondition(f"{self.resource_name} has deployed models")
+                super().delete()
+
+            def _sync_gca_resource(self):
+                pass
+
+            def _undeploy(self, deployed_model_id: str):
+                self.api_client.undeploy_model(
+                    endpoint=self.resource_name, deployed_model_id=deployed_model_id
+                ).result()
+
+        class Model(FakeResource):
+            _resource_noun = "models"
+            _project = project
+
+            def delete(self, sync: bool = True):
+                if self._project.is_deployed(self.resource_name):
+                    raise FailedPrecondition(f"{self.resource_name} is deployed")
+                super().delete()
+
+        class Dataset(FakeResource):
+            _resource_noun = "datasets"
+            _project = project
+
+        self.Endpoint = Endpoint
+        self.Model = Model
+        self.Dataset = Dataset
+        self.dataset_types = [
+            type(
+                f"{schema.title().replace('_', '')}Dataset",
+                (Dataset,),
+                {
+                    "_supported_metadata_schema_uris": (
+                        DATASET_SCHEMA_URI_FORMAT.format(schema),
+                    )
+                },
+            )
+            for schema in ["image", "tabular", "text", "time_series", "video"]
+        ]
+
+    def _add(self, resource_class, display_name: str, age: datetime.timedelta, **fields):
+        with self._lock:
+            self._next_id += 1
+            resource = resource_class(
+                resource_name=f"projects/test/locations/us-central1/{resource_class._resource_noun}/{self._next_id}",
+                display_name=display_name,
+                update_time=datetime.datetime.now(datetime.timezone.utc) - age,
+                **fields,
+            )
+            resource._gca_resource.name = resource.resource_name
+            self._resources.setdefault(resource_class._resource_noun, {})[
+                resource.resource_name
+            ] = resource
+            return resource
+
+    def add_model(self, display_name: str, age: datetime.timedelta) -> "FakeResource":
+        return self._add(self.Model, display_name, age)
+
+    def add_endpoint(
+        self,
+        display_name: str,
+        age: datetime.timedelta,
+        deployed_models: Optional[List["FakeResource"]] = None,
+    ) -> "FakeResource":
+        endpoint = self._add(self.Endpoint, display_name, age)
+        endpoint._gca_resource.deployed_models = [
+            DeployedModel(id=f"{index}", model=model.resource_name)
+            for index, model in enumerate(deployed_models or [])
+        ]
+        # All traffic goes to the first model
+        if deployed_models:
+            endpoint._gca_resource.traffic_split = {"0": 100}
+        return endpoint
+
+    def add_dataset(
+        self, display_name: str, age: datetime.timedelta, metadata_schema: str = "image"
+    ) -> "FakeResource":
+        return self._add(
+            self.Dataset,
+            display_name,
+            age,
+            metadata_schema_uri=DATASET_SCHEMA_URI_FORMAT.format(metadata_schema),
+        )
+
+    def names(self, resource_noun: str) -> List[str]:
+        with self._lock:
+            return sorted(
+                resource.display_name
+                for resource in self._resources.get(resource_noun, {}).values()
+            )
+
+    def is_deployed(self, model_name: str) -> bool:
+        with self._lock:
+            return any(
+                deployed_model.model == model_name
+                for endpoint in self._resources.get("endpoints", {}).values()
+                for deployed_model in endpoint._gca_resource.deployed_models
+            )
+
+    def _list(self, resource_noun: str, request: Dict) -> Iterator["FakeResource"]:
+        clauses = []
+        for clause in filter(None, request.get("filter", "").split(" AND ")):
+            match = _FILTER_CLAUSE.match(clause)
+            if not match or match.group(1) in self.unsupported_filter_fields:
+                raise exceptions.InvalidArgument(f"Unsupported filter: {clause}")
+            clauses.append(match.groups())
+
+        with self._lock:
+            self.list_requests.append(dict(request))
+            resources = list(self._resources.get(resource_noun, {}).values())
+
+        for field, operator, value in clauses:
+            if field == "update_time":
+                value = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(
+                    tzinfo=datetime.timezone.utc
+                )
+            resources = [
+                resource
+                for resource in resources
+                if (getattr(resource, field) < value if operator == "<" else getattr(resource, field) == value)
+            ]
+
+        if request.get("order_by") == "update_time":
+            resources.sort(key=lambda resource: resource.update_time)
+
+        return FakePager(self, resources, request.get("page_size") or 100)
+
+    def _start_operation(
+        self,
+        operation: str,
+        resource_name: str,
+        on_done: Callable[[], None] = lambda: None,
+    ) -> "FakeOperation":
+        """Starts a long-running operation, tracking how many overlap"""
+        resource_noun = resource_name.split("/")[-2]
+        with self._lock:
+            in_flight = self._in_flight_by_resource.get(resource_name, 0)
+            if (
+                self.max_operations_per_resource is not None
+                and in_flight >= self.max_operations_per_resource
+            ):
+                raise FailedPrecondition(f"{resource_name} has an operation in progress")
+            self._in_flight_by_resource[resource_name] = in_flight + 1
+            self._in_flight[resource_noun] = self._in_flight.get(resource_noun, 0) + 1
+            self.max_in_flight[resource_noun] = max(
+                self.max_in_flight.get(resource_noun, 0), self._in_flight[resource_noun]
+            )
+
+        def finish(start: float):
+            with self._lock:
+                self._in_flight_by_resource[resource_name] -= 1
+                self._in_flight[resource_noun] -= 1
+                self.operations.append((start, time.monotonic(), operation, resource_name))
+                on_done()
+
+        return FakeOperation(time.monotonic() + self.operation_latency_in_seconds, finish)
+
+    def _operation(self, operation: str, resource_name: str):
+        """Waits for a long-running operation"""
+        self._start_operation(operation, resource_name).result()
+
+    def _update_endpoint(self, endpoint: GcaResource, update_mask) -> GcaResource:
+        with self._lock:
+            gca_resource = self._resources["endpoints"][endpoint.name]._gca_resource
+            for path in update_mask.paths:
+                setattr(gca_resource, path, getattr(endpoint, path))
+            self.traffic_split_updates += 1
+            return gca_resource
+
+    def _undeploy_model(
+        self,
+        endpoint: str,
+        deployed_model_id: str,
+        traffic_split: Optional[Dict[str, int]] = None,
+    ) -> "FakeOperation":
+        gca_resource = self._resources["endpoints"][endpoint]._gca_resource
+        with self._lock:
+            new_traffic_split = dict(gca_resource.traffic_split if traffic_split is None else traffic_split)
+            new_traffic_split.pop(deployed_model_id, None)
+            if new_traffic_split and sum(new_traffic_split.values()) != 100:
+                raise exceptions.InvalidArgument(f"Invalid traffic split {new_traffic_split}")
+
+        def undeploy():
+            gca_resource.deployed_models = [
+                deployed_model
+                for deployed_model in gca_resource.deployed_models
+                if deployed_model.id != deployed_model_id
+            ]
+            gca_resource.traffic_split.pop(deployed_model_id, None)
+
+        return self._start_operation("undeploy", endpoint, on_done=undeploy)
+
+
+class FakeOperation:
+    """A long-running operation that completes at a deadline"""
+
+    def __init__(self, deadline: float, finish: Callable[[float], None]):
+        self._start = time.monotonic()
+        self._deadline = deadline
+        self._finish = finish
+        self._done = False
+
+    def result(self):
+        if not self._done:
+            time.sleep(max(self._deadline - time.monotonic(), 0))
+            self._done = True
+            self._finish(self._start)
+
+
+class FakePager:
+    """Fetches one page at a time, as the GAPIC list pagers do"""
+
+    def __init__(self, project: FakeProject, resources: List["FakeResource"], page_size: int):
+        self._project = project
+        self._resources = resources
+        self._page_size = page_size
+        self._project.pages_fetched += 1
+
+    def __iter__(self) -> Iterator["FakeResource"]:
+        for start in range(0, len(self._resources), self._page_size):
+            if start:
+                self._project.pages_fetched += 1
+            yield from self._resources[start : start + self._page_size]
+
+
+class FakeApiClient:
+    def __init__(self, project: FakeProject):
+        self._project = project
+
+    def list_endpoints(self, request: Dict) -> FakePager:
+        return self._project._list("endpoints", request)
+
+    def list_models(self, request: Dict) -> FakePager:
+        return self._project._list("models", request)
+
+    def list_datasets(self, request: Dict) -> FakePager:
+        return self._project._list("datasets", request)
+
+    def update_endpoint(self, endpoint: GcaResource, update_mask, **kwargs) -> GcaResource:
+        return self._project._update_endpoint(endpoint, update_mask)
+
+    def undeploy_model(self, **kwargs) -> FakeOperation:
+        return self._project._undeploy_model(**kwargs)
+
+
+class FakeResource:
+    _resource_noun: str
+    _project: FakeProject
+
+    project = "test"
+    location = "us-central1"
+    credentials = None
+
+    @property
+    def api_client(self) -> FakeApiClient:
+        return self._project.api_client
+
+    def __init__(
+        self,
+        resource_name: str,
+        display_name: str,
+        update_time: datetime.datetime,
+        metadata_schema_uri: Optional[str] = None,
+    ):
+        self.resource_name = resource_name
+        self.display_name = display_name
+        self.update_time = update_time
+        self.metadata_schema_uri = metadata_schema_uri
+        self._gca_resource = GcaResource()
+
+    @classmethod
+    def _empty_constructor(cls, project=None, location=None, credentials=None):
+        return _EmptyResource(cls)
+
+    @classmethod
+    def _construct_sdk_resource_from_gapic(
+        cls, gapic_resource, project=None, location=None, credentials=None
+    ) -> "FakeResource":
+        return gapic_resource
+
+    @classmethod
+    def list(cls, **kwargs) -> List["FakeResource"]:
+        with cls._project._lock:
+            return list(cls._project._resources.get(cls._resource_noun, {}).values())
+
+    def delete(self, sync: bool = True):
+        self._project._operation("delete", self.resource_name)
+        with self._project._lock:
+            del self._project._resources[self._resource_noun][self.resource_name]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.display_name})"
+
+
+class _EmptyResource:
+    def __init__(self, resource_class):
+        self._resource_noun = resource_class._resource_noun
+        self._list_method = f"list_{resource_class._resource_noun}"
+        self.api_client = resource_class._project.api_client
+        self.project = resource_class.project
+        self.location = resource_class.location
+        self.credentials = resource_class.credentials
@@ -1,15 +1,161 @@
 import abc
-from typing import Any, Type
+import datetime
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Type
 
+from google.api_core import exceptions
 from google.cloud import aiplatform
-from google.cloud.aiplatform import base
+from google.cloud.aiplatform import base, initializer
+from google.protobuf import field_mask_pb2
 from proto.datetime_helpers import DatetimeWithNanoseconds
 
 # If a resource was updated within this number of seconds, do not delete.
 RESOURCE_UPDATE_BUFFER_IN_SECONDS = 60 * 60 * 8
 
+# Resources fetched per list request
+LIST_PAGE_SIZE = 100
+
+# Resources listed in parallel but not yet consumed, per manager
+LIST_BUFFER_SIZE = 100
+
+
+def interleave(iterables: List[Iterable], buffer_size: int = LIST_BUFFER_SIZE) -> Iterator:
+    """
+    Iterates several blocking iterables in parallel threads, yielding items
+    as they arrive. At most buffer_size items are held at once.
+    """
+    if len(iterables) == 1:
+        yield from iterables[0]
+        return
+
+    items: queue.Queue = queue.Queue(maxsize=buffer_size)
+    end = object()
+
+    def produce(iterable: Iterable):
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as error:
+            items.put((end, error))
+        else:
+            items.put((end, None))
+
+    for iterable in iterables:
+        threading.Thread(target=produce, args=(iterable,), daemon=True).start()
+
+    remaining = len(iterables)
+    while remaining:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is end:
+            remaining -= 1
+        else:
+            yield item
+
+
+def list_pages(
+    resource_class: Type[base.VertexAiResourceNounWithFutureManager],
+    filter: Optional[str] = None,
+    cls_filter: Callable[[Any], bool] = lambda _: True,
+    updated_before: Optional[datetime.datetime] = None,
+) -> Iterator[base.VertexAiResourceNounWithFutureManager]:
+    """
+    Yields resources page by page, oldest update first. The filter and
+    updated_before are pushed down to the API where it supports them, and
+    applied to each page otherwise. Listing stops at the first resource
+    updated at or after updated_before.
+    """
+    resource = resource_class._empty_constructor()
+    list_method = getattr(resource.api_client, resource._list_method)
+    request = {
+        "parent": initializer.global_config.common_location_path(
+            project=resource.project, location=resource.location
+        ),
+        "order_by": "update_time",
+        "page_size": LIST_PAGE_SIZE,
+    }
+
+    filters = [filter] if filter else []
+    if updated_before:
+        filters.append(
+            f'update_time<"{updated_before.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}"'
+        )
+
+    # The pager sends the first request right away, so unsupported filters fail here
+    try:
+        pager = list_method(request=dict(request, filter=" AND ".join(filters)))
+    except exceptions.InvalidArgument as error:
+        print(f"Filtering {resource._resource_noun} locally, as the API rejected the filter: {error}")
+        try:
+            pager = list_method(request=request)
+        except exceptions.InvalidArgument:
+            del request["order_by"]
+            pager = list_method(request=request)
+
+    # Iterating the pager fetches the next page once the current one is consumed
+    for gapic_resource in pager:
+        if updated_before and gapic_resource.update_time >= updated_before:
+            if "order_by" in request:
+                return
+            continue
+
+        if cls_filter(gapic_resource):
+            yield resource_class._construct_sdk_resource_from_gapic(
+                gapic_resource,
+                project=resource.project,
+                location=resource.location,
+                credentials=resource.credentials,
+            )
+
+
+def undeploy_all_models(endpoint: aiplatform.Endpoint):
+    """
+    Undeploys every model of an endpoint at once. Traffic is first routed
+    away from all models in a single update, so that no undeploy has to
+    rebalance it, then all undeploy operations are started before waiting
+    on any of them.
+    """
+    deployed_model_ids = [
+        deployed_model.id for deployed_model in endpoint._gca_resource.deployed_models
+    ]
+    if not deployed_model_ids:
+        return
+
+    if endpoint._gca_resource.traffic_split:
+        endpoint._gca_resource = endpoint.api_client.update_endpoint(
+            endpoint=type(endpoint._gca_resource)(
+                name=endpoint.resource_name, traffic_split={}
+            ),
+            update_mask=field_mask_pb2.FieldMask(paths=["traffic_split"]),
+        )
+
+    def start_undeploy(deployed_model_id: str):
+        return endpoint.api_client.undeploy_model(
+            endpoint=endpoint.resource_name,
+            deployed_model_id=deployed_model_id,
+            traffic_split={},
+        )
+
+    operations = []
+    for deployed_model_id in deployed_model_ids:
+        try:
+            operations.append(start_undeploy(deployed_model_id))
+        except (exceptions.FailedPrecondition, exceptions.Aborted):
+            # The endpoint is busy with the undeploys in flight, so wait for them
+            for operation in operations:
+                operation.result()
+            operations = [start_undeploy(deployed_model_id)]
+
+    for operation in operations:
+        operation.result()
+
 
 class ResourceCleanupManager(abc.ABC):
+    # The type names of managers that must finish before this one starts
+    dependencies: List[str] = []
+
     @property
     @abc.abstractmethod
     def type_name(str) -> str:
@@ -31,10 +177,21 @@ class ResourceCleanupManager(abc.ABC):
     def get_seconds_since_modification(self, resource: Any) -> float:
         pass
 
+    def resource_id(self, resource: Any) -> str:
+        """Identifies a resource across cleanup runs"""
+        return self.resource_name(resource)
+
+    def update_time(self, resource: Any) -> Optional[datetime.datetime]:
+        """When the resource last changed, if known"""
+        return None
+
+    def is_permanent(self, resource: Any) -> bool:
+        return self.resource_name(resource).startswith("perm")
+
     def is_deletable(self, resource: Any) -> bool:
         time_difference = self.get_seconds_since_modification(resource)
 
-        if self.resource_name(resource).startswith("perm"):
+        if self.is_permanent(resource):
             print(f"Skipping '{resource}' due to name starting with 'perm'.")
             return False
 
@@ -58,19 +215,30 @@ class VertexAIResourceCleanupManager(ResourceCleanupManager):
     def type_name(self) -> str:
         return self.vertex_ai_resource._resource_noun
 
-    def list(self) -> Any:
-        return self.vertex_ai_resource.list()
+    def updated_before(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=RESOURCE_UPDATE_BUFFER_IN_SECONDS
+        )
+
+    def list(self) -> Iterator:
+        return list_pages(self.vertex_ai_resource, updated_before=self.updated_before())
 
     def resource_name(
         self, resource: Type[base.VertexAiResourceNounWithFutureManager]
     ) -> str:
         return resource.display_name
 
+    def resource_id(self, resource) -> str:
+        return resource.resource_name
+
+    def update_time(self, resource) -> datetime.datetime:
+        return resource.update_time
+
     def delete(self, resource):
         resource.delete()
 
     def get_seconds_since_modification(self, resource: Any) -> bool:
-        update_time = resource.update_time
+        update_time = self.update_time(resource)
         current_time = DatetimeWithNanoseconds.now(tz=update_time.tzinfo)
         return (current_time - update_time).total_seconds()
 
@@ -85,12 +253,23 @@ class DatasetResourceCleanupManager(VertexAIResourceCleanupManager):
         aiplatform.VideoDataset,
     ]
 
-    def list(self) -> Any:
-        return [
-            dataset
-            for dataset_type in self.dataset_types
-            for dataset in dataset_type.list()
-        ]
+    def list(self) -> Iterator:
+        # Every dataset type is listed separately, so list them in parallel
+        updated_before = self.updated_before()
+        return interleave(
+            [
+                list_pages(
+                    dataset_type,
+                    filter=f'metadata_schema_uri="{uri}"',
+                    cls_filter=lambda gapic_resource, uri=uri: (
+                        gapic_resource.metadata_schema_uri == uri
+                    ),
+                    updated_before=updated_before,
+                )
+                for dataset_type in self.dataset_types
+                for uri in dataset_type._supported_metadata_schema_uris
+            ]
+        )
 
 
 class EndpointResourceCleanupManager(VertexAIResourceCleanupManager):
@@ -99,13 +278,93 @@ class EndpointResourceCleanupManager(VertexAIResourceCleanupManager):
     def delete(self, resource):
         # TODO: Remove this once https://github.com/googleapis/python-aiplatform/issues/1441 is fixed
         resource._sync_gca_resource()
-        for deployed_model_id in [
-            models.id for models in resource._gca_resource.deployed_models
-        ]:
-            resource._undeploy(deployed_model_id=deployed_model_id)
+        undeploy_all_models(resource)
 
         resource.delete(force=True)
 
 
 class ModelResourceCleanupManager(VertexAIResourceCleanupManager):
     vertex_ai_resource = aiplatform.Model
+    # Deployed models block model deletion, and endpoints undeploy them
+    dependencies = [EndpointResourceCleanupManager.vertex_ai_resource._resource_noun]
+
+
+def test_list_pages_stops_at_recent_resources():
+    import fake_aiplatform
+
+    project = fake_aiplatform.FakeProject()
+    for index in range(250):
+        project.add_model(f"model-{index}", datetime.timedelta(days=2, minutes=index))
+    for index in range(250):
+        project.add_model(f"recent-model-{index}", datetime.timedelta(minutes=index))
+    updated_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+
+    models = list(list_pages(project.Model, updated_before=updated_before))
+    assert len(models) == 250
+    assert project.pages_fetched == 3
+    assert 'update_time<"' in project.list_requests[0]["filter"]
+
+    # Without server-side filters, listing stops at the first recent model
+    project.unsupported_filter_fields.add("update_time")
+    project.pages_fetched = 0
+    models = list(list_pages(project.Model, updated_before=updated_before))
+    assert len(models) == 250
+    assert project.pages_fetched == 3
+    assert "filter" not in project.list_requests[-1]
+
+
+def test_dataset_manager_lists_each_schema():
+    import fake_aiplatform
+
+    project = fake_aiplatform.FakeProject()
+    for schema in ["image", "tabular", "text"]:
+        project.add_dataset(f"{schema}-dataset", datetime.timedelta(days=1), metadata_schema=schema)
+
+    class FakeDatasetManager(DatasetResourceCleanupManager):
+        vertex_ai_resource = project.Dataset
+        dataset_types = project.dataset_types
+
+    project.unsupported_filter_fields.add("metadata_schema_uri")
+    assert sorted(dataset.display_name for dataset in FakeDatasetManager().list()) == [
+        "image-dataset",
+        "tabular-dataset",
+        "text-dataset",
+    ]
+
+
+def test_undeploy_all_models_overlaps_undeploys():
+    import time
+
+    import fake_aiplatform
+
+    project = fake_aiplatform.FakeProject(operation_latency_in_seconds=0.05)
+    old = datetime.timedelta(days=1)
+    endpoints = [
+        project.add_endpoint(
+            f"endpoint-{index}",
+            old,
+            deployed_models=[project.add_model(f"model-{index}-{model}", old) for model in range(4)],
+        )
+        for index in range(2)
+    ]
+
+    # Undeploying one by one waits on every operation in turn
+    time_start = time.monotonic()
+    for deployed_model in list(endpoints[0]._gca_resource.deployed_models):
+        endpoints[0]._undeploy(deployed_model.id)
+    sequential_duration = time.monotonic() - time_start
+
+    time_start = time.monotonic()
+    undeploy_all_models(endpoints[1])
+    concurrent_duration = time.monotonic() - time_start
+
+    assert endpoints[1]._gca_resource.deployed_models == []
+    assert project.traffic_split_updates == 1
+    assert project.max_in_flight["endpoints"] == 4
+    assert concurrent_duration * 2 < sequential_duration
+
+    # An endpoint that takes one operation at a time is undeployed in turn
+    project.max_operations_per_resource = 1
+    endpoint = project.add_endpoint("endpoint-serial", old, deployed_models=[project.add_model("model", old)] * 3)
+    undeploy_all_models(endpoint)
+    assert endpoint._gca_resource.deployed_models == []
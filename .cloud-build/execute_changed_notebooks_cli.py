@@ -19,6 +19,7 @@ import argparse
 import pathlib
 
 import execute_changed_notebooks_helper
+from utils import execution_history, sharding
 
 
 def str2bool(v):
@@ -36,14 +37,20 @@ parser = argparse.ArgumentParser(description="Run changed notebooks.")
 parser.add_argument(
     "--test_paths_file",
     type=pathlib.Path,
-    help="The path to the file that has newline-limited folders of notebooks that should be tested.",
-    required=True,
+    help="The path to the file that has newline-limited folders of notebooks that should be tested. Required unless --rerun_failed is given.",
+    required=False,
 )
 parser.add_argument(
     "--base_branch",
     help="The base git branch to diff against to find changed files.",
     required=False,
 )
+parser.add_argument(
+    "--dependency_index_file",
+    type=str,
+    help="A local path or GCS URI to cache the notebook dependency index in. Notebooks that reference changed files are also run.",
+    required=False,
+)
 parser.add_argument(
     "--container_uri",
     type=str,
@@ -107,13 +114,132 @@ parser.add_argument(
     default=True,
     help="Should run notebooks in parallel.",
 )
+parser.add_argument(
+    "--execution_history_file",
+    type=str,
+    help="A local path or GCS URI to a JSONL history of notebook durations. Used to run the longest notebooks first and to derive per-notebook timeouts. When sharding, every shard must be given the same pinned snapshot, which shards only read; merge_notebook_results_cli.py records the durations.",
+    required=False,
+)
+parser.add_argument(
+    "--result_cache_file",
+    type=str,
+    help="A local path or GCS URI to a cache of passing executions. Notebooks with unchanged inputs since their last pass are skipped. When sharding, shards only read the cache; merge_notebook_results_cli.py records the passes.",
+    required=False,
+)
+parser.add_argument(
+    "--result_cache_ttl_in_days",
+    type=float,
+    help="The number of days a cached pass stays valid.",
+    default=7,
+    required=False,
+)
+parser.add_argument(
+    "--should_force_execution",
+    type=str2bool,
+    nargs="?",
+    const=True,
+    default=False,
+    help="Execute every notebook even if it has a cached pass.",
+)
+parser.add_argument(
+    "--shard_index",
+    type=int,
+    help="The shard of the notebooks to run, from 0 to shard_count - 1.",
+    default=0,
+    required=False,
+)
+parser.add_argument(
+    "--shard_count",
+    type=int,
+    help="Split the notebooks into this many shards balanced by their duration in the execution history, and only run one of them.",
+    default=1,
+    required=False,
+)
+parser.add_argument(
+    "--results_file",
+    type=str,
+    help="A local path or GCS URI to write the results to as JSON, to merge shards with merge_notebook_results_cli.py.",
+    required=False,
+)
+parser.add_argument(
+    "--timings_json_file",
+    type=str,
+    help="A local path or GCS URI to write the time each notebook spent in each phase to, as JSON.",
+    required=False,
+)
+parser.add_argument(
+    "--timings_prometheus_file",
+    type=str,
+    help="A local path or GCS URI to write the phase timings to in the Prometheus text format.",
+    required=False,
+)
+parser.add_argument(
+    "--wheelhouse_dir",
+    type=str,
+    help="A local folder to build a shared wheelhouse of the notebooks' pip requirements in. Builds install from it instead of an index.",
+    required=False,
+)
+parser.add_argument(
+    "--wheelhouse_local_index",
+    type=str,
+    help="A local folder of wheels to build the wheelhouse from, instead of an index.",
+    required=False,
+)
+parser.add_argument(
+    "--rerun_failed",
+    type=str,
+    nargs="+",
+    help="Local paths or GCS URIs of results files written with --results_file. Only the notebooks that failed or timed out in them are run again.",
+    required=False,
+)
+parser.add_argument(
+    "--max_retries",
+    type=int,
+    help="The number of times to run failed notebooks again. Notebooks that pass on a retry are reported as flaky.",
+    default=0,
+    required=False,
+)
 
 args = parser.parse_args()
 
-notebooks = execute_changed_notebooks_helper.get_changed_notebooks(
-    test_paths_file=args.test_paths_file,
-    base_branch=args.base_branch,
-)
+previous_results = None
+if args.rerun_failed:
+    previous_results = []
+    for results_file in args.rerun_failed:
+        results = execute_changed_notebooks_helper.load_results(results_file)
+        if results is None:
+            parser.error(f"No results were written to {results_file}")
+        previous_results += results
+
+    notebooks = execute_changed_notebooks_helper.failed_notebooks(previous_results)
+    print(f"Re-running {len(notebooks)} failed notebooks: {notebooks}")
+elif args.test_paths_file:
+    notebooks = execute_changed_notebooks_helper.get_changed_notebooks(
+        test_paths_file=args.test_paths_file,
+        base_branch=args.base_branch,
+        dependency_index_file=args.dependency_index_file,
+    )
+else:
+    parser.error("Either --test_paths_file or --rerun_failed is required")
+
+history_snapshot = None
+if args.shard_count > 1:
+    # Every shard partitions from the same read-only snapshot, so that the
+    # shards agree on the partition. The merge step records the durations.
+    if args.execution_history_file:
+        history_snapshot = execution_history.ExecutionHistory.load(
+            args.execution_history_file
+        )
+
+    notebooks = sharding.shard_notebooks(
+        notebooks=notebooks,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        history=history_snapshot,
+    )
+    print(
+        f"Running shard {args.shard_index} of {args.shard_count} with {len(notebooks)} notebooks."
+    )
 
 execute_changed_notebooks_helper.process_and_execute_notebooks(
     notebooks=notebooks,
@@ -127,4 +253,17 @@ execute_changed_notebooks_helper.process_and_execute_notebooks(
     variable_service_account=args.variable_service_account,
     variable_vpc_network=args.variable_vpc_network,
     private_pool_id=args.private_pool_id,
+    execution_history_file=None if args.shard_count > 1 else args.execution_history_file,
+    history_snapshot=history_snapshot,
+    result_cache_file=args.result_cache_file,
+    result_cache_ttl_in_days=args.result_cache_ttl_in_days,
+    should_save_result_cache=args.shard_count <= 1,
+    should_force_execution=args.should_force_execution,
+    results_file=args.results_file,
+    timings_json_file=args.timings_json_file,
+    timings_prometheus_file=args.timings_prometheus_file,
+    wheelhouse_dir=args.wheelhouse_dir,
+    wheelhouse_local_index=args.wheelhouse_local_index,
+    max_retries=args.max_retries,
+    previous_results=previous_results,
 )
@@ -13,33 +13,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import concurrent
+import asyncio
 import dataclasses
 import datetime
 import functools
-import json
 import git
+import json
 import operator
 import os
 import pathlib
 import re
 import subprocess
+import tempfile
+import threading
 import utils
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 from utils import util
 
 import execute_notebook_helper
 import execute_notebook_remote
-import nbformat
+from google.api_core import operation
 from google.cloud.devtools.cloudbuild_v1.types import BuildOperationMetadata
-from ratemate import RateLimit
 from tabulate import tabulate
-from utils import NotebookProcessors, util
+from utils import (
+    build_scheduler,
+    code_archive,
+    execution_history,
+    log_reader,
+    notebook_dependencies,
+    notebook_preprocessing,
+    phase_timings,
+    rate_limiter,
+    result_cache,
+    staging,
+    storage,
+    wheelhouse,
+)
 
 # A buffer so that workers finish before the orchestrating job
 WORKER_TIMEOUT_BUFFER_IN_SECONDS: int = 60 * 60
+# The maximum number of notebook builds running at the same time
+MAX_CONCURRENT_BUILDS: int = 100
 PYTHON_VERSION = "3.9" # Set default python version
 
+# Marks the start of the notebook execution step in the build log
+NOTEBOOK_EXECUTION_STEP_MARKER = "starting Step #5"
+
+# The build steps that install dependencies and execute the notebook
+INSTALL_STEP_INDEX = 4
+EXECUTION_STEP_INDEX = 5
+
 
 def format_timedelta(delta: datetime.timedelta) -> str:
     """Formats a timedelta duration to [N days] %H:%M:%S format"""
@@ -72,6 +95,47 @@ class NotebookExecutionResult:
     build_id: str
     logs_bucket: str
     error_message: Optional[str]
+    is_cached: bool = False
+    phases: phase_timings.Phases = dataclasses.field(default_factory=dict)
+    notebook_path: str = ""
+    # Summaries of the earlier attempts at this notebook, oldest first
+    previous_attempts: List[Dict] = dataclasses.field(default_factory=list)
+    # The result cache key of the inputs this notebook ran with
+    cache_key: Optional[str] = None
+
+    @property
+    def status(self) -> str:
+        if self.is_cached:
+            return "CACHED"
+        return "PASSED" if self.is_pass else "FAILED"
+
+    @property
+    def attempts(self) -> str:
+        return " -> ".join(
+            [attempt["status"] for attempt in self.previous_attempts] + [self.status]
+        )
+
+    @property
+    def is_flaky(self) -> bool:
+        """Passed after failing on an earlier attempt"""
+        return self.is_pass and any(
+            attempt["status"] == "FAILED" for attempt in self.previous_attempts
+        )
+
+    def retried_by(self, retry: "NotebookExecutionResult"):
+        """Records this result as an earlier attempt of retry"""
+        retry.previous_attempts = self.previous_attempts + [
+            {
+                "status": self.status,
+                "duration": self.duration.total_seconds(),
+                "build_id": self.build_id,
+                "log_url": self.log_url,
+                "error_message": self.error_message,
+            }
+        ]
+
+    def phase_seconds(self, phase: str) -> Optional[float]:
+        return phase_timings.phase_seconds(self.phases, phase)
 
     @property
     def output_uri_web(self) -> Optional[str]:
@@ -87,59 +151,123 @@ def _process_notebook(
     variable_region: str,
     variable_service_account: str,
     variable_vpc_network: Optional[str],
-):
-    # Read notebook
-    with open(notebook_path) as f:
-        nb = nbformat.read(f, as_version=4)
-
-    # Create preprocessors
-    remove_no_execute_cells_preprocessor = NotebookProcessors.RemoveNoExecuteCells()
-    update_variables_preprocessor = NotebookProcessors.UpdateVariablesPreprocessor(
+) -> notebook_preprocessing.PreprocessedNotebook:
+    """
+    Pre-processes a notebook, parsing it only once, and returns the result
+    serialized as bytes along with its Python version. The notebook file
+    itself is left untouched.
+    """
+    return notebook_preprocessing.preprocess_notebook(
+        notebook_path=notebook_path,
         replacement_map={
             "PROJECT_ID": variable_project_id,
             "REGION": variable_region,
             "SERVICE_ACCOUNT": variable_service_account,
             "VPC_NETWORK": variable_vpc_network,
         },
+        default_python_version=PYTHON_VERSION,
     )
 
-    # Use no-execute preprocessor
-    (
-        nb,
-        resources,
-    ) = remove_no_execute_cells_preprocessor.preprocess(nb)
 
-    (nb, resources) = update_variables_preprocessor.preprocess(nb, resources)
-
-    with open(notebook_path, mode="w", encoding="utf-8") as new_file:
-        nbformat.write(nb, new_file)
+def _stage_notebook(
+    staging_area: staging.StagingArea,
+    notebook_path: str,
+    variable_project_id: str,
+    variable_region: str,
+    variable_service_account: str,
+    variable_vpc_network: Optional[str],
+):
+    """Pre-processes a notebook into the staging area"""
+    preprocessed_notebook = _process_notebook(
+        notebook_path=notebook_path,
+        variable_project_id=variable_project_id,
+        variable_region=variable_region,
+        variable_service_account=variable_service_account,
+        variable_vpc_network=variable_vpc_network,
+    )
+    staging_area.stage(
+        notebook_path,
+        preprocessed_notebook.content,
+        python_version=preprocessed_notebook.python_version,
+        preprocessing_started_at=preprocessed_notebook.preprocessing_started_at,
+        preprocessing_seconds=preprocessed_notebook.preprocessing_seconds,
+        wheelhouse_archive_uri=None,
+    )
 
 
-def _get_notebook_python_version(notebook_path: str) -> str:
+def _stage_notebooks(
+    staging_area: staging.StagingArea,
+    notebooks: List[str],
+    artifacts_bucket: str,
+    variable_project_id: str,
+    variable_region: str,
+    variable_service_account: str,
+    variable_vpc_network: Optional[str],
+    on_submitted: Optional[Callable[[], None]] = None,
+    notebook_wheelhouse: Optional[wheelhouse.Wheelhouse] = None,
+) -> List[NotebookExecutionResult]:
     """
-    Get the python version for running the notebook if it is specified in
-    the notebook.
+    Pre-processes all notebooks into the staging area using a process pool.
+    Returns failed results for the notebooks that could not be pre-processed.
+
+    If notebook_wheelhouse is set, the notebooks that run on this Python
+    version install their requirements from it.
     """
-    python_version = PYTHON_VERSION
-
-    # Load the notebook
-    file = open(notebook_path)
-    src = file.read()
-    nb_json = json.loads(src)
-
-    #Iterate over the cells in the ipynb
-    for cell in nb_json['cells']:
-        if cell['cell_type'] == 'markdown':
-            markdown = str.join('', cell['source'])
-
-            # Look for the python version specification pattern
-            re_match = re.search('python version = (\d\.\d)', markdown, flags=re.IGNORECASE)
-            if re_match:
-                # get the version number
-                python_version = re_match.group(1)
-                break
+    time_start = datetime.datetime.now()
+
+    preprocessed_notebooks, errors = notebook_preprocessing.preprocess_notebooks(
+        notebook_paths=notebooks,
+        replacement_map={
+            "PROJECT_ID": variable_project_id,
+            "REGION": variable_region,
+            "SERVICE_ACCOUNT": variable_service_account,
+            "VPC_NETWORK": variable_vpc_network,
+        },
+        default_python_version=PYTHON_VERSION,
+        on_submitted=on_submitted,
+        wheelhouse_requirements=set(notebook_wheelhouse.requirements)
+        if notebook_wheelhouse
+        else None,
+        wheelhouse_python_version=wheelhouse.python_version(),
+    )
 
-    return python_version
+    for notebook, preprocessed_notebook in preprocessed_notebooks.items():
+        staging_area.stage(
+            notebook,
+            preprocessed_notebook.content,
+            python_version=preprocessed_notebook.python_version,
+            preprocessing_started_at=preprocessed_notebook.preprocessing_started_at,
+            preprocessing_seconds=preprocessed_notebook.preprocessing_seconds,
+            wheelhouse_archive_uri=notebook_wheelhouse.archive_uri
+            if preprocessed_notebook.is_using_wheelhouse
+            else None,
+        )
+
+    print(
+        tabulate(
+            sorted(
+                [
+                    [notebook, f"{preprocessed_notebook.preprocessing_seconds:.3f}"]
+                    for notebook, preprocessed_notebook in preprocessed_notebooks.items()
+                ],
+                key=lambda row: float(row[1]),
+                reverse=True,
+            ),
+            headers=["notebook", "preprocessing_seconds"],
+        )
+    )
+    print(
+        f"Pre-processed {len(preprocessed_notebooks)} notebooks in {format_timedelta(datetime.datetime.now() - time_start)}."
+    )
+
+    failures = []
+    for notebook, error in errors.items():
+        result = _create_result(notebook=notebook, artifacts_bucket=artifacts_bucket)
+        result.error_message = f"Pre-processing failed: {error}"
+        failures.append(result)
+        print(f"{notebook} FAILED: {result.error_message}")
+
+    return failures
 
 
 def _create_tag(filepath: str) -> str:
@@ -152,40 +280,23 @@ def _create_tag(filepath: str) -> str:
     return tag
 
 
-rate_limit = RateLimit(max_count=50, per=60, greedy=True)
+# Build creations adapt to quota errors, and share one budget with the other
+# shards running on this machine
+rate_limit = rate_limiter.AdaptiveRateLimiter(
+    per_minute=50,
+    burst=50,
+    state_file=os.path.join(tempfile.gettempdir(), "notebook-build-rate-limit.json"),
+)
 
 
-def process_and_execute_notebook(
-    container_uri: str,
-    staging_bucket: str,
-    artifacts_bucket: str,
-    variable_project_id: str,
-    variable_region: str,
-    variable_service_account: str,
-    variable_vpc_network: Optional[str],
-    private_pool_id: Optional[str],
-    deadline: datetime.datetime,
-    notebook: str,
-    should_get_tail_logs: bool = False,
-) -> NotebookExecutionResult:
-    rate_limit.wait()  # wait before creating the task
-
-    print(f"Running notebook: {notebook}")
-
-    # Handle empty strings
-    if not variable_vpc_network:
-        variable_vpc_network = None
-
-    if not private_pool_id:
-        private_pool_id = None
-
+def _create_result(notebook: str, artifacts_bucket: str) -> NotebookExecutionResult:
     # Create paths
     notebook_output_uri = "/".join([artifacts_bucket, pathlib.Path(notebook).name])
 
     # Create tag from notebook
     tag = _create_tag(filepath=notebook)
 
-    result = NotebookExecutionResult(
+    return NotebookExecutionResult(
         name=tag,
         duration=datetime.timedelta(seconds=0),
         is_pass=False,
@@ -194,18 +305,43 @@ def process_and_execute_notebook(
         build_id="",
         logs_bucket="",
         error_message=None,
+        notebook_path=notebook,
     )
 
-    # TODO: Handle cases where multiple notebooks have the same name
-    time_start = datetime.datetime.now()
-    operation = None
-    try:
-        # Get the python version for running the notebook if specified
-        notebook_exec_python_version = _get_notebook_python_version(notebook_path=notebook)
-        print(f"Running notebook with python {notebook_exec_python_version}")
 
-        # Pre-process notebook by substituting variable names
-        _process_notebook(
+def _submit_notebook(
+    container_uri: str,
+    staging_bucket: str,
+    variable_project_id: str,
+    variable_region: str,
+    variable_service_account: str,
+    variable_vpc_network: Optional[str],
+    private_pool_id: Optional[str],
+    deadline: datetime.datetime,
+    notebook: str,
+    result: NotebookExecutionResult,
+    code_archive_builder: Optional[code_archive.CodeArchiveBuilder] = None,
+    staging_area: Optional[staging.StagingArea] = None,
+    timeout_in_seconds: Optional[int] = None,
+) -> operation.Operation:
+    """
+    Pre-processes and archives a notebook and submits its build. The build
+    details are recorded on the result.
+    """
+    # Handle empty strings
+    if not variable_vpc_network:
+        variable_vpc_network = None
+
+    if not private_pool_id:
+        private_pool_id = None
+
+    # Pre-process notebook by substituting variable names, unless already staged
+    if staging_area is None:
+        staging_area = staging.StagingArea()
+
+    if notebook not in staging_area:
+        _stage_notebook(
+            staging_area=staging_area,
             notebook_path=notebook,
             variable_project_id=variable_project_id,
             variable_region=variable_region,
@@ -213,33 +349,137 @@ def process_and_execute_notebook(
             variable_vpc_network=variable_vpc_network,
         )
 
-        # Upload the pre-processed code to a GCS bucket
-        code_archive_uri = util.archive_code_and_upload(staging_bucket=staging_bucket)
+    # Get the python version for running the notebook if specified
+    attributes = staging_area.attributes(notebook)
+    notebook_exec_python_version = attributes["python_version"]
+    print(f"Running notebook with python {notebook_exec_python_version}")
+
+    phase_timings.record(
+        result.phases,
+        "preprocess",
+        attributes["preprocessing_started_at"],
+        attributes["preprocessing_started_at"] + attributes["preprocessing_seconds"],
+    )
+
+    # Upload the shared source archive and the pre-processed notebook overlay
+    if code_archive_builder is None:
+        code_archive_builder = code_archive.CodeArchiveBuilder(
+            staging_bucket=staging_bucket,
+            storage_backend=storage.get_default_storage(),
+        )
+
+    # Archiving includes waiting for the shared archive to be built and uploaded
+    with phase_timings.timed(result.phases, "archive"):
+        code_archive_uri = code_archive_builder.base_archive_uri()
+        overlay_archive = code_archive.build_overlay_archive(
+            staging_area.files([notebook])
+        )
 
-        # Calculate timeout in seconds
-        timeout_in_seconds = max(
-            int((deadline - datetime.datetime.now()).total_seconds()), 1
+    with phase_timings.timed(result.phases, "upload"):
+        overlay_archive_uri = code_archive_builder.upload_overlay_archive(
+            overlay_archive
         )
 
-        operation = execute_notebook_remote.execute_notebook_remote(
+    # Calculate timeout in seconds, which never extends past the deadline
+    deadline_in_seconds = max(
+        int((deadline - datetime.datetime.now()).total_seconds()), 1
+    )
+    if timeout_in_seconds is None:
+        timeout_in_seconds = deadline_in_seconds
+    else:
+        timeout_in_seconds = min(timeout_in_seconds, deadline_in_seconds)
+
+    with phase_timings.timed(result.phases, "submit"):
+        operation = rate_limit.call(
+            execute_notebook_remote.execute_notebook_remote,
             code_archive_uri=code_archive_uri,
+            overlay_archive_uri=overlay_archive_uri,
             notebook_uri=notebook,
-            notebook_output_uri=notebook_output_uri,
+            notebook_output_uri=result.output_uri,
             container_uri=container_uri,
-            tag=tag,
+            tag=result.name,
             private_pool_id=private_pool_id,
             private_pool_region=variable_region,
             timeout_in_seconds=timeout_in_seconds,
-            python_version=notebook_exec_python_version
+            python_version=notebook_exec_python_version,
+            wheelhouse_archive_uri=attributes["wheelhouse_archive_uri"],
         )
 
-        operation_metadata = BuildOperationMetadata(mapping=operation.metadata)
-        result.build_id = operation_metadata.build.id
-        result.log_url = operation_metadata.build.log_url
-        result.logs_bucket = operation_metadata.build.logs_bucket
+    operation_metadata = BuildOperationMetadata(mapping=operation.metadata)
+    result.build_id = operation_metadata.build.id
+    result.log_url = operation_metadata.build.log_url
+    result.logs_bucket = operation_metadata.build.logs_bucket
+
+    return operation
+
+
+def _record_build_phases(
+    result: NotebookExecutionResult, state: build_scheduler.BuildState
+):
+    """Records the time the build was queued and running, and its main steps"""
+    phase_timings.record(result.phases, "queued", state.create_time, state.start_time)
+    phase_timings.record(result.phases, "running", state.start_time, state.finish_time)
+
+    for phase, step_index in [
+        ("install", INSTALL_STEP_INDEX),
+        ("execute", EXECUTION_STEP_INDEX),
+    ]:
+        if step_index < len(state.step_times):
+            phase_timings.record(result.phases, phase, *state.step_times[step_index])
+
+
+def _get_log_uri(result: NotebookExecutionResult) -> str:
+    return f"{result.logs_bucket}/log-{result.build_id}.txt"
+
+
+def _get_tail_logs(result: NotebookExecutionResult) -> str:
+    """Reads the tail end of the build log through the shared storage client"""
+    return log_reader.LogReader(_get_log_uri(result)).tail(1000)
+
+
+def process_and_execute_notebook(
+    container_uri: str,
+    staging_bucket: str,
+    artifacts_bucket: str,
+    variable_project_id: str,
+    variable_region: str,
+    variable_service_account: str,
+    variable_vpc_network: Optional[str],
+    private_pool_id: Optional[str],
+    deadline: datetime.datetime,
+    notebook: str,
+    should_get_tail_logs: bool = False,
+    code_archive_builder: Optional[code_archive.CodeArchiveBuilder] = None,
+    staging_area: Optional[staging.StagingArea] = None,
+    timeout_in_seconds: Optional[int] = None,
+) -> NotebookExecutionResult:
+    print(f"Running notebook: {notebook}")
+
+    result = _create_result(notebook=notebook, artifacts_bucket=artifacts_bucket)
+
+    # TODO: Handle cases where multiple notebooks have the same name
+    time_start = datetime.datetime.now()
+    operation = None
+    try:
+        operation = _submit_notebook(
+            container_uri=container_uri,
+            staging_bucket=staging_bucket,
+            variable_project_id=variable_project_id,
+            variable_region=variable_region,
+            variable_service_account=variable_service_account,
+            variable_vpc_network=variable_vpc_network,
+            private_pool_id=private_pool_id,
+            deadline=deadline,
+            notebook=notebook,
+            result=result,
+            code_archive_builder=code_archive_builder,
+            staging_area=staging_area,
+            timeout_in_seconds=timeout_in_seconds,
+        )
 
         # Block and wait for the result
         operation_result = operation.result()
+        _record_build_phases(result, build_scheduler.build_state(operation_result))
 
         result.duration = datetime.datetime.now() - time_start
         result.is_pass = True
@@ -248,17 +488,9 @@ def process_and_execute_notebook(
         result.error_message = str(error)
 
         if operation and should_get_tail_logs:
-            # Extract the logs
-            logs_bucket = operation_metadata.build.logs_bucket
-
-            # Download tail end of logs file
-            log_file_uri = f"{logs_bucket}/log-{result.build_id}.txt"
-
-            # Use gcloud to get tail
             try:
-                result.error_message = subprocess.check_output(
-                    ["gsutil", "cat", "-r", "-1000", log_file_uri], encoding="UTF-8"
-                )
+                with phase_timings.timed(result.phases, "log_fetch"):
+                    result.error_message = _get_tail_logs(result)
             except Exception as error:
                 result.error_message = str(error)
 
@@ -272,13 +504,125 @@ def process_and_execute_notebook(
     return result
 
 
+def _schedule_and_execute_notebooks(
+    notebooks: List[str],
+    container_uri: str,
+    staging_bucket: str,
+    artifacts_bucket: str,
+    variable_project_id: str,
+    variable_region: str,
+    variable_service_account: str,
+    variable_vpc_network: Optional[str],
+    private_pool_id: Optional[str],
+    deadline: datetime.datetime,
+    code_archive_builder: code_archive.CodeArchiveBuilder,
+    staging_area: staging.StagingArea,
+    timeouts_in_seconds: Dict[str, Optional[int]],
+) -> List[NotebookExecutionResult]:
+    """
+    Submits all notebooks through a BuildScheduler, which tracks every build
+    from a single event loop thread.
+    """
+    results = {
+        notebook: _create_result(notebook=notebook, artifacts_bucket=artifacts_bucket)
+        for notebook in notebooks
+    }
+    time_starts: Dict[str, datetime.datetime] = {}
+
+    def submit(notebook: str) -> str:
+        print(f"Running notebook: {notebook}")
+
+        time_starts[notebook] = datetime.datetime.now()
+        _submit_notebook(
+            container_uri=container_uri,
+            staging_bucket=staging_bucket,
+            variable_project_id=variable_project_id,
+            variable_region=variable_region,
+            variable_service_account=variable_service_account,
+            variable_vpc_network=variable_vpc_network,
+            private_pool_id=private_pool_id,
+            deadline=deadline,
+            notebook=notebook,
+            result=results[notebook],
+            code_archive_builder=code_archive_builder,
+            staging_area=staging_area,
+            timeout_in_seconds=timeouts_in_seconds[notebook],
+        )
+
+        return results[notebook].build_id
+
+    scheduler = build_scheduler.BuildScheduler(
+        service=build_scheduler.CloudBuildService(
+            session=execute_notebook_remote.get_default_session(),
+            region=variable_region if private_pool_id else None,
+        ),
+        max_concurrent_builds=MAX_CONCURRENT_BUILDS,
+    )
+
+    async def collect():
+        async for completion in scheduler.run(notebooks, submit):
+            notebook = completion.key
+            result = results[notebook]
+            result.duration = datetime.datetime.now() - time_starts.get(
+                notebook, datetime.datetime.now()
+            )
+            result.is_pass = completion.is_success
+            if completion.state:
+                _record_build_phases(result, completion.state)
+
+            if result.is_pass:
+                print(f"{notebook} PASSED in {format_timedelta(result.duration)}.")
+            else:
+                result.error_message = completion.error_message
+                print(
+                    f"{notebook} FAILED in {format_timedelta(result.duration)}: {result.error_message}"
+                )
+
+    asyncio.run(collect())
+
+    return [results[notebook] for notebook in notebooks]
+
+
+def _get_dependent_notebooks(
+    test_paths: List[str],
+    changed_files: List[str],
+    dependency_index_file: Optional[str] = None,
+) -> List[str]:
+    """
+    Get the notebooks under the test_paths that reference any of the changed files,
+    such as a shared trainer package or a src directory next to the notebook.
+    """
+    notebooks_str = subprocess.check_output(["git", "ls-files"] + test_paths)
+    notebooks = [
+        notebook
+        for notebook in notebooks_str.decode("utf-8").split("\n")
+        if notebook.endswith(".ipynb")
+    ]
+
+    dependency_index = notebook_dependencies.DependencyIndex(
+        tracked_files=code_archive.list_tracked_files(),
+        cache_file=dependency_index_file,
+    )
+    dependent_notebooks = dependency_index.dependent_notebooks(
+        notebooks=notebooks, changed_files=changed_files
+    )
+    dependency_index.save()
+
+    if len(dependent_notebooks) > 0:
+        print(f"Found {len(dependent_notebooks)} notebooks depending on changed files.")
+
+    return dependent_notebooks
+
+
 def get_changed_notebooks(
     test_paths_file: str,
     base_branch: Optional[str] = None,
+    dependency_index_file: Optional[str] = None,
 ) -> List[str]:
     """
     Get the notebooks that exist under the folders defined in the test_paths_file.
-    It only returns notebooks that have differences from the Git base_branch.
+    It only returns notebooks that have differences from the Git base_branch,
+    or that reference repository files which have differences from it.
     """
 
     test_paths = []
@@ -312,6 +656,17 @@ def get_changed_notebooks(
                 for diff in index.diff(branching_commit, paths=test_paths)
                 if diff.b_path is not None
             ]
+
+            # Notebooks are also affected by changes to the files they reference
+            changed_files = [
+                diff.b_path or diff.a_path for diff in index.diff(branching_commit)
+            ]
+            notebooks += _get_dependent_notebooks(
+                test_paths=test_paths,
+                changed_files=changed_files,
+                dependency_index_file=dependency_index_file,
+            )
+            notebooks = list(dict.fromkeys(notebooks))
         else:
             notebooks = []
     else:
@@ -331,6 +686,226 @@ def get_changed_notebooks(
     return notebooks
 
 
+def save_results(results: List[NotebookExecutionResult], results_file: str):
+    """Writes results as JSON to a local path or GCS URI, e.g. for merging shards"""
+    storage.write_text(
+        results_file,
+        json.dumps(
+            [
+                dict(
+                    dataclasses.asdict(result),
+                    duration=result.duration.total_seconds(),
+                )
+                for result in results
+            ],
+            indent=2,
+        ),
+    )
+
+
+def load_results(results_file: str) -> Optional[List[NotebookExecutionResult]]:
+    """Reads results written by save_results, or None if there are none"""
+    content = storage.read_text(results_file)
+    if content is None:
+        return None
+
+    return [
+        NotebookExecutionResult(
+            **dict(record, duration=datetime.timedelta(seconds=record["duration"]))
+        )
+        for record in json.loads(content)
+    ]
+
+
+def failed_notebooks(results: List[NotebookExecutionResult]) -> List[str]:
+    """Returns the paths of the notebooks that failed or timed out"""
+    notebooks = []
+    for result in results:
+        if result.is_pass:
+            continue
+
+        if not result.notebook_path:
+            raise ValueError(
+                f"The result of {result.name} has no notebook path. It was saved by an older version, so the whole set has to be run again."
+            )
+        notebooks.append(result.notebook_path)
+
+    return sorted(set(notebooks))
+
+
+def record_history(
+    history: execution_history.ExecutionHistory,
+    results: List[NotebookExecutionResult],
+):
+    """
+    Records every attempt that ran a build, including the failed attempts
+    before a retry. Builds already in the history are not recorded again.
+    """
+    for result in results:
+        if result.is_cached or not result.notebook_path:
+            continue
+
+        for attempt in result.previous_attempts:
+            if attempt["build_id"] and attempt["status"] != "CACHED":
+                history.record(
+                    notebook=result.notebook_path,
+                    duration=datetime.timedelta(seconds=attempt["duration"]),
+                    is_pass=attempt["status"] == "PASSED",
+                    build_id=attempt["build_id"],
+                )
+
+        if result.build_id:
+            history.record(
+                notebook=result.notebook_path,
+                duration=result.duration,
+                is_pass=result.is_pass,
+                build_id=result.build_id,
+            )
+
+
+def record_result_cache(
+    cache: result_cache.ResultCache, results: List[NotebookExecutionResult]
+):
+    """Records the passes of the results that carry a cache key"""
+    for result in results:
+        # A flaky pass must not hide the notebook from the next runs
+        if (
+            result.cache_key
+            and result.is_pass
+            and not result.is_cached
+            and not result.is_flaky
+        ):
+            cache.record_pass(
+                key=result.cache_key,
+                notebook=result.notebook_path,
+                build_id=result.build_id,
+                log_url=result.log_url,
+                output_uri=result.output_uri,
+            )
+
+
+def export_timings(
+    results: List[NotebookExecutionResult],
+    timings_json_file: Optional[str] = None,
+    timings_prometheus_file: Optional[str] = None,
+):
+    """
+    Writes the phase timings of results as JSON and in the Prometheus text
+    format, by notebook path, since notebooks in different folders may share
+    a file name
+    """
+    phases_by_notebook = {
+        result.notebook_path or result.name: result.phases for result in results
+    }
+
+    if timings_json_file:
+        storage.write_text(timings_json_file, phase_timings.to_json(phases_by_notebook))
+
+    if timings_prometheus_file:
+        storage.write_text(
+            timings_prometheus_file, phase_timings.to_prometheus(phases_by_notebook)
+        )
+
+
+def _format_phase(result: NotebookExecutionResult, phase: str) -> str:
+    seconds = result.phase_seconds(phase)
+    if seconds is None:
+        return ""
+
+    return format_timedelta(datetime.timedelta(seconds=seconds))
+
+
+def report_results(results: List[NotebookExecutionResult]):
+    """Prints the results table, and raises an error if any notebook failed"""
+    print("\n=== RESULTS ===\n")
+
+    results_sorted = sorted(
+        results,
+        key=lambda result: result.is_pass,
+        reverse=True,
+    )
+
+    # Print results
+    print(
+        tabulate(
+            [
+                [
+                    result.name,
+                    result.status,
+                    result.attempts,
+                    format_timedelta(result.duration),
+                    _format_phase(result, "queued"),
+                    _format_phase(result, "running"),
+                    result.log_url,
+                    result.output_uri,
+                    result.output_uri_web,
+                    result.logs_bucket
+                ]
+                for result in results_sorted
+            ],
+            headers=[
+                "build_tag",
+                "status",
+                "attempts",
+                "duration",
+                "queued",
+                "running",
+                "log_url",
+                "output_uri",
+                "output_uri_web",
+                "logs_bucket"
+            ],
+        )
+    )
+
+    if (
+        len(results_sorted) == 1
+        and not results_sorted[0].is_cached
+        and results_sorted[0].build_id
+    ):
+      print("="*100)
+      print("The notebook execution build log:\n")
+      print("="*100)
+
+      # Remove extra steps from the log, streaming it in chunks
+      log_reader.LogReader(_get_log_uri(results_sorted[0])).stream_from(
+          NOTEBOOK_EXECUTION_STEP_MARKER
+      )
+      print()
+
+    print("\n=== END RESULTS===\n")
+
+    flaky_results = [result for result in results_sorted if result.is_flaky]
+    if flaky_results:
+        print(
+            f"Flaky notebooks, which passed on retry: {[result.name for result in flaky_results]}"
+        )
+
+    total_notebook_duration = functools.reduce(
+        operator.add,
+        [datetime.timedelta(seconds=0)]
+        + [result.duration for result in results_sorted],
+    )
+
+    print(
+        f"Cumulative notebook duration: {format_timedelta(total_notebook_duration)}"
+    )
+
+    # Long queues relative to running time point to a lack of build capacity
+    totals = phase_timings.total_seconds(
+        {result.name: result.phases for result in results_sorted}
+    )
+    if "queued" in totals or "running" in totals:
+        print(
+            f"Cumulative queued: {format_timedelta(datetime.timedelta(seconds=totals.get('queued', 0)))}, "
+            f"cumulative running: {format_timedelta(datetime.timedelta(seconds=totals.get('running', 0)))}"
+        )
+
+    # Raise error if any notebooks failed
+    if not all([result.is_pass for result in results_sorted]):
+        raise RuntimeError("Notebook failures detected. See logs for details")
+
+
 def process_and_execute_notebooks(
     notebooks: List[str],
     container_uri: str,
@@ -343,6 +918,19 @@ def process_and_execute_notebooks(
     variable_service_account: str,
     variable_vpc_network: Optional[str] = None,
     private_pool_id: Optional[str] = None,
+    execution_history_file: Optional[str] = None,
+    history_snapshot: Optional[execution_history.ExecutionHistory] = None,
+    result_cache_file: Optional[str] = None,
+    result_cache_ttl_in_days: float = result_cache.DEFAULT_TTL.days,
+    should_save_result_cache: bool = True,
+    should_force_execution: bool = False,
+    results_file: Optional[str] = None,
+    timings_json_file: Optional[str] = None,
+    timings_prometheus_file: Optional[str] = None,
+    wheelhouse_dir: Optional[str] = None,
+    wheelhouse_local_index: Optional[str] = None,
+    max_retries: int = 0,
+    previous_results: Optional[List[NotebookExecutionResult]] = None,
 ):
     """
     Run the notebooks that exist under the folders defined in the test_paths_file.
@@ -371,6 +959,46 @@ def process_and_execute_notebooks(
             Required. Should run notebooks in parallel using a thread pool as opposed to in sequence.
         timeout (str):
             Required. Timeout string according to https://cloud.google.com/build/docs/build-config-file-schema#timeout.
+        execution_history_file (str):
+            Optional. A local path or GCS URI to a JSONL history of notebook durations. If provided,
+            notebooks are submitted longest-predicted-first, each notebook gets a timeout derived
+            from its passing runs, and the durations of this run are appended to the history.
+        history_snapshot (execution_history.ExecutionHistory):
+            Optional. A history loaded by the caller, used like execution_history_file but only
+            read, e.g. by shards whose durations are recorded when their results are merged.
+        result_cache_file (str):
+            Optional. A local path or GCS URI to a cache of passing executions. Notebooks whose
+            pre-processed content, container, Python version and requirements match a cached
+            pass are reported as cached instead of being executed.
+        result_cache_ttl_in_days (float):
+            Optional. The number of days a cached pass stays valid.
+        should_save_result_cache (bool):
+            Optional. Record the passes of this run in the result_cache_file. Shards only read
+            the cache, and their passes are recorded when their results are merged.
+        should_force_execution (bool):
+            Optional. Execute every notebook even if it has a cached pass.
+        results_file (str):
+            Optional. A local path or GCS URI to write the results to as JSON, so that the
+            results of several shards can be merged.
+        timings_json_file (str):
+            Optional. A local path or GCS URI to write the time each notebook spent in each
+            phase to, such as queued and running, as JSON.
+        timings_prometheus_file (str):
+            Optional. A local path or GCS URI to write the phase timings to in the
+            Prometheus text format.
+        wheelhouse_dir (str):
+            Optional. A local folder to build wheelhouses in. If provided, the requirements of
+            .cloud-build/requirements.txt and of the pip install lines of all notebooks are built
+            into one wheelhouse, keyed by a hash of the requirements, that builds install from.
+        wheelhouse_local_index (str):
+            Optional. A local folder of wheels to build the wheelhouse from instead of an index.
+        max_retries (int):
+            Optional. The number of times to run failed notebooks again. Notebooks that pass
+            on a retry are reported as flaky.
+        previous_results (List[NotebookExecutionResult]):
+            Optional. The results of an earlier run, e.g. when re-running its failed notebooks.
+            They are reported as the first attempts of the notebooks that are run again, and
+            as is for the other notebooks.
     """
 
     # Calculate deadline
@@ -381,34 +1009,134 @@ def process_and_execute_notebooks(
     if len(notebooks) >= 1:
         notebook_execution_results: List[NotebookExecutionResult] = []
 
+        requested_notebooks = set(notebooks)
+        previous_results_by_notebook = {
+            result.notebook_path: result for result in previous_results or []
+        }
+
         print(f"Found {len(notebooks)} modified notebooks: {notebooks}")
 
-        if should_parallelize and len(notebooks) > 1:
+        # Submit the longest notebooks first and cut hopeless runs early
+        history = history_snapshot
+        if execution_history_file:
+            history = execution_history.ExecutionHistory.load(execution_history_file)
+        if history:
+            notebooks = history.order_longest_first(notebooks)
+
+        timeouts_in_seconds = {
+            notebook: history.timeout_in_seconds(notebook) if history else None
+            for notebook in notebooks
+        }
+
+        # Pre-processed notebooks are staged in memory, so the checkout stays
+        # pristine and the shared archive can be built while notebooks are
+        # pre-processed. Submission starts once every notebook is staged.
+        staging_area = staging.StagingArea()
+
+        # Resolve the dependencies of all notebooks once, instead of in every build
+        notebook_wheelhouse = None
+        if wheelhouse_dir:
+            time_start = datetime.datetime.now()
+            notebook_wheelhouse = wheelhouse.prepare_wheelhouse(
+                requirement_sets=[
+                    wheelhouse.notebook_requirements(notebook) for notebook in notebooks
+                ]
+                + [wheelhouse.file_requirements(result_cache.REQUIREMENTS_FILEPATH)],
+                cache_dir=wheelhouse_dir,
+                staging_bucket=staging_bucket,
+                storage_backend=storage.get_default_storage(),
+                local_index=wheelhouse_local_index,
+            )
             print(
-                "Running notebooks in parallel, so no logs will be displayed. Please wait..."
+                f"Prepared the wheelhouse in {format_timedelta(datetime.datetime.now() - time_start)}."
             )
-            with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-                print(f"Max workers: {executor._max_workers}")
-
-                notebook_execution_results = list(
-                    executor.map(
-                        functools.partial(
-                            process_and_execute_notebook,
-                            container_uri,
-                            staging_bucket,
-                            artifacts_bucket,
-                            variable_project_id,
-                            variable_region,
-                            variable_service_account,
-                            variable_vpc_network,
-                            private_pool_id,
-                            deadline,
-                        ),
-                        notebooks,
+
+        code_archive_builder = code_archive.CodeArchiveBuilder(
+            staging_bucket=staging_bucket,
+            storage_backend=storage.get_default_storage(),
+        )
+        preprocessing_failures = _stage_notebooks(
+            staging_area=staging_area,
+            notebooks=notebooks,
+            artifacts_bucket=artifacts_bucket,
+            variable_project_id=variable_project_id,
+            variable_region=variable_region,
+            variable_service_account=variable_service_account,
+            variable_vpc_network=variable_vpc_network or None,
+            on_submitted=threading.Thread(
+                target=code_archive_builder.base_archive_uri
+            ).start,
+            notebook_wheelhouse=notebook_wheelhouse,
+        )
+        notebooks = [notebook for notebook in notebooks if notebook in staging_area]
+
+        # Skip notebooks whose inputs are unchanged since their last pass
+        cache = None
+        cache_keys: Dict[str, str] = {}
+        cached_results: List[NotebookExecutionResult] = []
+        cached_notebooks = set()
+        if result_cache_file:
+            cache = result_cache.ResultCache.load(
+                result_cache_file,
+                ttl=datetime.timedelta(days=result_cache_ttl_in_days),
+            )
+            requirements = result_cache.read_requirements()
+            # A notebook also runs again when a file it depends on changed
+            dependency_index = notebook_dependencies.DependencyIndex(
+                tracked_files=code_archive.list_tracked_files()
+            )
+
+            for notebook in notebooks:
+                cache_keys[notebook] = result_cache.cache_key(
+                    notebook_content=staging_area.read(notebook),
+                    container_uri=container_uri,
+                    python_version=staging_area.attributes(notebook)["python_version"],
+                    requirements=requirements,
+                    dependency_object_ids=dependency_index.dependency_object_ids(
+                        notebook
+                    ),
+                )
+
+                cached_pass = cache.get_pass(cache_keys[notebook])
+                if cached_pass and not should_force_execution:
+                    result = _create_result(
+                        notebook=notebook, artifacts_bucket=artifacts_bucket
                     )
+                    result.is_pass = True
+                    result.is_cached = True
+                    result.build_id = cached_pass["build_id"]
+                    result.log_url = cached_pass["log_url"]
+                    result.output_uri = cached_pass["output_uri"]
+                    cached_results.append(result)
+                    cached_notebooks.add(notebook)
+                    print(f"{notebook} CACHED from build {result.build_id}.")
+
+            notebooks = [
+                notebook for notebook in notebooks if notebook not in cached_notebooks
+            ]
+
+        def execute(notebooks: List[str]) -> List[NotebookExecutionResult]:
+            if should_parallelize and len(notebooks) > 1:
+                print(
+                    "Running notebooks in parallel, so no logs will be displayed. Please wait..."
                 )
-        else:
-            notebook_execution_results = [
+                return _schedule_and_execute_notebooks(
+                    notebooks=notebooks,
+                    container_uri=container_uri,
+                    staging_bucket=staging_bucket,
+                    artifacts_bucket=artifacts_bucket,
+                    variable_project_id=variable_project_id,
+                    variable_region=variable_region,
+                    variable_service_account=variable_service_account,
+                    variable_vpc_network=variable_vpc_network,
+                    private_pool_id=private_pool_id,
+                    deadline=deadline,
+                    code_archive_builder=code_archive_builder,
+                    staging_area=staging_area,
+                    timeouts_in_seconds=timeouts_in_seconds,
+                )
+
+            return [
                 process_and_execute_notebook(
                     container_uri=container_uri,
                     staging_bucket=staging_bucket,
@@ -420,83 +1148,75 @@ def process_and_execute_notebooks(
                     private_pool_id=private_pool_id,
                     deadline=deadline,
                     notebook=notebook,
+                    code_archive_builder=code_archive_builder,
+                    staging_area=staging_area,
+                    timeout_in_seconds=timeouts_in_seconds[notebook],
                 )
                 for notebook in notebooks
             ]
 
-        print("\n=== RESULTS ===\n")
+        notebook_execution_results = execute(notebooks)
 
-        results_sorted = sorted(
-            notebook_execution_results,
-            key=lambda result: result.is_pass,
-            reverse=True,
-        )
+        for notebook, result in zip(notebooks, notebook_execution_results):
+            if notebook in previous_results_by_notebook:
+                previous_results_by_notebook[notebook].retried_by(result)
 
-        # Print results
-        print(
-            tabulate(
-                [
-                    [
-                        result.name,
-                        "PASSED" if result.is_pass else "FAILED",
-                        format_timedelta(result.duration),
-                        result.log_url,
-                        result.output_uri,
-                        result.output_uri_web,
-                        result.logs_bucket
-                    ]
-                    for result in results_sorted
-                ],
-                headers=[
-                    "build_tag",
-                    "status",
-                    "duration",
-                    "log_url",
-                    "output_uri",
-                    "output_uri_web",
-                    "logs_bucket"
-                ],
+        # Run failures again, which tells flaky notebooks from broken ones
+        for retry in range(max_retries):
+            failed_indices = [
+                index
+                for index, result in enumerate(notebook_execution_results)
+                if not result.is_pass
+            ]
+            if not failed_indices:
+                break
+
+            print(
+                f"Retrying {len(failed_indices)} failed notebooks ({retry + 1} of {max_retries})."
             )
-        )
+            retry_results = execute([notebooks[index] for index in failed_indices])
+            for index, retry_result in zip(failed_indices, retry_results):
+                notebook_execution_results[index].retried_by(retry_result)
+                notebook_execution_results[index] = retry_result
 
-        if len(notebooks) == 1:
-          print("="*100)
-          print("The notebook execution build log:\n")
-          print("="*100)
+        if history and execution_history_file:
+            record_history(history, notebook_execution_results)
+            history.save()
 
-          build_id = results_sorted[0].build_id
-          logs_bucket_name = (results_sorted[0].logs_bucket).removeprefix("gs://")
-          log_file_name = f"log-{build_id}.txt"
+        for notebook, result in zip(notebooks, notebook_execution_results):
+            result.cache_key = cache_keys.get(notebook)
 
-          log_contents = util.download_blob_into_memory(
-            bucket_name=logs_bucket_name,
-            blob_name=log_file_name,
-            download_as_text=True
-            )
+        if cache and should_save_result_cache:
+            record_result_cache(cache, notebook_execution_results)
+            cache.save()
 
-          # Remove extra steps from the log
-          match = re.search("starting Step #4", log_contents, flags=re.IGNORECASE)
+        notebook_execution_results += cached_results + preprocessing_failures
 
-          if match is not None:
-            match_index = match.span()[0]
-            print(log_contents[match_index:])
-          else:
-            print(log_contents)
+        # Keep the earlier results of the notebooks that were not run again
+        notebook_execution_results += [
+            result
+            for result in previous_results or []
+            if result.notebook_path not in requested_notebooks
+        ]
 
-        print("\n=== END RESULTS===\n")
+        if results_file:
+            save_results(notebook_execution_results, results_file)
 
-        total_notebook_duration = functools.reduce(
-            operator.add,
-            [datetime.timedelta(seconds=0)]
-            + [result.duration for result in results_sorted],
+        export_timings(
+            notebook_execution_results,
+            timings_json_file=timings_json_file,
+            timings_prometheus_file=timings_prometheus_file,
         )
 
+        # Printed first, since report_results raises if any notebook failed
+        rate_limit_stats = rate_limit.stats()
         print(
-            f"Cumulative notebook duration: {format_timedelta(total_notebook_duration)}"
+            f"Build creations: {rate_limit_stats.succeeded} at {rate_limit_stats.throughput_per_minute:.1f} per minute, {rate_limit_stats.throttled} throttled, {rate_limit_stats.waited_seconds:.0f}s waited, final rate {rate_limit_stats.rate_per_minute:.1f} per minute"
         )
 
-        # Raise error if any notebooks failed
-        if not all([result.is_pass for result in results_sorted]):
-            raise RuntimeError("Notebook failures detected. See logs for details")
+        report_results(notebook_execution_results)
     else:
+        if results_file:
+            save_results(previous_results or [], results_file)
+
         print("No notebooks modified in this pull request.")
@@ -15,14 +15,20 @@
 
 """Methods to run a notebook locally"""
 
+import concurrent.futures
+import dataclasses
 import errno
+import json
 import os
 import shutil
 import sys
+import tempfile
+import time
+from typing import List, Optional
 
 import papermill as pm
 from google.cloud.aiplatform import utils
-from utils import util
+from utils import kernel_pool, notebook_checkpoint, util
 
 # This script is used to execute a notebook and write out the output notebook.
 
@@ -34,8 +40,17 @@ def execute_notebook(
     notebook_source: str,
     output_file_or_uri: str,
     should_log_output: bool,
+    kernel_manager=None,
+    max_output_bytes: Optional[int] = notebook_checkpoint.DEFAULT_MAX_OUTPUT_BYTES,
 ):
-    """Execute a single notebook using Papermill"""
+    """
+    Execute a single notebook using Papermill, in the given already started
+    kernel if there is one.
+
+    While logging output, the executed notebook is checkpointed on a time and
+    cell budget. Outputs larger than max_output_bytes are saved to side files
+    next to the executed notebook.
+    """
     file_name = os.path.basename(os.path.normpath(notebook_source))
 
     # Download notebook if it's a GCS URI
@@ -72,18 +87,35 @@ def execute_notebook(
             output_path=notebook_source,
             progress_bar=should_log_output,
             request_save_on_cell_execute=should_log_output,
+            engine_name=notebook_checkpoint.ENGINE_NAME,
+            max_output_bytes=max_output_bytes,
             kernel_name=DEFAULT_KERNEL_NAME,
             log_output=should_log_output,
             stdout_file=sys.stdout if should_log_output else None,
             stderr_file=sys.stderr if should_log_output else None,
+            km=kernel_manager,
         )
     except Exception as exception:
         execution_exception = exception
     finally:
+        side_file_folder = notebook_checkpoint.side_file_folder(output_file_or_uri)
+        side_files = []
+        if max_output_bytes is not None and os.path.exists(notebook_source):
+            side_files = notebook_checkpoint.externalize_large_outputs(
+                notebook_source,
+                max_output_bytes=max_output_bytes,
+                side_file_folder_name=os.path.basename(side_file_folder),
+            )
+
         # Copy executed notebook
         if output_file_or_uri.startswith("gs://"):
             # Upload to GCS path
             util.upload_file(notebook_source, remote_file_path=output_file_or_uri)
+            for side_file in side_files:
+                util.upload_file(
+                    side_file,
+                    remote_file_path=f"{side_file_folder}/{os.path.basename(side_file)}",
+                )
 
             print("\n=== EXECUTION FINISHED ===\n")
         else:
@@ -97,6 +129,104 @@ def execute_notebook(
 
             print(f"Writing output to: {output_file_or_uri}")
             shutil.move(notebook_source, output_file_or_uri)
+            for side_file in side_files:
+                os.makedirs(side_file_folder, exist_ok=True)
+                shutil.move(
+                    side_file,
+                    os.path.join(side_file_folder, os.path.basename(side_file)),
+                )
 
         if execution_exception:
             raise execution_exception
+
+
+@dataclasses.dataclass
+class LocalExecutionResult:
+    notebook: str
+    output_file: str
+    duration_in_seconds: float
+    saved_seconds: float
+    error_message: Optional[str] = None
+
+    @property
+    def is_pass(self) -> bool:
+        return self.error_message is None
+
+
+def _read_code(notebook_source: str) -> str:
+    with open(notebook_source, encoding="utf-8") as f:
+        cells = json.load(f).get("cells", [])
+
+    return "\n".join(
+        "".join(cell["source"]) if isinstance(cell["source"], list) else cell["source"]
+        for cell in cells
+        if cell.get("cell_type") == "code"
+    )
+
+
+def _output_files(notebook_sources: List[str], output_folder: str) -> List[str]:
+    """
+    Places each executed notebook under output_folder at its path relative to
+    the deepest folder holding all the source notebooks
+    """
+    source_dirs = [os.path.dirname(os.path.abspath(source)) for source in notebook_sources]
+    common_root = os.path.commonpath(source_dirs)
+
+    return [
+        os.path.join(output_folder, os.path.relpath(os.path.abspath(source), common_root))
+        for source in notebook_sources
+    ]
+
+
+def execute_notebooks_in_kernel_pool(
+    notebook_sources: List[str],
+    output_folder: str,
+    warm_up_imports: Optional[List[str]] = None,
+    num_kernels: Optional[int] = None,
+) -> List[LocalExecutionResult]:
+    """
+    Execute local notebooks concurrently on a pool of warm kernels, one
+    notebook per kernel at a time.
+
+    Each executed notebook is written under the output_folder at its path
+    relative to the common folder of the sources. The source notebooks are
+    left untouched.
+    """
+    num_kernels = min(num_kernels or os.cpu_count() or 1, len(notebook_sources))
+    output_files = dict(zip(notebook_sources, _output_files(notebook_sources, output_folder)))
+
+    with kernel_pool.KernelPool(
+        size=num_kernels, warm_up_imports=warm_up_imports
+    ) as pool:
+
+        def execute(notebook_source: str) -> LocalExecutionResult:
+            output_file = output_files[notebook_source]
+            error_message = None
+
+            with pool.kernel() as kernel, tempfile.TemporaryDirectory() as temp_dir:
+                # Execute a copy, since the executed notebook is moved to the output
+                notebook_copy = shutil.copy(notebook_source, temp_dir)
+
+                time_start = time.perf_counter()
+                try:
+                    execute_notebook(
+                        notebook_source=notebook_copy,
+                        output_file_or_uri=output_file,
+                        should_log_output=False,
+                        kernel_manager=kernel.kernel_manager,
+                    )
+                except Exception as exception:
+                    error_message = str(exception)
+
+                return LocalExecutionResult(
+                    notebook=notebook_source,
+                    output_file=output_file,
+                    duration_in_seconds=time.perf_counter() - time_start,
+                    saved_seconds=kernel.saved_seconds(
+                        kernel_pool.imported_modules(_read_code(notebook_source))
+                    ),
+                    error_message=error_message,
+                )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_kernels) as executor:
+            return list(executor.map(execute, notebook_sources))
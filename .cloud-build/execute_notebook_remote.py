@@ -15,8 +15,8 @@
 
 """Methods to run a notebook on Google Cloud Build"""
 
-from re import sub
-from typing import Optional
+import threading
+from typing import Callable, Dict, Optional
 
 import google.auth
 import yaml
@@ -31,75 +31,178 @@ CLOUD_BUILD_FILEPATH = ".cloud-build/notebook-execution-test-cloudbuild-single.y
 SERVICE_BASE_PATH = "cloudbuild.googleapis.com"
 
 
-def execute_notebook_remote(
-    code_archive_uri: str,
-    notebook_uri: str,
-    notebook_output_uri: str,
-    container_uri: str,
-    private_pool_id: Optional[str],
-    private_pool_region: Optional[str],
-    tag: Optional[str],
-    timeout_in_seconds: Optional[int] = None,
-    python_version: Optional[str] = None
-) -> operation.Operation:
-    """Create and execute a single notebook on Google Cloud Build"""
-    # Load build steps from YAML
+def _create_client(credentials, region: Optional[str]):
+    options: Optional[client_options.ClientOptions] = None
+    if region:
+        # Switch to the regional endpoint of the pool
+        options = client_options.ClientOptions(
+            api_endpoint=f"{region}-{SERVICE_BASE_PATH}"
+        )
 
-    cloudbuild_config = yaml.load(open(CLOUD_BUILD_FILEPATH), Loader=FullLoader)
+    return cloudbuild_v1.services.cloud_build.CloudBuildClient(
+        credentials=credentials, client_options=options
+    )
 
-    substitutions = {
-        "_PYTHON_IMAGE": container_uri,
-        "_NOTEBOOK_GCS_URI": notebook_uri,
-        "_NOTEBOOK_OUTPUT_GCS_URI": notebook_output_uri,
-        "_PYTHON_VERSION" : f"python{python_version}"
-    }
 
-    if python_version is not None:
-      substitutions["_PYTHON_VERSION"] = "python" + python_version
+class BuildSession:
+    """
+    Submits notebook builds, reusing everything that does not depend on the
+    notebook. The build template is parsed once into a Build prototype, and
+    there is one client per endpoint (global or the private pool's region).
+    The clients share one set of credentials, which refresh themselves when
+    they expire.
+
+    Sessions are thread-safe, so builds may be submitted concurrently.
+    """
+
+    def __init__(
+        self,
+        cloud_build_filepath: str = CLOUD_BUILD_FILEPATH,
+        credentials=None,
+        project_id: Optional[str] = None,
+        client_factory: Callable = _create_client,
+    ):
+        self._cloud_build_filepath = cloud_build_filepath
+        self._credentials = credentials
+        self._project_id = project_id
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self._prototype: Optional[cloudbuild_v1.Build] = None
+        self._options: Optional[Dict] = None
+        self._clients: Dict[Optional[str], object] = {}
+
+    def _load(self) -> cloudbuild_v1.Build:
+        with self._lock:
+            if self._prototype is None:
+                with open(self._cloud_build_filepath) as f:
+                    cloudbuild_config = yaml.load(f, Loader=FullLoader)
+
+                self._prototype = cloudbuild_v1.Build(steps=cloudbuild_config["steps"])
+                self._options = cloudbuild_config.get("options")
+
+            if self._credentials is None:
+                # Authorize the clients with Google defaults
+                self._credentials, project_id = google.auth.default()
+                self._project_id = self._project_id or project_id
+
+            return self._prototype
+
+    @property
+    def project_id(self) -> str:
+        """The project builds are created in"""
+        self._load()
+        return self._project_id
+
+    def client(self, region: Optional[str] = None):
+        """Returns the client for the regional endpoint, or the global one"""
+        self._load()
+
+        with self._lock:
+            if region not in self._clients:
+                self._clients[region] = self._client_factory(self._credentials, region)
+
+            return self._clients[region]
+
+    def create_build(
+        self,
+        code_archive_uri: str,
+        notebook_uri: str,
+        notebook_output_uri: str,
+        container_uri: str,
+        private_pool_id: Optional[str],
+        private_pool_region: Optional[str],
+        tag: Optional[str],
+        timeout_in_seconds: Optional[int] = None,
+        python_version: Optional[str] = None,
+        overlay_archive_uri: Optional[str] = None,
+        wheelhouse_archive_uri: Optional[str] = None,
+    ) -> operation.Operation:
+        """Create and execute a single notebook on Google Cloud Build"""
+        # Stamp the notebook onto a copy of the parsed build steps
+        build = cloudbuild_v1.Build()
+        cloudbuild_v1.Build.copy_from(build, self._load())
+
+        substitutions = {
+            "_PYTHON_IMAGE": container_uri,
+            "_NOTEBOOK_GCS_URI": notebook_uri,
+            "_NOTEBOOK_OUTPUT_GCS_URI": notebook_output_uri,
+            "_NOTEBOOK_OVERLAY_GCS_URI": overlay_archive_uri or "",
+            "_WHEELHOUSE_GCS_URI": wheelhouse_archive_uri or "",
+            "_PYTHON_VERSION" : f"python{python_version}"
+        }
+
+        if python_version is not None:
+          substitutions["_PYTHON_VERSION"] = "python" + python_version
+
+        region: Optional[str] = None
+        if private_pool_id and private_pool_region:
+            # substitutions["_PRIVATE_POOL_NAME"] = private_pool_id
+            build.options = self._options
+            build.options.pool = {"name": private_pool_id}
+            region = private_pool_region
+
+        (
+            source_archived_file_gcs_bucket,
+            source_archived_file_gcs_object,
+        ) = utils.extract_bucket_and_prefix_from_gcs_path(code_archive_uri)
+
+        build.source = Source(
+            storage_source=StorageSource(
+                bucket=source_archived_file_gcs_bucket,
+                object_=source_archived_file_gcs_object,
+            )
+        )
 
-    build = cloudbuild_v1.Build()
+        build.substitutions = substitutions
+        build.timeout = duration_pb2.Duration(seconds=timeout_in_seconds)
+        build.queue_ttl = duration_pb2.Duration(seconds=timeout_in_seconds)
 
-    options: Optional[client_options.ClientOptions] = None
-    if private_pool_id and private_pool_region:
-        # substitutions["_PRIVATE_POOL_NAME"] = private_pool_id
-        build.options = cloudbuild_config.get("options")
-        build.options.pool = {"name": private_pool_id}
+        if tag:
+            build.tags = [tag]
 
-        # Switch to the regional endpoint of the pool
-        options = client_options.ClientOptions(
-            api_endpoint=f"{private_pool_region}-{SERVICE_BASE_PATH}"
+        return self.client(region).create_build(
+            project_id=self._project_id, build=build
         )
 
-    # Authorize the client with Google defaults
-    credentials, project_id = google.auth.default()
-
-    client = cloudbuild_v1.services.cloud_build.CloudBuildClient(client_options=options)
 
-    (
-        source_archived_file_gcs_bucket,
-        source_archived_file_gcs_object,
-    ) = utils.extract_bucket_and_prefix_from_gcs_path(code_archive_uri)
+_default_session: Optional[BuildSession] = None
+_default_session_lock = threading.Lock()
 
-    build.source = Source(
-        storage_source=StorageSource(
-            bucket=source_archived_file_gcs_bucket,
-            object_=source_archived_file_gcs_object,
-        )
-    )
 
-    build.steps = cloudbuild_config["steps"]
-    build.substitutions = substitutions
-    build.timeout = duration_pb2.Duration(seconds=timeout_in_seconds)
-    build.queue_ttl = duration_pb2.Duration(seconds=timeout_in_seconds)
+def get_default_session() -> BuildSession:
+    """Returns the process-wide build session"""
+    global _default_session
 
-    if tag:
-        build.tags = [tag]
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = BuildSession()
+        return _default_session
 
-    operation = client.create_build(project_id=project_id, build=build)
-    # Print the in-progress operation
-    # print("IN PROGRESS:")
-    # print(operation.metadata)
 
-    # Print the completed status
-    # print("RESULT:", result.status)
-    return operation
+def execute_notebook_remote(
+    code_archive_uri: str,
+    notebook_uri: str,
+    notebook_output_uri: str,
+    container_uri: str,
+    private_pool_id: Optional[str],
+    private_pool_region: Optional[str],
+    tag: Optional[str],
+    timeout_in_seconds: Optional[int] = None,
+    python_version: Optional[str] = None,
+    overlay_archive_uri: Optional[str] = None,
+    wheelhouse_archive_uri: Optional[str] = None,
+) -> operation.Operation:
+    """Create and execute a single notebook on Google Cloud Build"""
+    return get_default_session().create_build(
+        code_archive_uri=code_archive_uri,
+        notebook_uri=notebook_uri,
+        notebook_output_uri=notebook_output_uri,
+        container_uri=container_uri,
+        private_pool_id=private_pool_id,
+        private_pool_region=private_pool_region,
+        tag=tag,
+        timeout_in_seconds=timeout_in_seconds,
+        python_version=python_version,
+        overlay_archive_uri=overlay_archive_uri,
+        wheelhouse_archive_uri=wheelhouse_archive_uri,
+    )
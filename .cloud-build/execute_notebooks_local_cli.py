@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A CLI to run many notebooks locally on a pool of warm kernels"""
+
+import argparse
+import sys
+
+from tabulate import tabulate
+
+import execute_notebook_helper
+from utils import kernel_pool
+
+parser = argparse.ArgumentParser(
+    description="Run notebooks locally on a pool of warm kernels."
+)
+parser.add_argument(
+    "--notebook_sources",
+    type=str,
+    nargs="+",
+    help="Local filepaths to notebooks.",
+    required=True,
+)
+parser.add_argument(
+    "--output_folder",
+    type=str,
+    help="Local folder to save executed notebooks to.",
+    required=True,
+)
+parser.add_argument(
+    "--warm_up_imports",
+    type=lambda value: [module for module in value.split(",") if module],
+    help="Comma-separated modules that each kernel imports before running notebooks.",
+    default=kernel_pool.DEFAULT_WARM_UP_IMPORTS,
+    required=False,
+)
+parser.add_argument(
+    "--num_kernels",
+    type=int,
+    help="The number of kernels, and so of notebooks running at once. Defaults to the number of cores.",
+    default=None,
+    required=False,
+)
+
+args = parser.parse_args()
+results = execute_notebook_helper.execute_notebooks_in_kernel_pool(
+    notebook_sources=args.notebook_sources,
+    output_folder=args.output_folder,
+    warm_up_imports=args.warm_up_imports,
+    num_kernels=args.num_kernels,
+)
+
+print(
+    tabulate(
+        [
+            [
+                result.notebook,
+                "PASSED" if result.is_pass else "FAILED",
+                f"{result.duration_in_seconds:.1f}",
+                f"{result.saved_seconds:.1f}",
+                result.output_file,
+            ]
+            for result in results
+        ],
+        headers=["notebook", "status", "duration_seconds", "saved_seconds", "output_file"],
+    )
+)
+print(
+    f"Warm kernels saved an estimated {sum(result.saved_seconds for result in results):.1f} seconds versus cold kernels."
+)
+
+for result in results:
+    if not result.is_pass:
+        print(f"{result.notebook} FAILED: {result.error_message}")
+
+if not all(result.is_pass for result in results):
+    sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A CLI to merge the results of sharded notebook runs into one report.
+
+Each shard of execute_changed_notebooks_cli.py writes its results with
+--results_file. The merged table is printed, and the exit status is non-zero
+if any notebook failed or any shard wrote no results. Shards only read the
+execution history and the result cache, so that concurrent shards do not
+overwrite each other, and the merged results are recorded in them here.
+"""
+
+import argparse
+import datetime
+import sys
+
+import execute_changed_notebooks_helper
+from utils import execution_history, result_cache
+
+parser = argparse.ArgumentParser(description="Merge sharded notebook results.")
+parser.add_argument(
+    "--results_files",
+    type=str,
+    nargs="+",
+    help="The local paths or GCS URIs the shards wrote their results to.",
+    required=True,
+)
+parser.add_argument(
+    "--timings_json_file",
+    type=str,
+    help="A local path or GCS URI to write the merged phase timings to, as JSON.",
+    required=False,
+)
+parser.add_argument(
+    "--timings_prometheus_file",
+    type=str,
+    help="A local path or GCS URI to write the merged phase timings to in the Prometheus text format.",
+    required=False,
+)
+parser.add_argument(
+    "--execution_history_file",
+    type=str,
+    help="A local path or GCS URI to the JSONL history of notebook durations to record the merged results in.",
+    required=False,
+)
+parser.add_argument(
+    "--result_cache_file",
+    type=str,
+    help="A local path or GCS URI to the cache of passing executions to record the merged passes in.",
+    required=False,
+)
+parser.add_argument(
+    "--result_cache_ttl_in_days",
+    type=float,
+    help="The number of days a cached pass stays valid.",
+    default=7,
+    required=False,
+)
+
+args = parser.parse_args()
+
+results = []
+missing_results_files = []
+for results_file in args.results_files:
+    shard_results = execute_changed_notebooks_helper.load_results(results_file)
+    if shard_results is None:
+        missing_results_files.append(results_file)
+    else:
+        results += shard_results
+
+if missing_results_files:
+    print(f"No results were written to: {missing_results_files}")
+
+execute_changed_notebooks_helper.export_timings(
+    results,
+    timings_json_file=args.timings_json_file,
+    timings_prometheus_file=args.timings_prometheus_file,
+)
+
+if args.execution_history_file:
+    history = execution_history.ExecutionHistory.load(args.execution_history_file)
+    execute_changed_notebooks_helper.record_history(history, results)
+    history.save()
+
+if args.result_cache_file:
+    cache = result_cache.ResultCache.load(
+        args.result_cache_file,
+        ttl=datetime.timedelta(days=args.result_cache_ttl_in_days),
+    )
+    execute_changed_notebooks_helper.record_result_cache(cache, results)
+    cache.save()
+
+if results:
+    execute_changed_notebooks_helper.report_results(results)
+else:
+    print("No notebooks were run by any shard.")
+
+if missing_results_files:
+    sys.exit(1)
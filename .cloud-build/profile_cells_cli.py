@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A CLI to rank the slowest cells of executed notebooks.
+
+Point it at the executed notebooks written by execute_notebook_helper, or at
+artifact folders copied locally (e.g. with gsutil -m cp -r), to see where
+execution time goes across the whole corpus.
+"""
+
+import argparse
+import dataclasses
+import json
+
+from tabulate import tabulate
+
+from utils import cell_profiler
+
+parser = argparse.ArgumentParser(
+    description="Rank the slowest cells of executed notebooks."
+)
+parser.add_argument(
+    "--paths",
+    type=str,
+    nargs="+",
+    help="Executed notebooks, or folders to search for them recursively.",
+    required=True,
+)
+parser.add_argument(
+    "--top_n",
+    type=int,
+    help="The number of slowest cells and notebooks to report.",
+    default=50,
+    required=False,
+)
+parser.add_argument(
+    "--output_json_file",
+    type=str,
+    help="A local path to also write the slowest cells to, as JSON.",
+    required=False,
+)
+
+args = parser.parse_args()
+
+profile = cell_profiler.profile_notebooks(args.paths, top_n=args.top_n)
+slowest_cells = profile.slowest_cells()
+
+
+def share(seconds: float) -> str:
+    return f"{seconds / profile.total_seconds:.1%}" if profile.total_seconds else ""
+
+
+print(
+    tabulate(
+        [
+            [
+                timing.notebook,
+                timing.cell_index,
+                f"{timing.duration_in_seconds:.1f}",
+                share(timing.duration_in_seconds),
+                timing.status,
+                timing.source_snippet,
+            ]
+            for timing in slowest_cells
+        ],
+        headers=["notebook", "cell", "seconds", "share", "status", "source"],
+    )
+)
+print()
+print(
+    tabulate(
+        [
+            [notebook, f"{seconds:.1f}", share(seconds)]
+            for notebook, seconds in profile.slowest_notebooks(args.top_n)
+        ],
+        headers=["notebook", "seconds", "share"],
+    )
+)
+print()
+print(
+    f"Profiled {profile.num_cells} cells of {len(profile.notebook_seconds)} executed notebooks, "
+    f"out of {profile.num_notebooks_scanned} scanned, "
+    f"{profile.total_seconds:.1f} seconds in total. "
+    f"The slowest {len(slowest_cells)} cells took "
+    f"{share(sum(timing.duration_in_seconds for timing in slowest_cells)) or '0%'} of it."
+)
+if profile.unreadable_notebooks:
+    print(f"Skipped {len(profile.unreadable_notebooks)} unreadable notebooks.")
+
+if args.output_json_file:
+    with open(args.output_json_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "total_seconds": profile.total_seconds,
+                "num_cells": profile.num_cells,
+                "num_notebooks": len(profile.notebook_seconds),
+                "slowest_cells": [
+                    dataclasses.asdict(timing) for timing in slowest_cells
+                ],
+            },
+            f,
+            indent=2,
+        )
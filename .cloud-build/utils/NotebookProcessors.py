@@ -13,11 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict
+import re
+from typing import Dict, Iterable, Optional
 
 from nbconvert.preprocessors import Preprocessor
 
 from . import UpdateNotebookVariables as update_notebook_variables
+from . import wheelhouse
 
 
 class RemoveNoExecuteCells(Preprocessor):
@@ -36,20 +38,26 @@ class UpdateVariablesPreprocessor(Preprocessor):
     def __init__(self, replacement_map: Dict):
         self._replacement_map = replacement_map
 
+        # Compile one pattern for all variables, shared by every cell
+        self._pattern = update_notebook_variables.compile_variables_pattern(
+            replacement_map
+        )
+
     @staticmethod
-    def update_variables(content: str, replacement_map: Dict[str, str]):
+    def update_variables(
+        content: str,
+        replacement_map: Dict[str, str],
+        pattern: Optional[re.Pattern] = None,
+    ):
         # replace variables inside .ipynb files
         # looking for this format inside notebooks:
         # VARIABLE_NAME = '[description]'
 
-        for variable_name, variable_value in replacement_map.items():
-            content = update_notebook_variables.get_updated_value(
-                content=content,
-                variable_name=variable_name,
-                variable_value=variable_value,
-            )
-
-        return content
+        return update_notebook_variables.get_updated_values(
+            content=content,
+            replacement_map=replacement_map,
+            pattern=pattern,
+        )
 
     def preprocess(self, notebook, resources=None):
         executable_cells = []
@@ -58,8 +66,30 @@ class UpdateVariablesPreprocessor(Preprocessor):
                 cell.source = self.update_variables(
                     content=cell.source,
                     replacement_map=self._replacement_map,
+                    pattern=self._pattern,
                 )
 
             executable_cells.append(cell)
         notebook.cells = executable_cells
         return notebook, resources
+
+
+class InstallFromWheelhousePreprocessor(Preprocessor):
+    def __init__(
+        self,
+        available_requirements: Iterable[str],
+        wheelhouse_path: str = wheelhouse.BUILD_WHEELHOUSE_PATH,
+    ):
+        self._available_requirements = set(available_requirements)
+        self._wheelhouse_path = wheelhouse_path
+
+    def preprocess(self, notebook, resources=None):
+        for cell in notebook.cells:
+            if cell.cell_type == "code":
+                cell.source = wheelhouse.rewrite_install_lines(
+                    cell.source,
+                    wheelhouse_path=self._wheelhouse_path,
+                    available_requirements=self._available_requirements,
+                )
+
+        return notebook, resources
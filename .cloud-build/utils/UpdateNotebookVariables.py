@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import re
+from typing import Dict, Iterable, Optional
 
 """
  This script is used to update variables in the notebook via regex
@@ -34,14 +35,80 @@ Variables in conditionals can also be replaced:
 
 
 def get_updated_value(content: str, variable_name: str, variable_value: str) -> str:
+    # The name must be a whole identifier, e.g. REGION does not match MY_REGION
     return re.sub(
-        rf"({variable_name}.*? = .*?[\",\'])\[.+?\]([\",\'].*?)",
+        rf"(\b{variable_name}\b.*? = .*?[\",\'])\[.+?\]([\",\'].*?)",
         rf"\g<1>{variable_value}\g<2>",
         content,
         flags=re.M,
     )
 
 
+# Every replacement has a quote directly followed by an opening bracket
+_CANDIDATE_PATTERN = re.compile(r"[\",\']\[")
+
+
+def compile_variables_pattern(variable_names: Iterable[str]) -> re.Pattern:
+    """
+    Compiles a single pattern matching any of the variables, in the same format
+    as get_updated_value. The variable that matched is the group variable_<index>.
+    Names only match whole identifiers, so the result does not depend on the
+    order of the alternatives when one name contains another.
+    """
+    alternation = "|".join(
+        [
+            f"(?P<variable_{index}>{variable_name})"
+            for index, variable_name in enumerate(variable_names)
+        ]
+    )
+    return re.compile(
+        rf"(?P<prefix>\b(?:{alternation})\b.*? = .*?[\",\'])\[.+?\](?P<suffix>[\",\'].*?)",
+        flags=re.M,
+    )
+
+
+def get_updated_values(
+    content: str,
+    replacement_map: Dict[str, str],
+    pattern: Optional[re.Pattern] = None,
+) -> str:
+    """
+    Replaces all variables in one pass over the content. The pattern can be
+    precompiled with compile_variables_pattern(replacement_map).
+    """
+    if len(replacement_map) == 0 or not _CANDIDATE_PATTERN.search(content):
+        return content
+
+    if pattern is None:
+        pattern = compile_variables_pattern(replacement_map)
+
+    templates = [
+        rf"\g<prefix>{variable_value}\g<suffix>"
+        for variable_value in replacement_map.values()
+    ]
+
+    def replace(match: re.Match) -> str:
+        for index, template in enumerate(templates):
+            if match.group(f"variable_{index}") is not None:
+                return match.expand(template)
+
+    # Matches never span lines, so only lines that can match are searched
+    lines = content.split("\n")
+    for index, line in enumerate(lines):
+        if _CANDIDATE_PATTERN.search(line):
+            lines[index] = pattern.sub(replace, line)
+
+    return "\n".join(lines)
+
+
+def _assert_single_pass_matches(content: str, variable_name: str, variable_value: str):
+    assert get_updated_values(
+        content=content, replacement_map={variable_name: variable_value}
+    ) == get_updated_value(
+        content=content, variable_name=variable_name, variable_value=variable_value
+    )
+
+
 def test_update_value():
     new_content = get_updated_value(
         content='asdf\nPROJECT_ID = "[your-project-id]" #@param {type:"string"} \nasdf',
@@ -102,3 +169,62 @@ def test_service_account():
         new_content
         == 'SERVICE_ACCOUNT = "12345-compute@developer.gserviceaccount.com"  # @param {type:"string"}'
     )
+
+
+def test_single_pass_matches_get_updated_value():
+    _assert_single_pass_matches(
+        'asdf\nPROJECT_ID = "[your-project-id]" #@param {type:"string"} \nasdf',
+        "PROJECT_ID",
+        "sample-project",
+    )
+    _assert_single_pass_matches(
+        "PROJECT_ID = '[your-project-id]'", "PROJECT_ID", "sample-project"
+    )
+    _assert_single_pass_matches(
+        "PROJECT_ID = shell_output[0] ", "PROJECT_ID", "sample-project"
+    )
+    _assert_single_pass_matches(
+        'REGION = "[your-region]"  # @param {type:"string"}', "REGION", "us-central1"
+    )
+    _assert_single_pass_matches(
+        'REGION == "[your-region]"  # @param {type:"string"}', "REGION", "us-central1"
+    )
+    _assert_single_pass_matches(
+        'SERVICE_ACCOUNT = "[your-service-account]"  # @param {type:"string"}',
+        "SERVICE_ACCOUNT",
+        "12345-compute@developer.gserviceaccount.com",
+    )
+
+
+def test_single_pass_replaces_all_variables():
+    new_content = get_updated_values(
+        content='PROJECT_ID = "[your-project-id]"\nREGION = "[your-region]"\nVPC_NETWORK = "[your-network]"',
+        replacement_map={
+            "PROJECT_ID": "sample-project",
+            "REGION": "us-central1",
+            "VPC_NETWORK": None,
+        },
+    )
+    assert (
+        new_content
+        == 'PROJECT_ID = "sample-project"\nREGION = "us-central1"\nVPC_NETWORK = "None"'
+    )
+
+
+def test_overlapping_variable_names():
+    replacement_map = {"PROJECT_ID": "sample-project", "REGION": "us-central1"}
+    for content in [
+        'MY_REGION_PROJECT_ID = "[x]"',
+        'REGION_PROJECT_ID = "[x]"',
+        'PROJECT_ID_REGION = "[x]"',
+    ]:
+        # Neither name is the whole identifier, so nothing is replaced
+        assert get_updated_values(content, replacement_map) == content
+        assert get_updated_values(content, dict(reversed(replacement_map.items()))) == content
+        for variable_name, variable_value in replacement_map.items():
+            _assert_single_pass_matches(content, variable_name, variable_value)
+
+    assert (
+        get_updated_values('PROJECT_ID = "[x]"  # in REGION', replacement_map)
+        == 'PROJECT_ID = "sample-project"  # in REGION'
+    )
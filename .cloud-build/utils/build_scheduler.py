@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An event-driven scheduler for notebook builds.
+
+Builds are submitted under a bounded concurrency limit and every outstanding
+build is tracked from the event loop thread by polling build statuses in
+batched list calls, instead of parking one thread per build. A build the list
+calls keep missing is looked up on its own, and given up on if it cannot be
+found at all, so that a run never waits on it forever.
+"""
+
+import abc
+import asyncio
+import concurrent.futures
+import dataclasses
+import itertools
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Cloud Build statuses after which a build no longer changes
+TERMINAL_STATUSES = frozenset(
+    ["SUCCESS", "FAILURE", "INTERNAL_ERROR", "TIMEOUT", "CANCELLED", "EXPIRED"]
+)
+
+# Number of build ids looked up by a single list call
+LIST_BATCH_SIZE = 50
+
+# Polls a build may be missing from the list calls before it is looked up on
+# its own, e.g. when it was created under another parent or endpoint
+MISSING_POLLS_BEFORE_LOOKUP = 4
+
+# Polls after which a build that cannot be found at all is given up on
+MAX_MISSING_POLLS = 40
+
+# Status of a build that was given up on
+UNKNOWN_STATUS = "STATUS_UNKNOWN"
+
+
+@dataclasses.dataclass
+class BuildState:
+    """The status of a build and its timestamps, in seconds since the epoch"""
+
+    status: str
+    create_time: Optional[float] = None
+    start_time: Optional[float] = None
+    finish_time: Optional[float] = None
+    # The start and end time of each build step
+    step_times: List[Tuple[Optional[float], Optional[float]]] = dataclasses.field(
+        default_factory=list
+    )
+    # Why the build did not succeed, as reported by Cloud Build
+    status_detail: Optional[str] = None
+
+
+def _to_epoch_seconds(timestamp) -> Optional[float]:
+    return timestamp.timestamp() if timestamp else None
+
+
+def build_state(build) -> BuildState:
+    """Converts a cloudbuild_v1.Build into a BuildState"""
+    failure_info = getattr(build, "failure_info", None)
+    return BuildState(
+        status=type(build).Status(build.status).name,
+        create_time=_to_epoch_seconds(build.create_time),
+        start_time=_to_epoch_seconds(build.start_time),
+        finish_time=_to_epoch_seconds(build.finish_time),
+        step_times=[
+            (
+                _to_epoch_seconds(step.timing.start_time),
+                _to_epoch_seconds(step.timing.end_time),
+            )
+            for step in build.steps
+        ],
+        status_detail=(
+            getattr(failure_info, "detail", None) or build.status_detail or None
+        ),
+    )
+
+
+class BuildService(abc.ABC):
+    """Looks up the state of submitted builds"""
+
+    @abc.abstractmethod
+    def get_builds(self, build_ids: List[str]) -> Dict[str, BuildState]:
+        """Returns the state of each of the given builds that was found"""
+        pass
+
+    def get_build(self, build_id: str) -> Optional[BuildState]:
+        """Returns the state of a single build, or None if it was not found"""
+        return self.get_builds([build_id]).get(build_id)
+
+
+class CloudBuildService(BuildService):
+    """
+    Looks up build statuses with batched Cloud Build list calls, through the
+    client and project of the BuildSession that submits the builds
+    """
+
+    def __init__(self, session, region: Optional[str] = None):
+        self._project_id = session.project_id
+        self._region = region
+        # Builds in a private pool are only listed by the regional endpoint
+        self._client = session.client(region)
+
+    def get_builds(self, build_ids: List[str]) -> Dict[str, BuildState]:
+        request = {
+            "project_id": self._project_id,
+            "filter": " OR ".join([f'build_id="{build_id}"' for build_id in build_ids]),
+            "page_size": len(build_ids),
+        }
+        if self._region:
+            request["parent"] = f"projects/{self._project_id}/locations/{self._region}"
+
+        return {
+            build.id: build_state(build)
+            for build in self._client.list_builds(request=request)
+        }
+
+    def get_build(self, build_id: str) -> Optional[BuildState]:
+        from google.api_core import exceptions
+
+        request = {"project_id": self._project_id, "id": build_id}
+        if self._region:
+            request["name"] = (
+                f"projects/{self._project_id}/locations/{self._region}/builds/{build_id}"
+            )
+
+        try:
+            return build_state(self._client.get_build(request=request))
+        except exceptions.NotFound:
+            return None
+
+
+class FakeCloudBuildService(BuildService):
+    """
+    An in-memory Cloud Build stand-in. Each build is queued for queue_duration
+    seconds, then runs and finishes with the given status once its duration
+    in seconds has elapsed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._builds: Dict[str, tuple] = {}
+        # Builds that list calls do not return, as if created under another parent
+        self.unlisted_build_ids: List[str] = []
+        self.list_calls = 0
+        self.get_calls = 0
+
+    def create_build(
+        self,
+        duration: float = 0,
+        status: str = "SUCCESS",
+        queue_duration: float = 0,
+        status_detail: Optional[str] = None,
+    ) -> str:
+        with self._lock:
+            build_id = f"fake-build-{next(self._ids)}"
+            create_time = time.time()
+            self._builds[build_id] = (
+                create_time,
+                create_time + queue_duration,
+                create_time + queue_duration + duration,
+                status,
+                status_detail,
+            )
+            return build_id
+
+    def get_builds(self, build_ids: List[str]) -> Dict[str, BuildState]:
+        with self._lock:
+            self.list_calls += 1
+            return self._states(
+                [
+                    build_id
+                    for build_id in build_ids
+                    if build_id not in self.unlisted_build_ids
+                ]
+            )
+
+    def get_build(self, build_id: str) -> Optional[BuildState]:
+        with self._lock:
+            self.get_calls += 1
+            return self._states([build_id]).get(build_id)
+
+    def _states(self, build_ids: List[str]) -> Dict[str, BuildState]:
+        now = time.time()
+        builds = {}
+        for build_id in build_ids:
+            if build_id not in self._builds:
+                continue
+            (
+                create_time,
+                start_time,
+                finish_time,
+                status,
+                status_detail,
+            ) = self._builds[build_id]
+            if now < start_time:
+                builds[build_id] = BuildState("QUEUED", create_time)
+            elif now < finish_time:
+                builds[build_id] = BuildState("WORKING", create_time, start_time)
+            else:
+                builds[build_id] = BuildState(
+                    status,
+                    create_time,
+                    start_time,
+                    finish_time,
+                    status_detail=status_detail,
+                )
+        return builds
+
+
+@dataclasses.dataclass
+class BuildCompletion:
+    key: str
+    build_id: Optional[str]
+    status: Optional[str]
+    error_message: Optional[str] = None
+    state: Optional[BuildState] = None
+
+    @property
+    def is_success(self) -> bool:
+        return self.status == "SUCCESS"
+
+
+class BuildScheduler:
+    """
+    Submits builds with at most max_concurrent_builds in flight and yields
+    their completions as they happen.
+
+    Submission is a blocking call (pre-processing, archiving and creating the
+    build) that runs on a small thread pool. Tracking runs on the event loop,
+    with the list calls on a thread of their own, so that polling never waits
+    behind submissions held back by the rate limiter.
+    """
+
+    def __init__(
+        self,
+        service: BuildService,
+        max_concurrent_builds: int = 100,
+        poll_interval_in_seconds: float = 15,
+        submit_workers: int = 8,
+    ):
+        self._service = service
+        self._max_concurrent_builds = max_concurrent_builds
+        self._poll_interval_in_seconds = poll_interval_in_seconds
+        self._submit_workers = submit_workers
+
+    async def run(
+        self, keys: Iterable[str], submit: Callable[[str], str]
+    ) -> AsyncIterator[BuildCompletion]:
+        """
+        Calls submit(key) for every key, which must return the build id, and
+        yields a BuildCompletion for every key in order of completion.
+        """
+        keys = list(keys)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self._max_concurrent_builds)
+        completions: asyncio.Queue = asyncio.Queue()
+        outstanding: Dict[str, asyncio.Future] = {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._submit_workers
+        )
+        poll_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        async def track(key: str):
+            async with semaphore:
+                try:
+                    build_id = await loop.run_in_executor(executor, submit, key)
+                except Exception as error:
+                    await completions.put(
+                        BuildCompletion(
+                            key=key, build_id=None, status=None, error_message=str(error)
+                        )
+                    )
+                    return
+
+                done = loop.create_future()
+                outstanding[build_id] = done
+                state = await done
+
+            error_message = None
+            if state.status != "SUCCESS":
+                error_message = f"Build {state.status}" + (
+                    f": {state.status_detail}" if state.status_detail else ""
+                )
+            await completions.put(
+                BuildCompletion(
+                    key=key,
+                    build_id=build_id,
+                    status=state.status,
+                    error_message=error_message,
+                    state=state,
+                )
+            )
+
+        # The number of consecutive list calls each outstanding build was missing from
+        missing_polls: Dict[str, int] = {}
+
+        def finish(build_id: str, state: BuildState):
+            if (
+                state.status in TERMINAL_STATUSES or state.status == UNKNOWN_STATUS
+            ) and build_id in outstanding:
+                missing_polls.pop(build_id, None)
+                outstanding.pop(build_id).set_result(state)
+
+        async def poll():
+            while True:
+                await asyncio.sleep(self._poll_interval_in_seconds)
+
+                build_ids = list(outstanding)
+                for start in range(0, len(build_ids), LIST_BATCH_SIZE):
+                    batch = build_ids[start : start + LIST_BATCH_SIZE]
+                    try:
+                        states = await loop.run_in_executor(
+                            poll_executor, self._service.get_builds, batch
+                        )
+                    except Exception as error:
+                        print(f"Failed to poll build statuses, retrying: {error}")
+                        continue
+
+                    for build_id in batch:
+                        if build_id in states:
+                            missing_polls.pop(build_id, None)
+                        else:
+                            missing_polls[build_id] = missing_polls.get(build_id, 0) + 1
+
+                    for build_id, state in states.items():
+                        finish(build_id, state)
+
+                # Builds the list calls keep missing are looked up one by one
+                for build_id, count in list(missing_polls.items()):
+                    if count < MISSING_POLLS_BEFORE_LOOKUP or build_id not in outstanding:
+                        continue
+
+                    try:
+                        state = await loop.run_in_executor(
+                            poll_executor, self._service.get_build, build_id
+                        )
+                    except Exception as error:
+                        print(f"Failed to look up build {build_id}: {error}")
+                        state = None
+
+                    if state is not None:
+                        finish(build_id, state)
+                    elif count >= MAX_MISSING_POLLS:
+                        finish(
+                            build_id,
+                            BuildState(
+                                UNKNOWN_STATUS,
+                                status_detail=f"The build was not found after {count} polls",
+                            ),
+                        )
+
+        trackers = [asyncio.ensure_future(track(key)) for key in keys]
+        poller = asyncio.ensure_future(poll())
+
+        try:
+            for _ in keys:
+                yield await completions.get()
+        finally:
+            poller.cancel()
+            for tracker in trackers:
+                tracker.cancel()
+            executor.shutdown(wait=False)
+            poll_executor.shutdown(wait=False)
+
+
+def _collect(scheduler: BuildScheduler, keys, submit) -> List[BuildCompletion]:
+    async def collect():
+        return [completion async for completion in scheduler.run(keys, submit)]
+
+    return asyncio.run(collect())
+
+
+def test_scheduler_tracks_many_builds_with_batched_polls():
+    service = FakeCloudBuildService()
+    scheduler = BuildScheduler(
+        service, max_concurrent_builds=2000, poll_interval_in_seconds=0.01
+    )
+    keys = [f"notebook_{i}.ipynb" for i in range(1200)]
+
+    completions = _collect(
+        scheduler,
+        keys,
+        lambda key: service.create_build(duration=0.05)
+        if not key.endswith("7.ipynb")
+        else service.create_build(
+            duration=0.05, status="FAILURE", status_detail="Step #2 failed"
+        ),
+    )
+
+    assert sorted([completion.key for completion in completions]) == sorted(keys)
+    failed = [c for c in completions if not c.is_success]
+    assert len(failed) == 120
+    assert {c.error_message for c in failed} == {"Build FAILURE: Step #2 failed"}
+    assert all(c.error_message is None for c in completions if c.is_success)
+    assert all(
+        c.state.create_time <= c.state.start_time <= c.state.finish_time
+        for c in completions
+    )
+    # Every build is polled in batches rather than one call per build
+    assert service.list_calls < len(keys)
+
+
+def test_scheduler_bounds_concurrency_and_reports_submit_errors():
+    service = FakeCloudBuildService()
+    scheduler = BuildScheduler(
+        service, max_concurrent_builds=3, poll_interval_in_seconds=0.01
+    )
+    in_flight = []
+    lock = threading.Lock()
+
+    def submit(key):
+        if key == "bad":
+            raise RuntimeError("submit failed")
+
+        with lock:
+            pending = service.get_builds(in_flight)
+            in_flight[:] = [b for b in in_flight if pending[b].status == "WORKING"]
+            assert len(in_flight) < 3
+            build_id = service.create_build(duration=0.02)
+            in_flight.append(build_id)
+            return build_id
+
+    completions = _collect(scheduler, ["a", "b", "bad", "c", "d", "e"], submit)
+
+    failed = [completion for completion in completions if not completion.is_success]
+    assert [completion.key for completion in failed] == ["bad"]
+    assert failed[0].error_message == "submit failed"
+
+
+def test_scheduler_finds_unlisted_builds_and_gives_up_on_missing_ones():
+    service = FakeCloudBuildService()
+    scheduler = BuildScheduler(service, poll_interval_in_seconds=0.001)
+
+    def submit(key):
+        if key == "missing":
+            return "never-created"
+
+        build_id = service.create_build()
+        if key == "unlisted":
+            service.unlisted_build_ids.append(build_id)
+        return build_id
+
+    completions = {
+        completion.key: completion
+        for completion in _collect(scheduler, ["listed", "unlisted", "missing"], submit)
+    }
+
+    assert completions["listed"].is_success
+    assert completions["unlisted"].is_success
+    assert completions["missing"].status == UNKNOWN_STATUS
+    assert completions["missing"].error_message == (
+        f"Build {UNKNOWN_STATUS}: The build was not found after {MAX_MISSING_POLLS} polls"
+    )
+
+
+def test_scheduler_polls_while_submissions_are_blocked():
+    service = FakeCloudBuildService()
+    scheduler = BuildScheduler(
+        service, poll_interval_in_seconds=0.01, submit_workers=1
+    )
+    first_done = threading.Event()
+
+    def submit(key):
+        if key == "blocked":
+            # Stands in for a submission waiting on the rate limiter
+            assert first_done.wait(timeout=5)
+        return service.create_build()
+
+    async def collect():
+        completions = []
+        async for completion in scheduler.run(["first", "blocked"], submit):
+            first_done.set()
+            completions.append(completion.key)
+        return completions
+
+    assert asyncio.run(collect()) == ["first", "blocked"]
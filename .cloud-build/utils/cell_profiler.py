@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-cell execution durations across a corpus of executed notebooks.
+
+Papermill records the duration of every executed cell in the cell's
+metadata. Notebooks are read one at a time and only the slowest cells are
+kept, so memory stays bounded however many notebooks are scanned.
+"""
+
+import dataclasses
+import heapq
+import json
+import os
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Cells are identified in reports by the start of their first line of code
+SOURCE_SNIPPET_LENGTH = 80
+
+# Folders that hold copies rather than executed notebooks
+SKIPPED_FOLDERS = {".ipynb_checkpoints", ".git"}
+
+
+@dataclasses.dataclass
+class CellTiming:
+    notebook: str
+    cell_index: int
+    duration_in_seconds: float
+    source_snippet: str
+    status: Optional[str]
+
+
+def source_snippet(source, length: int = SOURCE_SNIPPET_LENGTH) -> str:
+    """Returns the first non-blank line of a cell's source, truncated"""
+    if isinstance(source, list):
+        source = "".join(source)
+
+    for line in source.splitlines():
+        line = line.strip()
+        if line:
+            return line if len(line) <= length else line[: length - 3] + "..."
+
+    return ""
+
+
+def iter_notebook_paths(paths: List[str]) -> Iterator[str]:
+    """Yields the notebooks given directly, and those found under folders"""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+
+        for root, folders, files in os.walk(path):
+            folders[:] = sorted(
+                folder for folder in folders if folder not in SKIPPED_FOLDERS
+            )
+            for file in sorted(files):
+                if file.endswith(".ipynb"):
+                    yield os.path.join(root, file)
+
+
+def iter_cell_timings(notebook_path: str) -> Iterator[CellTiming]:
+    """Yields the timings of the cells of one notebook that papermill executed"""
+    with open(notebook_path, encoding="utf-8") as f:
+        nb = json.load(f)
+
+    for cell_index, cell in enumerate(nb.get("cells", [])):
+        papermill_metadata = cell.get("metadata", {}).get("papermill", {})
+        duration = papermill_metadata.get("duration")
+        if duration is None:
+            continue
+
+        yield CellTiming(
+            notebook=notebook_path,
+            cell_index=cell_index,
+            duration_in_seconds=float(duration),
+            source_snippet=source_snippet(cell.get("source", "")),
+            status=papermill_metadata.get("status"),
+        )
+
+
+class CellProfile:
+    """
+    The top_n slowest cells seen, with totals per notebook and over all cells.
+    """
+
+    def __init__(self, top_n: int = 50):
+        self._top_n = top_n
+        # A min-heap, so the fastest of the slowest cells is evicted first
+        self._heap: List[Tuple[float, int, CellTiming]] = []
+        self._num_cells_seen = 0
+
+        # Seconds per notebook, for the notebooks with any executed cells
+        self.notebook_seconds: Dict[str, float] = {}
+        self.num_notebooks_scanned = 0
+        self.unreadable_notebooks: List[str] = []
+        self.total_seconds = 0.0
+
+    @property
+    def num_cells(self) -> int:
+        return self._num_cells_seen
+
+    def add(self, timing: CellTiming):
+        self._num_cells_seen += 1
+        self.total_seconds += timing.duration_in_seconds
+        self.notebook_seconds[timing.notebook] = (
+            self.notebook_seconds.get(timing.notebook, 0.0)
+            + timing.duration_in_seconds
+        )
+
+        # The counter breaks ties, so timings themselves are never compared
+        entry = (timing.duration_in_seconds, -self._num_cells_seen, timing)
+        if len(self._heap) < self._top_n:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def add_notebook(self, notebook_path: str):
+        self.num_notebooks_scanned += 1
+        try:
+            timings = list(iter_cell_timings(notebook_path))
+        except (OSError, ValueError) as error:
+            print(f"Skipping unreadable notebook {notebook_path}: {error}")
+            self.unreadable_notebooks.append(notebook_path)
+            return
+
+        for timing in timings:
+            self.add(timing)
+
+    def slowest_cells(self) -> List[CellTiming]:
+        return [
+            timing
+            for _, _, timing in sorted(
+                self._heap, key=lambda entry: entry[:2], reverse=True
+            )
+        ]
+
+    def slowest_notebooks(self, n: int) -> List[Tuple[str, float]]:
+        return heapq.nlargest(
+            n, self.notebook_seconds.items(), key=lambda item: item[1]
+        )
+
+
+def profile_notebooks(paths: List[str], top_n: int = 50) -> CellProfile:
+    profile = CellProfile(top_n=top_n)
+    for notebook_path in iter_notebook_paths(paths):
+        profile.add_notebook(notebook_path)
+
+    return profile
+
+
+def test_profile_notebooks_ranks_slowest_cells():
+    def write_notebook(path: str, durations: List[Optional[float]]):
+        cells = [
+            {
+                "cell_type": "code",
+                "source": ["\n", f"sleep({duration})\n", "print('done')"],
+                "metadata": {"papermill": {"duration": duration, "status": "completed"}},
+                "outputs": [],
+            }
+            for duration in durations
+        ]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"cells": cells, "metadata": {}}, f)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        a = os.path.join(temp_dir, "a.ipynb")
+        b = os.path.join(temp_dir, "nested", "b.ipynb")
+        write_notebook(a, [1.0, 30.0, None])
+        write_notebook(b, [20.0, 5.0])
+        write_notebook(os.path.join(temp_dir, ".ipynb_checkpoints", "a.ipynb"), [99.0])
+        with open(os.path.join(temp_dir, "broken.ipynb"), "w") as f:
+            f.write("{")
+
+        profile = profile_notebooks([temp_dir], top_n=2)
+
+        assert [
+            (timing.notebook, timing.cell_index, timing.duration_in_seconds)
+            for timing in profile.slowest_cells()
+        ] == [(a, 1, 30.0), (b, 0, 20.0)]
+        assert profile.slowest_cells()[0].source_snippet == "sleep(30.0)"
+        assert profile.num_cells == 4
+        assert profile.num_notebooks_scanned == 3
+        assert profile.total_seconds == 56.0
+        assert profile.slowest_notebooks(1) == [(a, 31.0)]
+        assert profile.unreadable_notebooks == [os.path.join(temp_dir, "broken.ipynb")]
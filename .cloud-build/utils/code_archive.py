@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-addressed source archives for notebook builds.
+
+The tree at HEAD is archived and uploaded once as a shared base archive named
+after a hash of that tree, so that the name always matches the content. Each
+notebook build only ships a small overlay archive holding its preprocessed
+files, which is extracted over the base.
+"""
+
+import gzip
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from . import storage
+
+CODE_ARCHIVES_PREFIX = "code_archives"
+
+
+def list_tracked_files(repo_dir: str = ".") -> List[Tuple[str, str]]:
+    """Returns (object_id, path) for every file tracked at HEAD"""
+    output = subprocess.check_output(
+        ["git", "ls-tree", "-r", "HEAD"], cwd=repo_dir, encoding="UTF-8"
+    )
+
+    tracked_files = []
+    for line in output.split("\n"):
+        if len(line) == 0:
+            continue
+
+        # Format: <mode> SP <type> SP <object> TAB <path>
+        info, path = line.split("\t", 1)
+        _, _, object_id = info.split(" ")
+        tracked_files.append((object_id, path))
+
+    return tracked_files
+
+
+def hash_tracked_files(tracked_files: List[Tuple[str, str]]) -> str:
+    """Hashes a tracked file listing so identical trees share one archive"""
+    digest = hashlib.sha256()
+    for object_id, path in sorted(tracked_files, key=lambda item: item[1]):
+        digest.update(f"{object_id} {path}\n".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def build_overlay_archive(files: Dict[str, bytes]) -> bytes:
+    """
+    Builds a tar.gz of the given files. Timestamps are fixed so that the same
+    files always produce the same bytes.
+    """
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode="w") as tar:
+        for path in sorted(files):
+            content = files[path]
+            info = tarfile.TarInfo(name=path)
+            info.size = len(content)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(content))
+
+    return gzip.compress(tar_buffer.getvalue(), mtime=0)
+
+
+class CodeArchiveBuilder:
+    """
+    Builds and uploads the shared base archive once and a content-addressed
+    overlay archive per notebook. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        staging_bucket: str,
+        storage_backend: storage.StorageBackend,
+        repo_dir: str = ".",
+    ):
+        self._staging_bucket = staging_bucket
+        self._storage = storage_backend
+        self._repo_dir = repo_dir
+        self._lock = threading.Lock()
+        self._base_archive_uri: Optional[str] = None
+
+    def _archive_uri(self, *parts: str) -> str:
+        return "/".join([self._staging_bucket, CODE_ARCHIVES_PREFIX, *parts])
+
+    def base_archive_uri(self) -> str:
+        """Returns the URI of the base archive, building it on first use"""
+        with self._lock:
+            if self._base_archive_uri is None:
+                self._base_archive_uri = self._build_base_archive()
+
+        return self._base_archive_uri
+
+    def _build_base_archive(self) -> str:
+        tracked_files = list_tracked_files(self._repo_dir)
+        tree_hash = hash_tracked_files(tracked_files)
+        archive_uri = self._archive_uri(f"source_archived_{tree_hash}.tar.gz")
+
+        if self._storage.exists(archive_uri):
+            print(f"Reusing source code archive at {archive_uri}")
+            return archive_uri
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_archive = os.path.join(temp_dir, "source_archived.tar.gz")
+            # Archives HEAD rather than the working tree, which the hash does not cover
+            subprocess.check_call(
+                ["git", "archive", "--format=tar.gz", "-o", local_archive, "HEAD"],
+                cwd=self._repo_dir,
+            )
+
+            self._storage.upload_file(local_archive, archive_uri)
+
+        print(f"Uploaded source code archive to {archive_uri}")
+
+        return archive_uri
+
+    def overlay_archive_uri(self, files: Dict[str, bytes]) -> str:
+        """Uploads an overlay holding the given repo-relative files"""
+        return self.upload_overlay_archive(build_overlay_archive(files))
+
+    def upload_overlay_archive(self, archive: bytes) -> str:
+        """Uploads an overlay built by build_overlay_archive"""
+        archive_uri = self._archive_uri(
+            "overlays", f"{hashlib.sha256(archive).hexdigest()}.tar.gz"
+        )
+
+        if not self._storage.exists(archive_uri):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                local_archive = os.path.join(temp_dir, "overlay.tar.gz")
+                with open(local_archive, "wb") as f:
+                    f.write(archive)
+
+                self._storage.upload_file(local_archive, archive_uri)
+
+        return archive_uri
+
+
+def _create_test_repo(repo_dir: str):
+    def git(*args):
+        subprocess.check_output(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+            + list(args),
+            cwd=repo_dir,
+        )
+
+    os.makedirs(os.path.join(repo_dir, "notebooks"))
+    with open(os.path.join(repo_dir, "notebooks", "a.ipynb"), "w") as f:
+        f.write('{"cells": []}')
+
+    git("init", "-q")
+    git("add", "-A")
+    git("commit", "-q", "-m", "init")
+
+
+def test_base_archive_is_uploaded_once():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo_dir = os.path.join(temp_dir, "repo")
+        _create_test_repo(repo_dir)
+        local_storage = storage.LocalStorage(os.path.join(temp_dir, "gcs"))
+
+        first_uri = CodeArchiveBuilder(
+            "gs://staging", local_storage, repo_dir=repo_dir
+        ).base_archive_uri()
+        archive_mtime = os.path.getmtime(local_storage.local_path(first_uri))
+
+        second_uri = CodeArchiveBuilder(
+            "gs://staging", local_storage, repo_dir=repo_dir
+        ).base_archive_uri()
+
+        assert first_uri == second_uri
+        assert os.path.getmtime(local_storage.local_path(second_uri)) == archive_mtime
+
+        with tarfile.open(local_storage.local_path(first_uri)) as tar:
+            assert [member.name for member in tar.getmembers() if member.isfile()] == [
+                "notebooks/a.ipynb"
+            ]
+
+
+def test_base_archive_holds_the_committed_tree():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo_dir = os.path.join(temp_dir, "repo")
+        _create_test_repo(repo_dir)
+        local_storage = storage.LocalStorage(os.path.join(temp_dir, "gcs"))
+
+        # Uncommitted edits would otherwise end up under the name of HEAD's tree
+        with open(os.path.join(repo_dir, "notebooks", "a.ipynb"), "w") as f:
+            f.write('{"cells": ["edited"]}')
+
+        archive_uri = CodeArchiveBuilder(
+            "gs://staging", local_storage, repo_dir=repo_dir
+        ).base_archive_uri()
+        with tarfile.open(local_storage.local_path(archive_uri)) as tar:
+            assert tar.extractfile("notebooks/a.ipynb").read() == b'{"cells": []}'
+
+
+def test_overlay_archive_is_content_addressed():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_storage = storage.LocalStorage(temp_dir)
+        builder = CodeArchiveBuilder("gs://staging", local_storage)
+
+        uri_a = builder.overlay_archive_uri({"notebooks/a.ipynb": b"a"})
+        uri_b = builder.overlay_archive_uri({"notebooks/a.ipynb": b"b"})
+
+        assert uri_a == builder.overlay_archive_uri({"notebooks/a.ipynb": b"a"})
+        assert uri_a != uri_b
+
+        with tarfile.open(local_storage.local_path(uri_b)) as tar:
+            assert tar.extractfile("notebooks/a.ipynb").read() == b"b"
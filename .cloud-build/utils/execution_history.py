@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A JSONL history of notebook execution durations.
+
+The history is used to submit notebooks longest-predicted-first, so that long
+notebooks do not start last and set the makespan of a run, and to give each
+notebook a timeout derived from how long it took when it passed.
+"""
+
+import datetime
+import json
+import os
+import statistics
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set
+
+from . import storage
+
+# Number of most recent runs of a notebook used for predictions
+MAX_SAMPLES_PER_NOTEBOOK = 10
+
+# Passing runs needed before a notebook gets a history-based timeout
+MIN_SAMPLES_FOR_TIMEOUT = 3
+
+# A notebook is cut off after this multiple of its longest passing run...
+TIMEOUT_MULTIPLIER = 2.0
+
+# ...plus this padding, to absorb queueing and dependency install variance
+TIMEOUT_PADDING_IN_SECONDS = 30 * 60
+
+
+class ExecutionHistory:
+    """
+    Execution durations keyed by notebook path, stored as one JSON record per
+    line. A gs:// path is read and written through the default storage backend.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._records: List[Dict] = []
+        self._new_records: List[Dict] = []
+        self._durations: Dict[str, List[float]] = {}
+        self._build_ids: Set[str] = set()
+
+    @classmethod
+    def load(cls, path: str) -> "ExecutionHistory":
+        history = cls(path)
+
+        for line in (storage.read_text(path) or "").splitlines():
+            if line.strip():
+                history._add(json.loads(line))
+
+        return history
+
+    def _add(self, record: Dict):
+        self._records.append(record)
+        if record.get("build_id"):
+            self._build_ids.add(record["build_id"])
+        if record["is_pass"]:
+            durations = self._durations.setdefault(record["notebook"], [])
+            durations.append(record["duration_seconds"])
+            del durations[:-MAX_SAMPLES_PER_NOTEBOOK]
+
+    def record(
+        self,
+        notebook: str,
+        duration: datetime.timedelta,
+        is_pass: bool,
+        build_id: Optional[str] = None,
+    ):
+        """Adds a run of a notebook. A build that is already recorded is skipped."""
+        record = {
+            "notebook": notebook,
+            "duration_seconds": duration.total_seconds(),
+            "is_pass": is_pass,
+            "timestamp": datetime.datetime.now().isoformat(),
+        }
+        if build_id:
+            record["build_id"] = build_id
+
+        with self._lock:
+            if build_id and build_id in self._build_ids:
+                return
+            self._add(record)
+            self._new_records.append(record)
+
+    def save(self):
+        """Appends the records added since the history was loaded"""
+        with self._lock:
+            lines = "".join(
+                [json.dumps(record) + "\n" for record in self._new_records]
+            )
+
+            if self._path.startswith(storage.GCS_SCHEME):
+                # Objects cannot be appended to, so rewrite the full history
+                storage.write_text(
+                    self._path,
+                    "".join([json.dumps(record) + "\n" for record in self._records]),
+                )
+            else:
+                with open(self._path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+
+            self._new_records = []
+
+    def predicted_duration(self, notebook: str) -> Optional[float]:
+        """Returns the median recent passing duration in seconds, if any"""
+        durations = self._durations.get(notebook)
+        if not durations:
+            return None
+
+        return statistics.median(durations)
+
+    def order_longest_first(self, notebooks: List[str]) -> List[str]:
+        """
+        Orders notebooks longest-predicted-first. Notebooks without history go
+        first, since they may be the longest of all.
+        """
+
+        def sort_key(notebook: str):
+            predicted_duration = self.predicted_duration(notebook)
+            if predicted_duration is None:
+                return (0, 0)
+            return (1, -predicted_duration)
+
+        return sorted(notebooks, key=sort_key)
+
+    def timeout_in_seconds(self, notebook: str) -> Optional[int]:
+        """Returns a timeout derived from passing runs, if there are enough"""
+        durations = self._durations.get(notebook, [])
+        if len(durations) < MIN_SAMPLES_FOR_TIMEOUT:
+            return None
+
+        return int(max(durations) * TIMEOUT_MULTIPLIER + TIMEOUT_PADDING_IN_SECONDS)
+
+
+def test_history_orders_longest_first_and_derives_timeouts():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "history.jsonl")
+
+        history = ExecutionHistory.load(path)
+        for minutes in [10, 12, 11]:
+            history.record("short.ipynb", datetime.timedelta(minutes=minutes), True)
+        history.record("long.ipynb", datetime.timedelta(hours=4), True)
+        history.record("long.ipynb", datetime.timedelta(hours=9), False)
+        history.record("short.ipynb", datetime.timedelta(hours=1), True, build_id="b1")
+        history.save()
+
+        history = ExecutionHistory.load(path)
+        # A build recorded by an earlier run is not counted twice
+        history.record("short.ipynb", datetime.timedelta(hours=1), True, build_id="b1")
+        history.save()
+
+        history = ExecutionHistory.load(path)
+
+        assert history.order_longest_first(
+            ["short.ipynb", "long.ipynb", "new.ipynb"]
+        ) == ["new.ipynb", "long.ipynb", "short.ipynb"]
+        assert history.predicted_duration("long.ipynb") == 4 * 60 * 60
+        assert history.predicted_duration("short.ipynb") == 11.5 * 60
+        assert history.timeout_in_seconds("long.ipynb") is None
+        assert (
+            history.timeout_in_seconds("short.ipynb")
+            == 60 * 60 * 2 + TIMEOUT_PADDING_IN_SECONDS
+        )
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A pool of pre-started Jupyter kernels for running many notebooks locally.
+
+Starting a kernel and importing heavy libraries can take longer than running
+a short notebook. Pool kernels are started once, import a warm-up list of
+modules, and are reset between notebooks instead of being restarted. Modules
+stay in sys.modules across a reset, so notebooks import them for free.
+"""
+
+import concurrent.futures
+import contextlib
+import dataclasses
+import os
+import queue
+import re
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from jupyter_client.manager import KernelManager
+
+# The kernel used to run notebooks, regardless of the one defined in the notebook
+DEFAULT_KERNEL_NAME = "python3"
+
+# Modules imported by most notebooks that are slow to import
+DEFAULT_WARM_UP_IMPORTS = [
+    "numpy",
+    "pandas",
+    "google.cloud.aiplatform",
+    "tensorflow",
+]
+
+STARTUP_TIMEOUT_IN_SECONDS = 60
+RESET_TIMEOUT_IN_SECONDS = 60
+
+# Clears the user namespace and returns to the working directory of the pool
+_RESET_CODE = "%reset -f\nimport os as _os\n_os.chdir({cwd!r})\ndel _os"
+
+_IMPORT_LINE = re.compile(r"^\s*import\s+([\w.]+(?:\s*,\s*[\w.]+)*)", flags=re.MULTILINE)
+_FROM_IMPORT_LINE = re.compile(r"^\s*from\s+([\w.]+)\s+import\s+(\w+)", flags=re.MULTILINE)
+
+
+def imported_modules(source: str) -> Set[str]:
+    """Returns the modules imported by code, e.g. from a notebook's code cells"""
+    modules = set()
+    for match in _IMPORT_LINE.finditer(source):
+        modules |= {module.strip() for module in match.group(1).split(",")}
+
+    for match in _FROM_IMPORT_LINE.finditer(source):
+        # `from google.cloud import aiplatform` may import a submodule
+        modules |= {match.group(1), f"{match.group(1)}.{match.group(2)}"}
+
+    return modules
+
+
+def _execute(kernel_manager: KernelManager, code: str, timeout: float) -> bool:
+    """Runs code in the kernel, returning whether it succeeded"""
+    kernel_client = kernel_manager.client()
+    kernel_client.start_channels()
+    try:
+        kernel_client.wait_for_ready(timeout=timeout)
+        reply = kernel_client.execute_interactive(
+            code, timeout=timeout, store_history=False, output_hook=lambda msg: None
+        )
+        return reply["content"]["status"] == "ok"
+    except (RuntimeError, TimeoutError):
+        return False
+    finally:
+        kernel_client.stop_channels()
+
+
+@dataclasses.dataclass
+class WarmKernel:
+    kernel_manager: KernelManager
+    startup_seconds: float
+    import_seconds: Dict[str, float]
+
+    def saved_seconds(self, modules: Iterable[str]) -> float:
+        """
+        Estimates the time a cold kernel would have spent before running code
+        that imports the given modules: starting up and importing the warm-up
+        modules that the code uses.
+        """
+        modules = set(modules)
+        return self.startup_seconds + sum(
+            seconds
+            for warm_module, seconds in self.import_seconds.items()
+            if any(
+                module == warm_module or module.startswith(warm_module + ".")
+                for module in modules
+            )
+        )
+
+
+class KernelPool:
+    """
+    A fixed number of warm kernels, checked out one notebook at a time.
+
+    A kernel that dies or cannot be reset, e.g. because the notebook restarted
+    it after installing packages, is replaced by a freshly started one.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        warm_up_imports: Optional[List[str]] = None,
+        kernel_name: str = DEFAULT_KERNEL_NAME,
+        cwd: Optional[str] = None,
+    ):
+        self._warm_up_imports = (
+            DEFAULT_WARM_UP_IMPORTS if warm_up_imports is None else warm_up_imports
+        )
+        self._kernel_name = kernel_name
+        self._cwd = cwd or os.getcwd()
+        self._kernels: "queue.Queue[WarmKernel]" = queue.Queue()
+
+        # Kernels start in parallel, since each is a separate process
+        with concurrent.futures.ThreadPoolExecutor(max_workers=size) as executor:
+            for kernel in executor.map(lambda _: self._start_kernel(), range(size)):
+                self._kernels.put(kernel)
+
+    def _start_kernel(self) -> WarmKernel:
+        time_start = time.perf_counter()
+        kernel_manager = KernelManager(kernel_name=self._kernel_name)
+        kernel_manager.start_kernel(cwd=self._cwd)
+        _execute(kernel_manager, "pass", timeout=STARTUP_TIMEOUT_IN_SECONDS)
+        startup_seconds = time.perf_counter() - time_start
+
+        import_seconds = {}
+        for module in self._warm_up_imports:
+            time_start = time.perf_counter()
+            # A module that fails to import is left for the notebook to report
+            if _execute(
+                kernel_manager, f"import {module}", timeout=STARTUP_TIMEOUT_IN_SECONDS
+            ):
+                import_seconds[module] = time.perf_counter() - time_start
+
+        _execute(
+            kernel_manager,
+            _RESET_CODE.format(cwd=self._cwd),
+            timeout=RESET_TIMEOUT_IN_SECONDS,
+        )
+
+        return WarmKernel(
+            kernel_manager=kernel_manager,
+            startup_seconds=startup_seconds,
+            import_seconds=import_seconds,
+        )
+
+    def _reset(self, kernel: WarmKernel) -> WarmKernel:
+        if kernel.kernel_manager.is_alive() and _execute(
+            kernel.kernel_manager,
+            _RESET_CODE.format(cwd=self._cwd),
+            timeout=RESET_TIMEOUT_IN_SECONDS,
+        ):
+            return kernel
+
+        kernel.kernel_manager.shutdown_kernel(now=True)
+        return self._start_kernel()
+
+    @contextlib.contextmanager
+    def kernel(self) -> Iterator[WarmKernel]:
+        """Checks out a kernel, which is reset when it is returned"""
+        kernel = self._kernels.get()
+        try:
+            yield kernel
+        finally:
+            self._kernels.put(self._reset(kernel))
+
+    def shutdown(self):
+        while not self._kernels.empty():
+            self._kernels.get_nowait().kernel_manager.shutdown_kernel(now=True)
+
+    def __enter__(self) -> "KernelPool":
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+def test_saved_seconds():
+    modules = imported_modules(
+        "import os, numpy as np\n"
+        "from google.cloud import aiplatform\n"
+        "  import tensorflow.keras\n"
+        "# import pandas\n"
+    )
+    assert modules == {
+        "os",
+        "numpy",
+        "google.cloud",
+        "google.cloud.aiplatform",
+        "tensorflow.keras",
+    }
+
+    kernel = WarmKernel(
+        kernel_manager=None,
+        startup_seconds=2.0,
+        import_seconds={"numpy": 0.5, "pandas": 1.0, "google.cloud.aiplatform": 4.0},
+    )
+    assert kernel.saved_seconds(modules) == 6.5
+    assert kernel.saved_seconds([]) == 2.0
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming access to build logs.
+
+Build logs of long notebooks can be hundreds of megabytes. The reader only
+fetches the byte ranges it needs, and scans for step boundaries one chunk at
+a time, so memory use is bounded by the chunk size rather than the log size.
+"""
+
+import codecs
+import os
+import sys
+import tempfile
+from typing import Iterator, Optional, TextIO
+
+from . import storage
+
+# The size of each ranged read
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class LogReader:
+    """Reads a log object through ranged reads of a storage backend"""
+
+    def __init__(
+        self,
+        uri: str,
+        storage_backend: Optional[storage.StorageBackend] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ):
+        self._uri = uri
+        self._storage_backend = storage_backend or storage.get_default_storage()
+        self._chunk_size = chunk_size
+        self._size: Optional[int] = None
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = self._storage_backend.size(self._uri)
+        return self._size
+
+    def tail(self, num_bytes: int) -> str:
+        """Returns the last num_bytes of the log, like `gsutil cat -r -N`"""
+        return self._storage_backend.read_range(self._uri, start=-num_bytes).decode(
+            "utf-8", errors="replace"
+        )
+
+    def iter_chunks(self, start: int = 0) -> Iterator[bytes]:
+        """Yields the log from the start offset onwards, one chunk at a time"""
+        for offset in range(start, self.size, self._chunk_size):
+            yield self._storage_backend.read_range(
+                self._uri, start=offset, end=offset + self._chunk_size
+            )
+
+    def find(self, marker: str, ignore_case: bool = True) -> Optional[int]:
+        """
+        Returns the byte offset of the first occurrence of marker, or None.
+        Consecutive chunks overlap by len(marker) - 1 bytes, so a marker that
+        straddles a chunk boundary is still found.
+        """
+        needle = marker.encode("utf-8")
+        if ignore_case:
+            needle = needle.lower()
+
+        overlap = b""
+        offset = 0
+        for chunk in self.iter_chunks():
+            window = overlap + chunk
+            index = (window.lower() if ignore_case else window).find(needle)
+            if index != -1:
+                return offset - len(overlap) + index
+
+            offset += len(chunk)
+            overlap = window[max(len(window) - len(needle) + 1, 0) :]
+
+        return None
+
+    def stream(self, output: TextIO = sys.stdout, start: int = 0):
+        """Writes the log from the start offset onwards to output"""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for chunk in self.iter_chunks(start=start):
+            output.write(decoder.decode(chunk))
+        output.write(decoder.decode(b"", final=True))
+
+    def stream_from(
+        self, marker: str, output: TextIO = sys.stdout, ignore_case: bool = True
+    ):
+        """
+        Writes the log from the first occurrence of marker onwards to output,
+        or the whole log if the marker is not found.
+        """
+        self.stream(output=output, start=self.find(marker, ignore_case) or 0)
+
+
+def test_find_across_chunk_boundaries():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_storage = storage.LocalStorage(os.path.join(temp_dir, "gcs"))
+        local_file = os.path.join(temp_dir, "log.txt")
+        content = b"Step #4: pip install\n" * 7 + b"Step #5: Starting Step #5\ndone\n"
+        with open(local_file, "wb") as f:
+            f.write(content)
+
+        uri = local_storage.upload_file(local_file, "gs://logs/log.txt")
+        expected = content.lower().find(b"starting step #5")
+
+        # Every chunk size splits the marker at a different position
+        for chunk_size in range(1, 40):
+            log_reader = LogReader(uri, local_storage, chunk_size=chunk_size)
+            assert log_reader.find("starting Step #5") == expected
+            assert log_reader.find("starting Step #5", ignore_case=False) is None
+            assert log_reader.find("missing marker") is None
+
+        log_reader = LogReader(uri, local_storage, chunk_size=8)
+        assert log_reader.tail(5) == "done\n"
+        assert b"".join(log_reader.iter_chunks()) == content
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Debounced checkpointing of notebooks during execution.
+
+Papermill rewrites the whole output notebook when every cell starts and
+completes. The checkpointing engine registered here writes on a time or cell
+budget instead, atomically, and moves oversized outputs into side files that
+are written once, so checkpoints stay small.
+"""
+
+import copy
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import nbformat
+from papermill.engines import NBClientEngine, NotebookExecutionManager, papermill_engines
+
+# The papermill engine name to execute notebooks with
+ENGINE_NAME = "checkpointing"
+
+DEFAULT_CHECKPOINT_INTERVAL_IN_SECONDS = 30
+DEFAULT_CHECKPOINT_EVERY_CELLS = 20
+
+# Outputs larger than this, once serialized, are moved into side files
+DEFAULT_MAX_OUTPUT_BYTES = 256 * 1024
+
+# Side files are written next to the notebook, in <notebook>.outputs
+SIDE_FILE_FOLDER_SUFFIX = ".outputs"
+
+
+def side_file_folder(notebook_path: str) -> str:
+    return notebook_path + SIDE_FILE_FOLDER_SUFFIX
+
+
+def write_atomically(path: str, content: bytes):
+    """Writes through a temporary file, so readers never see a partial file"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    os.fchmod(fd, 0o644)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def serialize_notebook(nb: nbformat.NotebookNode) -> bytes:
+    """Serializes the notebook the same way nbformat.write does"""
+    content = nbformat.writes(nb)
+    if not content.endswith("\n"):
+        content += "\n"
+    return content.encode("utf-8")
+
+
+class NotebookCheckpointer:
+    """
+    Writes a notebook when checkpoint_interval_in_seconds have passed or
+    checkpoint_every_cells cells have completed since the last write.
+
+    If max_output_bytes is set, larger outputs are written to side files and
+    replaced in the notebook by a pointer to the side file. A side file is
+    only rewritten when its output changes size. The pointer names the side
+    file folder as side_file_folder_name, for notebooks that will be renamed.
+    """
+
+    def __init__(
+        self,
+        notebook_path: str,
+        checkpoint_interval_in_seconds: float = DEFAULT_CHECKPOINT_INTERVAL_IN_SECONDS,
+        checkpoint_every_cells: int = DEFAULT_CHECKPOINT_EVERY_CELLS,
+        max_output_bytes: Optional[int] = DEFAULT_MAX_OUTPUT_BYTES,
+        side_file_folder_name: Optional[str] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._notebook_path = notebook_path
+        self._checkpoint_interval_in_seconds = checkpoint_interval_in_seconds
+        self._checkpoint_every_cells = checkpoint_every_cells
+        self._max_output_bytes = max_output_bytes
+        self._side_file_folder_name = side_file_folder_name or os.path.basename(
+            side_file_folder(notebook_path)
+        )
+        self._clock = clock
+        self._last_write_time = clock()
+        self._cells_since_write = 0
+        self._side_file_sizes: Dict[str, int] = {}
+
+        self.num_writes = 0
+        self.bytes_written = 0
+
+    @property
+    def side_files(self) -> List[str]:
+        return sorted(self._side_file_sizes)
+
+    def cell_completed(self):
+        self._cells_since_write += 1
+
+    def is_due(self) -> bool:
+        return (
+            self._cells_since_write >= self._checkpoint_every_cells
+            or self._clock() - self._last_write_time
+            >= self._checkpoint_interval_in_seconds
+        )
+
+    def checkpoint(self, nb: nbformat.NotebookNode, force: bool = False) -> bool:
+        """Writes the notebook if a checkpoint is due, returning whether it did"""
+        if not force and not self.is_due():
+            return False
+
+        self.write(nb)
+        return True
+
+    def write(self, nb: nbformat.NotebookNode):
+        content = serialize_notebook(self._externalize_large_outputs(nb))
+        write_atomically(self._notebook_path, content)
+
+        self.num_writes += 1
+        self.bytes_written += len(content)
+        self._last_write_time = self._clock()
+        self._cells_since_write = 0
+
+    def _externalize_large_outputs(
+        self, nb: nbformat.NotebookNode
+    ) -> nbformat.NotebookNode:
+        """Returns a shallow copy of the notebook without oversized outputs"""
+        if self._max_output_bytes is None:
+            return nb
+
+        folder = side_file_folder(self._notebook_path)
+        cells = []
+        for cell_index, cell in enumerate(nb.cells):
+            outputs = []
+            is_externalized = False
+            for output_index, output in enumerate(cell.get("outputs", [])):
+                content = json.dumps(output).encode("utf-8")
+                if len(content) <= self._max_output_bytes:
+                    outputs.append(output)
+                    continue
+
+                file_name = f"cell-{cell_index}-output-{output_index}.json"
+                side_file = os.path.join(folder, file_name)
+                if self._side_file_sizes.get(side_file) != len(content):
+                    write_atomically(side_file, content)
+                    self._side_file_sizes[side_file] = len(content)
+                    self.bytes_written += len(content)
+
+                is_externalized = True
+                outputs.append(
+                    nbformat.v4.new_output(
+                        "display_data",
+                        data={
+                            "text/plain": f"Output of {len(content)} bytes saved to {self._side_file_folder_name}/{file_name}"
+                        },
+                    )
+                )
+
+            if is_externalized:
+                cell = copy.copy(cell)
+                cell.outputs = outputs
+            cells.append(cell)
+
+        nb = copy.copy(nb)
+        nb.cells = cells
+        return nb
+
+
+def externalize_large_outputs(
+    notebook_path: str,
+    max_output_bytes: int = DEFAULT_MAX_OUTPUT_BYTES,
+    side_file_folder_name: Optional[str] = None,
+) -> List[str]:
+    """
+    Moves the oversized outputs of a notebook file into side files, and
+    returns the side files
+    """
+    with open(notebook_path, encoding="utf-8") as f:
+        nb = nbformat.read(f, as_version=4)
+
+    checkpointer = NotebookCheckpointer(
+        notebook_path,
+        max_output_bytes=max_output_bytes,
+        side_file_folder_name=side_file_folder_name,
+    )
+    checkpointer.write(nb)
+    return checkpointer.side_files
+
+
+class CheckpointingExecutionManager(NotebookExecutionManager):
+    """Saves through a NotebookCheckpointer instead of after every cell"""
+
+    def __init__(self, nb, checkpointer: Optional[NotebookCheckpointer], **kwargs):
+        super().__init__(nb, **kwargs)
+        self.checkpointer = checkpointer
+
+    def save(self, **kwargs):
+        # papermill autosaves long-running cells based on last_save_time, so it
+        # only moves when the notebook is actually written
+        if self.checkpointer and self.checkpointer.checkpoint(self.nb):
+            self.last_save_time = self.now()
+
+    def cell_exception(self, cell, cell_index=None, **kwargs):
+        super().cell_exception(cell, cell_index=cell_index, **kwargs)
+        # Make failures visible right away
+        if self.checkpointer:
+            self.checkpointer.checkpoint(self.nb, force=True)
+            self.last_save_time = self.now()
+
+    def cell_complete(self, cell, cell_index=None, **kwargs):
+        if self.checkpointer:
+            self.checkpointer.cell_completed()
+        super().cell_complete(cell, cell_index=cell_index, **kwargs)
+
+
+class CheckpointingEngine(NBClientEngine):
+    """The nbclient engine, with debounced and size-bounded saves"""
+
+    @classmethod
+    def execute_notebook(
+        cls,
+        nb,
+        kernel_name,
+        output_path=None,
+        progress_bar=True,
+        log_output=False,
+        autosave_cell_every=30,
+        checkpoint_interval_in_seconds=DEFAULT_CHECKPOINT_INTERVAL_IN_SECONDS,
+        checkpoint_every_cells=DEFAULT_CHECKPOINT_EVERY_CELLS,
+        max_output_bytes=DEFAULT_MAX_OUTPUT_BYTES,
+        **kwargs,
+    ):
+        checkpointer = None
+        if output_path:
+            checkpointer = NotebookCheckpointer(
+                output_path,
+                checkpoint_interval_in_seconds=checkpoint_interval_in_seconds,
+                checkpoint_every_cells=checkpoint_every_cells,
+                max_output_bytes=max_output_bytes,
+            )
+
+        nb_man = CheckpointingExecutionManager(
+            nb,
+            checkpointer=checkpointer,
+            output_path=output_path,
+            progress_bar=progress_bar,
+            log_output=log_output,
+            autosave_cell_every=autosave_cell_every,
+        )
+
+        nb_man.notebook_start()
+        try:
+            cls.execute_managed_notebook(
+                nb_man, kernel_name, log_output=log_output, **kwargs
+            )
+        finally:
+            nb_man.cleanup_pbar()
+            nb_man.notebook_complete()
+
+        return nb_man.nb
+
+
+papermill_engines.register(ENGINE_NAME, CheckpointingEngine)
+
+
+def test_checkpointer_budgets_and_side_files():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        notebook_path = os.path.join(temp_dir, "executed.ipynb")
+        now = [0.0]
+        checkpointer = NotebookCheckpointer(
+            notebook_path,
+            checkpoint_interval_in_seconds=10,
+            checkpoint_every_cells=3,
+            max_output_bytes=1000,
+            clock=lambda: now[0],
+        )
+
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [nbformat.v4.new_code_cell(f"print({i})") for i in range(4)]
+        nb.cells[1].outputs = [
+            nbformat.v4.new_output("stream", name="stdout", text="x" * 5000)
+        ]
+
+        # Two completed cells and little time are not worth a write
+        for _ in range(2):
+            checkpointer.cell_completed()
+            assert not checkpointer.checkpoint(nb)
+
+        checkpointer.cell_completed()
+        assert checkpointer.checkpoint(nb)
+
+        now[0] = 10
+        assert checkpointer.checkpoint(nb)
+        assert not checkpointer.checkpoint(nb)
+        assert checkpointer.num_writes == 2
+
+        # The oversized output is written once, and the notebook points to it
+        side_file = os.path.join(
+            side_file_folder(notebook_path), "cell-1-output-0.json"
+        )
+        assert checkpointer.side_files == [side_file]
+        with open(side_file) as f:
+            assert json.load(f)["text"] == "x" * 5000
+
+        with open(notebook_path) as f:
+            written = nbformat.read(f, as_version=4)
+        assert "cell-1-output-0.json" in written.cells[1].outputs[0].data["text/plain"]
+        assert nb.cells[1].outputs[0].text == "x" * 5000
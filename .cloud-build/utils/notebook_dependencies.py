@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An index of the repository files each notebook depends on.
+
+A notebook depends on the files it references from `!python`, `%%writefile`
+and `gsutil cp` lines, and on a `src` directory next to it. The references
+found in a notebook are cached by its git blob id, so only notebooks that
+changed since the last run are parsed again.
+"""
+
+import json
+import os
+import posixpath
+import re
+import shlex
+import tempfile
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from . import storage
+
+# Bump when the extraction rules change, to invalidate cached references
+INDEX_VERSION = 1
+
+# Directory next to a notebook that holds its sources
+SOURCE_DIRECTORY_NAME = "src"
+
+_PYTHON_LINE = re.compile(r"^\s*!\s*python[0-9.]*\s+(.*)$")
+_WRITEFILE_LINE = re.compile(r"^\s*%%writefile\s+(.*)$")
+_GSUTIL_CP_LINE = re.compile(r"^\s*!\s*gsutil\s+(?:-\S+\s+)*cp\s+(.*)$")
+
+
+def _split_arguments(arguments: str) -> List[str]:
+    try:
+        return shlex.split(arguments, comments=True)
+    except ValueError:
+        return arguments.split()
+
+
+def extract_references(notebook_content: str) -> List[str]:
+    """Returns the raw path-like arguments referenced by a notebook's code cells"""
+    try:
+        cells = json.loads(notebook_content).get("cells", [])
+    except ValueError:
+        return []
+
+    references = []
+    for cell in cells:
+        if cell.get("cell_type") != "code":
+            continue
+
+        source = cell.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+
+        for line in source.split("\n"):
+            match = _PYTHON_LINE.match(line)
+            if match:
+                arguments = _split_arguments(match.group(1))
+                if len(arguments) >= 2 and arguments[0] == "-m":
+                    # A module such as trainer.task lives at trainer/task.py
+                    module_path = arguments[1].replace(".", "/")
+                    references += [module_path + ".py", module_path.split("/")[0]]
+                references += [
+                    argument for argument in arguments if not argument.startswith("-")
+                ]
+                continue
+
+            match = _WRITEFILE_LINE.match(line) or _GSUTIL_CP_LINE.match(line)
+            if match:
+                references += [
+                    argument
+                    for argument in _split_arguments(match.group(1))
+                    if not argument.startswith("-") and "://" not in argument
+                ]
+
+    return sorted(set(references))
+
+
+class DependencyIndex:
+    """
+    Maps notebooks to the tracked files and directories they depend on.
+    References are cached per blob id in an optional JSON cache file.
+    """
+
+    def __init__(self, tracked_files: List[Tuple[str, str]], cache_file: Optional[str] = None):
+        self._tracked_files = tracked_files
+        self._object_ids = {path: object_id for object_id, path in tracked_files}
+        self._directories: Set[str] = set()
+        for _, path in tracked_files:
+            directory = posixpath.dirname(path)
+            while directory and directory not in self._directories:
+                self._directories.add(directory)
+                directory = posixpath.dirname(directory)
+
+        self._cache_file = cache_file
+        self._cached_references: Dict[str, List[str]] = {}
+        self._is_cache_dirty = False
+
+        content = storage.read_text(cache_file) if cache_file else None
+        if content:
+            cache = json.loads(content)
+            if cache.get("version") == INDEX_VERSION:
+                self._cached_references = cache["references"]
+
+    def _references(self, notebook: str) -> List[str]:
+        object_id = self._object_ids.get(notebook)
+        if object_id is not None and object_id in self._cached_references:
+            return self._cached_references[object_id]
+
+        with open(notebook, encoding="utf-8") as f:
+            references = extract_references(f.read())
+
+        if object_id is not None:
+            self._cached_references[object_id] = references
+            self._is_cache_dirty = True
+
+        return references
+
+    def _resolve(self, notebook: str, reference: str) -> Optional[str]:
+        """Resolves a reference relative to the notebook, then to the repo root"""
+        for candidate in [
+            posixpath.join(posixpath.dirname(notebook), reference),
+            reference,
+        ]:
+            candidate = posixpath.normpath(candidate).rstrip("/")
+            if candidate in self._object_ids or candidate in self._directories:
+                return candidate
+
+        return None
+
+    def dependencies(self, notebook: str) -> Set[str]:
+        """Returns the tracked files and directories the notebook depends on"""
+        dependencies = set()
+        for reference in self._references(notebook) + [SOURCE_DIRECTORY_NAME]:
+            resolved = self._resolve(notebook, reference)
+            if resolved is not None and resolved != notebook:
+                dependencies.add(resolved)
+
+        return dependencies
+
+    def dependency_object_ids(self, notebook: str) -> Dict[str, str]:
+        """
+        Returns the blob id of every tracked file the notebook depends on,
+        including the files under the directories it depends on
+        """
+        dependencies = self.dependencies(notebook)
+        object_ids = {}
+        for path, object_id in self._object_ids.items():
+            parent = path
+            while parent:
+                if parent in dependencies:
+                    object_ids[path] = object_id
+                    break
+                parent = posixpath.dirname(parent)
+
+        return object_ids
+
+    def dependent_notebooks(
+        self, notebooks: Iterable[str], changed_files: Iterable[str]
+    ) -> List[str]:
+        """Returns the notebooks that depend on any of the changed files"""
+        # Reverse index from each dependency to the notebooks that use it
+        dependents: Dict[str, Set[str]] = {}
+        for notebook in notebooks:
+            for dependency in self.dependencies(notebook):
+                dependents.setdefault(dependency, set()).add(notebook)
+
+        affected = set()
+        for changed_file in changed_files:
+            # A changed file affects users of the file and of any parent directory
+            path = changed_file
+            while path:
+                affected |= dependents.get(path, set())
+                path = posixpath.dirname(path)
+
+        return sorted(affected)
+
+    def save(self):
+        if not self._cache_file or not self._is_cache_dirty:
+            return
+
+        # Drop references of blobs that are no longer tracked
+        references = {
+            object_id: self._cached_references[object_id]
+            for object_id in set(self._object_ids.values())
+            if object_id in self._cached_references
+        }
+        storage.write_text(
+            self._cache_file,
+            json.dumps({"version": INDEX_VERSION, "references": references}),
+        )
+        self._is_cache_dirty = False
+
+
+def _code_cell(source: str) -> Dict:
+    return {"cell_type": "code", "source": source}
+
+
+def test_extract_references():
+    notebook_content = json.dumps(
+        {
+            "cells": [
+                _code_cell("!python3 trainer/task.py --epochs=3"),
+                _code_cell("!python -m custom.trainer.task --epochs=3"),
+                _code_cell("%%writefile custom/setup.py\nimport setuptools"),
+                _code_cell("! gsutil -m cp -r data/train.csv gs://bucket/train.csv"),
+                {"cell_type": "markdown", "source": "!python docs.py"},
+            ]
+        }
+    )
+
+    assert extract_references(notebook_content) == [
+        "custom",
+        "custom.trainer.task",
+        "custom/setup.py",
+        "custom/trainer/task.py",
+        "data/train.csv",
+        "trainer/task.py",
+    ]
+
+
+def test_dependent_notebooks():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        try:
+            os.makedirs("notebooks/a/src")
+            os.makedirs("notebooks/b")
+            with open("notebooks/a/a.ipynb", "w") as f:
+                json.dump({"cells": []}, f)
+            with open("notebooks/b/b.ipynb", "w") as f:
+                json.dump({"cells": [_code_cell("!python ../shared/train.py")]}, f)
+
+            tracked_files = [
+                ("1", "notebooks/a/a.ipynb"),
+                ("2", "notebooks/a/src/trainer.py"),
+                ("3", "notebooks/b/b.ipynb"),
+                ("4", "notebooks/shared/train.py"),
+            ]
+            cache_file = os.path.join(temp_dir, "index.json")
+            index = DependencyIndex(tracked_files, cache_file=cache_file)
+            notebooks = ["notebooks/a/a.ipynb", "notebooks/b/b.ipynb"]
+
+            assert index.dependent_notebooks(
+                notebooks, ["notebooks/a/src/trainer.py"]
+            ) == ["notebooks/a/a.ipynb"]
+            assert index.dependent_notebooks(
+                notebooks, ["notebooks/shared/train.py"]
+            ) == ["notebooks/b/b.ipynb"]
+            assert index.dependency_object_ids("notebooks/a/a.ipynb") == {
+                "notebooks/a/src/trainer.py": "2"
+            }
+            index.save()
+
+            # A warm index answers from the cache without reading notebooks
+            os.remove("notebooks/b/b.ipynb")
+            warm_index = DependencyIndex(tracked_files, cache_file=cache_file)
+            assert warm_index.dependent_notebooks(
+                notebooks, ["notebooks/shared/train.py"]
+            ) == ["notebooks/b/b.ipynb"]
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-processes notebooks for execution, parsing each only once"""
+
+import concurrent.futures
+import dataclasses
+import multiprocessing
+import re
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import nbformat
+
+from . import NotebookProcessors
+
+# The Python version used unless the notebook specifies one
+DEFAULT_PYTHON_VERSION = "3.9"
+
+PYTHON_VERSION_PATTERN = re.compile(r"python version = (\d\.\d)", flags=re.IGNORECASE)
+
+
+@dataclasses.dataclass
+class PreprocessedNotebook:
+    notebook_path: str
+    content: bytes
+    python_version: str
+    is_using_wheelhouse: bool = False
+    preprocessing_seconds: float = 0.0
+    preprocessing_started_at: float = 0.0
+
+
+def get_python_version(
+    nb: nbformat.NotebookNode, default_python_version: str = DEFAULT_PYTHON_VERSION
+) -> str:
+    """
+    Get the python version for running the notebook if it is specified in
+    the notebook.
+    """
+    for cell in nb.cells:
+        if cell.cell_type == "markdown":
+            # Look for the python version specification pattern
+            re_match = PYTHON_VERSION_PATTERN.search(cell.source)
+            if re_match:
+                return re_match.group(1)
+
+    return default_python_version
+
+
+def preprocess_notebook(
+    notebook_path: str,
+    replacement_map: Dict[str, Optional[str]],
+    default_python_version: str = DEFAULT_PYTHON_VERSION,
+    wheelhouse_requirements: Optional[Set[str]] = None,
+    wheelhouse_python_version: Optional[str] = None,
+) -> PreprocessedNotebook:
+    """
+    Removes no_execute cells and substitutes variables. The notebook file
+    itself is left untouched.
+
+    If the notebook runs on wheelhouse_python_version, pip install lines of
+    wheelhouse_requirements are rewritten to install from the wheelhouse.
+    """
+    started_at = time.time()
+    time_start = time.perf_counter()
+
+    with open(notebook_path, encoding="utf-8") as f:
+        nb = nbformat.read(f, as_version=4)
+
+    # The version may be specified in a cell that is not executed
+    python_version = get_python_version(nb, default_python_version)
+
+    nb, resources = NotebookProcessors.RemoveNoExecuteCells().preprocess(nb)
+    nb, resources = NotebookProcessors.UpdateVariablesPreprocessor(
+        replacement_map=replacement_map
+    ).preprocess(nb, resources)
+
+    is_using_wheelhouse = bool(wheelhouse_requirements) and (
+        python_version == wheelhouse_python_version
+    )
+    if is_using_wheelhouse:
+        nb, resources = NotebookProcessors.InstallFromWheelhousePreprocessor(
+            available_requirements=wheelhouse_requirements
+        ).preprocess(nb, resources)
+
+    # Serialize the same way nbformat.write does
+    content = nbformat.writes(nb)
+    if not content.endswith("\n"):
+        content += "\n"
+
+    return PreprocessedNotebook(
+        notebook_path=notebook_path,
+        content=content.encode("utf-8"),
+        python_version=python_version,
+        is_using_wheelhouse=is_using_wheelhouse,
+        preprocessing_seconds=time.perf_counter() - time_start,
+        preprocessing_started_at=started_at,
+    )
+
+
+def preprocess_notebooks(
+    notebook_paths: List[str],
+    replacement_map: Dict[str, Optional[str]],
+    default_python_version: str = DEFAULT_PYTHON_VERSION,
+    max_workers: Optional[int] = None,
+    on_submitted: Optional[Callable[[], None]] = None,
+    wheelhouse_requirements: Optional[Set[str]] = None,
+    wheelhouse_python_version: Optional[str] = None,
+) -> Tuple[Dict[str, PreprocessedNotebook], Dict[str, Exception]]:
+    """
+    Pre-processes notebooks in a process pool, so the CPU-bound parsing and
+    substitution does not contend on the GIL.
+
+    on_submitted is called once every notebook has been handed to the pool and
+    before waiting for results, so I/O-bound work can overlap pre-processing.
+
+    Returns the pre-processed notebooks and the errors, by notebook path.
+    """
+    preprocessed_notebooks: Dict[str, PreprocessedNotebook] = {}
+    errors: Dict[str, Exception] = {}
+
+    # The CLIs run at import time, so workers must not re-import the main module
+    # as spawn and forkserver workers do
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        futures = {
+            executor.submit(
+                preprocess_notebook,
+                notebook_path=notebook_path,
+                replacement_map=replacement_map,
+                default_python_version=default_python_version,
+                wheelhouse_requirements=wheelhouse_requirements,
+                wheelhouse_python_version=wheelhouse_python_version,
+            ): notebook_path
+            for notebook_path in notebook_paths
+        }
+
+        if on_submitted:
+            on_submitted()
+
+        for future in concurrent.futures.as_completed(futures):
+            notebook_path = futures[future]
+            try:
+                preprocessed_notebooks[notebook_path] = future.result()
+            except Exception as error:
+                errors[notebook_path] = error
+
+    return preprocessed_notebooks, errors
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-phase timings of notebook executions.
+
+Each phase is recorded as a [start, end] pair of seconds since the epoch,
+keyed by phase name, so that phases measured locally and by Cloud Build can
+be compared. Timings are exported as JSON or in the Prometheus text format.
+"""
+
+import contextlib
+import json
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Client-side phases, followed by the phases of the build itself. Install and
+# execute are the dependency install and notebook execution steps of running.
+PHASES = [
+    "preprocess",
+    "archive",
+    "upload",
+    "submit",
+    "queued",
+    "running",
+    "install",
+    "execute",
+    "log_fetch",
+]
+
+PROMETHEUS_METRIC_NAME = "notebook_phase_duration_seconds"
+# A gauge too, so it avoids the _total suffix that Prometheus reserves for counters
+PROMETHEUS_TOTALS_METRIC_NAME = "notebook_phase_duration_all_notebooks_seconds"
+
+Phases = Dict[str, List[float]]
+
+
+@contextlib.contextmanager
+def timed(
+    phases: Phases, phase: str, clock: Callable[[], float] = time.time
+) -> Iterator[None]:
+    """Records the wall-clock span of the block as the given phase"""
+    start = clock()
+    try:
+        yield
+    finally:
+        phases[phase] = [start, clock()]
+
+
+def record(phases: Phases, phase: str, start: Optional[float], end: Optional[float]):
+    """Records a phase if both of its timestamps are known"""
+    if start is not None and end is not None:
+        phases[phase] = [start, end]
+
+
+def phase_seconds(phases: Phases, phase: str) -> Optional[float]:
+    if phase not in phases:
+        return None
+
+    start, end = phases[phase]
+    return max(end - start, 0.0)
+
+
+def total_seconds(phases_by_notebook: Dict[str, Phases]) -> Dict[str, float]:
+    """Sums each phase over all notebooks"""
+    totals = {}
+    for phase in PHASES:
+        durations = [
+            phase_seconds(phases, phase)
+            for phases in phases_by_notebook.values()
+            if phase in phases
+        ]
+        if durations:
+            totals[phase] = sum(durations)
+
+    return totals
+
+
+def to_json(phases_by_notebook: Dict[str, Phases]) -> str:
+    return json.dumps(
+        {
+            "totals": total_seconds(phases_by_notebook),
+            "notebooks": {
+                notebook: {
+                    phase: {
+                        "start": phases[phase][0],
+                        "end": phases[phase][1],
+                        "seconds": phase_seconds(phases, phase),
+                    }
+                    for phase in PHASES
+                    if phase in phases
+                }
+                for notebook, phases in sorted(phases_by_notebook.items())
+            },
+        },
+        indent=2,
+    )
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def to_prometheus(phases_by_notebook: Dict[str, Phases]) -> str:
+    """Formats the phase durations as a gauge per notebook and phase"""
+    lines = [
+        f"# HELP {PROMETHEUS_METRIC_NAME} Time a notebook spent in each execution phase.",
+        f"# TYPE {PROMETHEUS_METRIC_NAME} gauge",
+    ]
+    for notebook, phases in sorted(phases_by_notebook.items()):
+        for phase in PHASES:
+            if phase in phases:
+                lines.append(
+                    f'{PROMETHEUS_METRIC_NAME}{{notebook="{_escape_label_value(notebook)}",phase="{phase}"}} '
+                    f"{phase_seconds(phases, phase)}"
+                )
+
+    lines += [
+        f"# HELP {PROMETHEUS_TOTALS_METRIC_NAME} Time all notebooks spent in each execution phase.",
+        f"# TYPE {PROMETHEUS_TOTALS_METRIC_NAME} gauge",
+    ]
+    for phase, seconds in total_seconds(phases_by_notebook).items():
+        lines.append(f'{PROMETHEUS_TOTALS_METRIC_NAME}{{phase="{phase}"}} {seconds}')
+
+    return "\n".join(lines) + "\n"
+
+
+def test_phase_exports():
+    phases_by_notebook = {
+        "a": {"queued": [100.0, 130.0], "running": [130.0, 190.0]},
+        'b"c': {"queued": [100.0, 110.0]},
+    }
+    clock = iter([5.0, 7.5])
+    with timed(phases_by_notebook["a"], "submit", clock=lambda: next(clock)):
+        pass
+
+    assert total_seconds(phases_by_notebook) == {
+        "submit": 2.5,
+        "queued": 40.0,
+        "running": 60.0,
+    }
+    assert json.loads(to_json(phases_by_notebook))["notebooks"]["a"]["running"] == {
+        "start": 130.0,
+        "end": 190.0,
+        "seconds": 60.0,
+    }
+
+    prometheus = to_prometheus(phases_by_notebook)
+    assert f'{PROMETHEUS_METRIC_NAME}{{notebook="b\\"c",phase="queued"}} 10.0' in prometheus
+    assert f'{PROMETHEUS_TOTALS_METRIC_NAME}{{phase="queued"}} 40.0' in prometheus
+    assert "_total" not in prometheus
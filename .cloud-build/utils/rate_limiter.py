@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A token bucket rate limiter that adapts to quota errors.
+
+The rate grows additively while calls succeed, up to a ceiling, and is cut
+multiplicatively when the API reports a quota error. No call is let through
+before the error's Retry-After deadline. Limiters given the same state file
+share one bucket through a file lock, so concurrent processes, e.g. shards
+of one test run, stay within a single quota.
+"""
+
+import asyncio
+import contextlib
+import dataclasses
+import datetime
+import email.utils
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from google.api_core import exceptions
+
+# A shared bucket left idle for this long starts over from the configured rate
+IDLE_RESET_SECONDS = 10 * 60
+
+# Attempts of a call before a quota error is raised to the caller
+MAX_ATTEMPTS = 5
+
+
+def is_quota_error(error: Exception) -> bool:
+    return isinstance(error, (exceptions.TooManyRequests, exceptions.ResourceExhausted))
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Returns how long the API asked to wait, from a Retry-After header of an
+    HTTP response or the RetryInfo details of a gRPC error
+    """
+    response = getattr(error, "response", None)
+    value = (getattr(response, "headers", None) or {}).get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            retry_time = email.utils.parsedate_to_datetime(value)
+            return max(
+                (retry_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds(),
+                0.0,
+            )
+
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+
+    return None
+
+
+@dataclasses.dataclass
+class RateLimiterStats:
+    """Counters of the calls made through one limiter"""
+
+    rate_per_minute: float
+    acquired: int = 0
+    succeeded: int = 0
+    throttled: int = 0
+    waited_seconds: float = 0.0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def throughput_per_minute(self) -> float:
+        if not self.elapsed_seconds:
+            return 0.0
+        return self.succeeded / self.elapsed_seconds * 60
+
+
+class AdaptiveRateLimiter:
+    def __init__(
+        self,
+        per_minute: float,
+        burst: int = 1,
+        min_per_minute: Optional[float] = None,
+        max_per_minute: Optional[float] = None,
+        increase_per_minute: Optional[float] = None,
+        decrease_factor: float = 0.5,
+        state_file: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        Starts at per_minute, letting up to burst calls through at once. Each
+        minute's worth of successful calls raises the rate by
+        increase_per_minute, up to max_per_minute, and each quota error
+        multiplies it by decrease_factor, down to min_per_minute.
+        """
+        self._per_minute = per_minute
+        self._burst = burst
+        self._min_per_minute = min_per_minute or per_minute / 10
+        self._max_per_minute = max_per_minute or per_minute * 2
+        self._increase_per_minute = increase_per_minute or per_minute / 10
+        self._decrease_factor = decrease_factor
+        self._state_file = state_file
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = threading.Lock()
+        self._local_state = self._initial_state()
+        self._start = clock()
+        self._stats = RateLimiterStats(rate_per_minute=per_minute)
+
+    def _initial_state(self) -> Dict[str, float]:
+        return {
+            "tokens": float(self._burst),
+            "updated": self._clock(),
+            "rate_per_minute": self._per_minute,
+            "blocked_until": 0.0,
+        }
+
+    @contextlib.contextmanager
+    def _state(self) -> Iterator[Dict[str, float]]:
+        """Holds the bucket, locking the state file if it is shared"""
+        with self._lock:
+            if not self._state_file:
+                yield self._local_state
+                self._stats.rate_per_minute = self._local_state["rate_per_minute"]
+                return
+
+            with os.fdopen(
+                os.open(self._state_file, os.O_RDWR | os.O_CREAT, 0o644), "r+"
+            ) as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                content = file.read()
+                state = json.loads(content) if content else self._initial_state()
+                if self._clock() - state["updated"] > IDLE_RESET_SECONDS:
+                    state = self._initial_state()
+
+                yield state
+
+                file.seek(0)
+                file.truncate()
+                json.dump(state, file)
+                self._stats.rate_per_minute = state["rate_per_minute"]
+
+    def reserve(self) -> float:
+        """Takes a token and returns the seconds to wait before using it"""
+        with self._state() as state:
+            now = self._clock()
+            rate_per_second = state["rate_per_minute"] / 60
+            state["tokens"] = min(
+                self._burst,
+                state["tokens"] + max(now - state["updated"], 0) * rate_per_second,
+            )
+            state["updated"] = now
+            state["tokens"] -= 1
+            self._stats.acquired += 1
+
+            return max(
+                -state["tokens"] / rate_per_second,
+                state["blocked_until"] - now,
+                0.0,
+            )
+
+    def wait(self):
+        wait_seconds = self.reserve()
+        if wait_seconds > 0:
+            self._stats.waited_seconds += wait_seconds
+            self._sleep(wait_seconds)
+
+    async def acquire(self):
+        wait_seconds = self.reserve()
+        if wait_seconds > 0:
+            self._stats.waited_seconds += wait_seconds
+            await asyncio.sleep(wait_seconds)
+
+    def on_success(self):
+        with self._state() as state:
+            # Adds increase_per_minute over a minute's worth of calls
+            state["rate_per_minute"] = min(
+                self._max_per_minute,
+                state["rate_per_minute"]
+                + self._increase_per_minute / state["rate_per_minute"],
+            )
+            self._stats.succeeded += 1
+
+    def on_throttled(self, retry_after_seconds: Optional[float] = None):
+        with self._state() as state:
+            state["rate_per_minute"] = max(
+                self._min_per_minute, state["rate_per_minute"] * self._decrease_factor
+            )
+            # Drop any burst, so that calls resume at the reduced rate
+            now = self._clock()
+            state["tokens"] = min(state["tokens"], 0.0)
+            state["updated"] = max(state["updated"], now)
+            if retry_after_seconds:
+                state["blocked_until"] = max(
+                    state["blocked_until"], now + retry_after_seconds
+                )
+            self._stats.throttled += 1
+
+    def call(
+        self, function: Callable[..., Any], *args, is_acquired: bool = False, **kwargs
+    ) -> Any:
+        """
+        Calls function once the rate allows, retrying it on quota errors. Pass
+        is_acquired if a token was already taken for the first attempt.
+        """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if attempt > 1 or not is_acquired:
+                self.wait()
+
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                if not is_quota_error(error):
+                    raise
+
+                self.on_throttled(retry_after_seconds(error))
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                print(f"Quota exceeded, retrying at {self._stats.rate_per_minute:.1f} per minute: {error}")
+                continue
+
+            self.on_success()
+            return result
+
+    def stats(self) -> RateLimiterStats:
+        return dataclasses.replace(
+            self._stats, elapsed_seconds=self._clock() - self._start
+        )
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def test_limiter_bursts_then_spaces_calls_and_adapts():
+    clock = _FakeClock()
+    limiter = AdaptiveRateLimiter(per_minute=60, burst=2, clock=clock, sleep=clock.sleep)
+
+    assert [limiter.reserve() for _ in range(4)] == [0.0, 0.0, 1.0, 2.0]
+    clock.now += 10
+    assert limiter.reserve() == 0.0
+
+    # A quota error halves the rate and blocks calls until Retry-After
+    limiter.on_throttled(retry_after_seconds=30)
+    assert limiter.stats().rate_per_minute == 30
+    assert limiter.reserve() == 30
+
+    # A minute's worth of successes adds a tenth of the configured rate back
+    for _ in range(30):
+        limiter.on_success()
+    assert round(limiter.stats().rate_per_minute) == 36
+
+    calls = []
+
+    def create():
+        calls.append(clock.now)
+        if len(calls) < 3:
+            raise exceptions.TooManyRequests("quota exceeded")
+        return "created"
+
+    assert limiter.call(create) == "created"
+    stats = limiter.stats()
+    assert (stats.throttled, stats.succeeded) == (3, 31)
+    assert calls[1] > calls[0]
+
+
+def test_limiters_share_a_state_file(tmp_path):
+    clock = _FakeClock()
+    state_file = str(tmp_path / "rate_limit.json")
+    shards = [
+        AdaptiveRateLimiter(per_minute=60, burst=1, state_file=state_file, clock=clock)
+        for _ in range(2)
+    ]
+
+    # The second shard waits for the token the first one took
+    assert [shard.reserve() for shard in shards] == [0.0, 1.0]
+
+    shards[0].on_throttled()
+    assert shards[1].reserve() > 2.0
+    assert shards[1].stats().rate_per_minute == 30
+
+
+def test_retry_after_seconds_reads_headers():
+    class Response:
+        headers = {"Retry-After": "12"}
+
+    error = exceptions.TooManyRequests("quota exceeded", response=Response())
+    assert retry_after_seconds(error) == 12.0
+    assert retry_after_seconds(exceptions.TooManyRequests("quota exceeded")) is None
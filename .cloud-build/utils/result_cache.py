@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A cache of passing notebook executions.
+
+A notebook whose inputs are unchanged since it last passed does not need to
+run again. The inputs are the pre-processed notebook, the container it runs
+in, its Python version, the requirements installed in the build and the
+repository files the notebook depends on.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, Optional
+
+from . import storage
+
+# The requirements installed in every notebook build
+REQUIREMENTS_FILEPATH = ".cloud-build/requirements.txt"
+
+# Cached passes older than this are executed again
+DEFAULT_TTL = datetime.timedelta(days=7)
+
+
+def cache_key(
+    notebook_content: bytes,
+    container_uri: str,
+    python_version: str,
+    requirements: bytes,
+    dependency_object_ids: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Hashes every input that affects the outcome of a notebook execution. The
+    dependencies are given as the git blob id of each file, by path.
+    """
+    dependencies = "".join(
+        f"{object_id} {path}\n"
+        for path, object_id in sorted((dependency_object_ids or {}).items())
+    )
+
+    digest = hashlib.sha256()
+    for part in [
+        notebook_content,
+        container_uri.encode("utf-8"),
+        python_version.encode("utf-8"),
+        requirements,
+        dependencies.encode("utf-8"),
+    ]:
+        # Length-prefix each part so that boundaries between parts are unambiguous
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+
+    return digest.hexdigest()
+
+
+def read_requirements(requirements_filepath: str = REQUIREMENTS_FILEPATH) -> bytes:
+    with open(requirements_filepath, "rb") as f:
+        return f.read()
+
+
+class ResultCache:
+    """
+    Passing executions keyed by cache_key, stored as a JSON object in a local
+    file or a gs:// object.
+    """
+
+    def __init__(self, path: str, ttl: datetime.timedelta = DEFAULT_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+
+    @classmethod
+    def load(cls, path: str, ttl: datetime.timedelta = DEFAULT_TTL) -> "ResultCache":
+        result_cache = cls(path, ttl=ttl)
+
+        content = storage.read_text(path)
+        if content:
+            result_cache._entries = json.loads(content)
+
+        return result_cache
+
+    def get_pass(self, key: str) -> Optional[Dict]:
+        """Returns the cached pass for the key, unless it has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        passed_at = datetime.datetime.fromisoformat(entry["timestamp"])
+        if datetime.datetime.now() - passed_at > self._ttl:
+            return None
+
+        return entry
+
+    def record_pass(
+        self, key: str, notebook: str, build_id: str, log_url: str, output_uri: str
+    ):
+        with self._lock:
+            self._entries[key] = {
+                "notebook": notebook,
+                "build_id": build_id,
+                "log_url": log_url,
+                "output_uri": output_uri,
+                "timestamp": datetime.datetime.now().isoformat(),
+            }
+
+    def save(self):
+        """Writes the cache, dropping expired entries"""
+        now = datetime.datetime.now()
+        with self._lock:
+            self._entries = {
+                key: entry
+                for key, entry in self._entries.items()
+                if now - datetime.datetime.fromisoformat(entry["timestamp"])
+                <= self._ttl
+            }
+            storage.write_text(self._path, json.dumps(self._entries, indent=2))
+
+
+def test_result_cache_expiry():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "cache.json")
+        key = cache_key(b"{}", "python:3.9", "3.9", b"papermill")
+
+        result_cache = ResultCache.load(path)
+        result_cache.record_pass(key, "a.ipynb", "build-1", "log", "gs://out/a.ipynb")
+        result_cache.save()
+
+        assert ResultCache.load(path).get_pass(key)["build_id"] == "build-1"
+        assert ResultCache.load(path).get_pass(
+            cache_key(b"{}", "python:3.10", "3.9", b"papermill")
+        ) is None
+        assert (
+            ResultCache.load(path, ttl=datetime.timedelta(seconds=-1)).get_pass(key)
+            is None
+        )
+
+
+def test_cache_key_covers_dependencies():
+    def key(dependency_object_ids):
+        return cache_key(
+            b"{}", "python:3.9", "3.9", b"papermill", dependency_object_ids
+        )
+
+    # Only a file under the notebook's src directory changed
+    assert key({"notebooks/a/src/trainer.py": "1"}) != key(
+        {"notebooks/a/src/trainer.py": "2"}
+    )
+    assert key({"notebooks/a/src/trainer.py": "1"}) != key({})
+    assert key(None) == key({})
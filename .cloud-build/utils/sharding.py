@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deterministic, duration-balanced sharding of notebooks across orchestrators.
+
+Every shard computes the same partition from the same notebook list and
+history, so shards need no coordination as long as they read one pinned
+snapshot of the history that no shard writes to. Notebooks are assigned
+longest-predicted-first to the shard with the least predicted total.
+"""
+
+import datetime
+import os
+import statistics
+import tempfile
+from typing import List, Optional
+
+from . import execution_history
+
+# The predicted duration of notebooks when there is no history at all
+DEFAULT_PREDICTED_DURATION_IN_SECONDS = 1.0
+
+
+def shard_notebooks(
+    notebooks: List[str],
+    shard_index: int,
+    shard_count: int,
+    history: Optional[execution_history.ExecutionHistory] = None,
+) -> List[str]:
+    """
+    Returns the notebooks of shard shard_index out of shard_count. Notebooks
+    without history are predicted to take the median duration of the others.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"Shard index {shard_index} is out of range for {shard_count} shards"
+        )
+
+    notebooks = sorted(set(notebooks))
+
+    predicted_durations = {
+        notebook: history.predicted_duration(notebook) if history else None
+        for notebook in notebooks
+    }
+    known_durations = [
+        duration for duration in predicted_durations.values() if duration is not None
+    ]
+    default_duration = (
+        statistics.median(known_durations)
+        if known_durations
+        else DEFAULT_PREDICTED_DURATION_IN_SECONDS
+    )
+    for notebook, duration in predicted_durations.items():
+        if duration is None:
+            predicted_durations[notebook] = default_duration
+
+    shard_totals = [0.0] * shard_count
+    shards: List[List[str]] = [[] for _ in range(shard_count)]
+
+    # Ties are broken by path and by shard index, so every shard agrees
+    for notebook in sorted(
+        notebooks, key=lambda notebook: (-predicted_durations[notebook], notebook)
+    ):
+        shard = min(range(shard_count), key=lambda index: (shard_totals[index], index))
+        shards[shard].append(notebook)
+        shard_totals[shard] += predicted_durations[notebook]
+
+    return shards[shard_index]
+
+
+def test_shard_notebooks_balances_durations():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        history = execution_history.ExecutionHistory.load(
+            os.path.join(temp_dir, "history.jsonl")
+        )
+        for notebook, minutes in [("a", 60), ("b", 50), ("c", 40), ("d", 30), ("e", 20)]:
+            history.record(
+                f"{notebook}.ipynb",
+                duration=datetime.timedelta(minutes=minutes),
+                is_pass=True,
+            )
+
+        notebooks = ["e.ipynb", "d.ipynb", "c.ipynb", "b.ipynb", "a.ipynb", "new.ipynb"]
+        shards = [
+            shard_notebooks(notebooks, shard_index, 2, history)
+            for shard_index in range(2)
+        ]
+
+        # Every notebook lands in exactly one shard
+        assert sorted(shards[0] + shards[1]) == sorted(notebooks)
+        # new.ipynb is predicted at the median, 40 minutes, and both shards
+        # end up with 120 minutes
+        assert shards == [
+            ["a.ipynb", "new.ipynb", "e.ipynb"],
+            ["b.ipynb", "c.ipynb", "d.ipynb"],
+        ]
+        assert shard_notebooks(list(reversed(notebooks)), 1, 2, history) == shards[1]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in-memory overlay of pre-processed files.
+
+Workers stage their pre-processed notebooks here instead of rewriting the
+checkout, so the tracked tree stays pristine while other workers archive it.
+"""
+
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+
+class StagingArea:
+    """
+    Thread-safe mapping of repo-relative paths to staged file contents, with
+    optional attributes describing each staged file
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Dict[str, bytes] = {}
+        self._attributes: Dict[str, Dict[str, Any]] = {}
+
+    def stage(self, path: str, content: bytes, **attributes: Any):
+        with self._lock:
+            self._files[path] = content
+            self._attributes[path] = attributes
+
+    def read(self, path: str) -> bytes:
+        with self._lock:
+            return self._files[path]
+
+    def attributes(self, path: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._attributes[path])
+
+    def files(self, paths: Optional[Iterable[str]] = None) -> Dict[str, bytes]:
+        """Returns a snapshot of the staged files, optionally limited to paths"""
+        with self._lock:
+            if paths is None:
+                return dict(self._files)
+
+            return {path: self._files[path] for path in paths}
+
+    def discard(self, path: str):
+        with self._lock:
+            self._files.pop(path, None)
+            self._attributes.pop(path, None)
+
+    def __contains__(self, path: str) -> bool:
+        with self._lock:
+            return path in self._files
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._files)
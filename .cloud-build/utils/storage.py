@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage backends used to stage notebook sources, outputs and logs"""
+
+import abc
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+
+GCS_SCHEME = "gs://"
+
+# Number of pooled HTTP connections kept open to GCS by the shared client
+CONNECTION_POOL_SIZE = 128
+
+# Uploads larger than this are sent as resumable uploads in chunks of this size
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Maximum number of files transferred concurrently by upload_files
+MAX_PARALLEL_TRANSFERS = 16
+
+
+def split_uri(uri: str) -> Tuple[str, str]:
+    """Splits a gs://bucket/path URI into its bucket and object name"""
+    if uri.startswith(GCS_SCHEME):
+        uri = uri[len(GCS_SCHEME) :]
+
+    bucket_name, _, blob_name = uri.partition("/")
+    return bucket_name, blob_name
+
+
+def _resolve_range(size: int, start: int, end: Optional[int]) -> Tuple[int, int]:
+    """
+    Resolves a byte range into absolute [start, end) offsets. A negative start
+    counts back from the end of the object, like `gsutil cat -r -N`.
+    """
+    if start < 0:
+        start = max(size + start, 0)
+    if end is None or end > size:
+        end = size
+
+    return start, max(start, end)
+
+
+class StorageBackend(abc.ABC):
+    """An object store addressed by gs://bucket/path URIs"""
+
+    @abc.abstractmethod
+    def exists(self, uri: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def size(self, uri: str) -> int:
+        pass
+
+    @abc.abstractmethod
+    def upload_file(self, local_file_path: str, uri: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def download_file(self, uri: str, local_file_path: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def read_range(self, uri: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        """Reads bytes [start, end) of an object. A negative start reads the tail."""
+        pass
+
+    def read(self, uri: str) -> bytes:
+        return self.read_range(uri)
+
+    def upload_files(self, transfers: List[Tuple[str, str]]) -> List[str]:
+        """Uploads (local_file_path, uri) pairs in parallel"""
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_TRANSFERS
+        ) as executor:
+            return list(
+                executor.map(
+                    lambda transfer: self.upload_file(*transfer),
+                    transfers,
+                )
+            )
+
+
+class GCSStorage(StorageBackend):
+    """
+    Google Cloud Storage through a single in-process client. The client's
+    connection pool is shared by every thread, and all requests are retried
+    on transient errors.
+    """
+
+    def __init__(self, client=None):
+        from google.cloud.storage.retry import DEFAULT_RETRY
+
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._retry = DEFAULT_RETRY
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._create_client()
+
+        return self._client
+
+    @staticmethod
+    def _create_client():
+        import requests
+        from google.cloud import storage
+
+        client = storage.Client()
+
+        # The default pool only keeps 10 connections, fewer than the number of
+        # notebooks that are transferred concurrently
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=CONNECTION_POOL_SIZE
+        )
+        client._http.mount("https://", adapter)
+
+        return client
+
+    def _blob(self, uri: str):
+        bucket_name, blob_name = split_uri(uri)
+        return self.client.bucket(bucket_name).blob(
+            blob_name, chunk_size=RESUMABLE_CHUNK_SIZE
+        )
+
+    def exists(self, uri: str) -> bool:
+        return self._blob(uri).exists(retry=self._retry)
+
+    def size(self, uri: str) -> int:
+        blob = self._blob(uri)
+        blob.reload(retry=self._retry)
+        return blob.size
+
+    def upload_file(self, local_file_path: str, uri: str) -> str:
+        # Uploads are not retried by default because they are not conditional,
+        # but overwriting a staged object with the same file is harmless
+        self._blob(uri).upload_from_filename(local_file_path, retry=self._retry)
+        return uri
+
+    def download_file(self, uri: str, local_file_path: str) -> str:
+        self._blob(uri).download_to_filename(local_file_path, retry=self._retry)
+        return local_file_path
+
+    def read_range(self, uri: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        if start == 0 and end is None:
+            return self._blob(uri).download_as_bytes(retry=self._retry)
+
+        start, end = _resolve_range(self.size(uri), start, end)
+        if start == end:
+            return b""
+
+        # The end offset of download_as_bytes is inclusive
+        return self._blob(uri).download_as_bytes(
+            start=start, end=end - 1, retry=self._retry
+        )
+
+
+class LocalStorage(StorageBackend):
+    """
+    A local directory standing in for GCS. The object gs://bucket/path is
+    stored at <root>/bucket/path.
+    """
+
+    def __init__(self, root: str):
+        self._root = root
+
+    def local_path(self, uri: str) -> str:
+        bucket_name, blob_name = split_uri(uri)
+        return os.path.join(self._root, bucket_name, blob_name)
+
+    def exists(self, uri: str) -> bool:
+        return os.path.isfile(self.local_path(uri))
+
+    def size(self, uri: str) -> int:
+        return os.path.getsize(self.local_path(uri))
+
+    def upload_file(self, local_file_path: str, uri: str) -> str:
+        destination = self.local_path(uri)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        # Copy to a temporary file first so readers never see partial objects
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(destination))
+        os.close(fd)
+        shutil.copyfile(local_file_path, temp_path)
+        os.replace(temp_path, destination)
+        return uri
+
+    def download_file(self, uri: str, local_file_path: str) -> str:
+        shutil.copyfile(self.local_path(uri), local_file_path)
+        return local_file_path
+
+    def read_range(self, uri: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        local_path = self.local_path(uri)
+        start, end = _resolve_range(os.path.getsize(local_path), start, end)
+
+        with open(local_path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+_default_storage: Optional[StorageBackend] = None
+_default_storage_lock = threading.Lock()
+
+
+def get_default_storage() -> StorageBackend:
+    """Returns the process-wide storage backend, a shared GCSStorage by default"""
+    global _default_storage
+
+    with _default_storage_lock:
+        if _default_storage is None:
+            _default_storage = GCSStorage()
+
+        return _default_storage
+
+
+def set_default_storage(storage_backend: StorageBackend):
+    """Replaces the process-wide storage backend, e.g. with a LocalStorage"""
+    global _default_storage
+
+    with _default_storage_lock:
+        _default_storage = storage_backend
+
+
+def read_text(path: str) -> Optional[str]:
+    """
+    Reads a local file or a gs:// object through the default storage backend.
+    Returns None if it does not exist.
+    """
+    if path.startswith(GCS_SCHEME):
+        if not get_default_storage().exists(path):
+            return None
+        return get_default_storage().read(path).decode("utf-8")
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def write_text(path: str, text: str):
+    """Atomically writes a local file or a gs:// object"""
+    if path.startswith(GCS_SCHEME):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_path = os.path.join(temp_dir, os.path.basename(path))
+            with open(local_path, "w", encoding="utf-8") as f:
+                f.write(text)
+
+            get_default_storage().upload_file(local_path, path)
+        return
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def test_local_storage_read_range():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_storage = LocalStorage(os.path.join(temp_dir, "gcs"))
+        local_file = os.path.join(temp_dir, "log.txt")
+        with open(local_file, "wb") as f:
+            f.write(b"0123456789")
+
+        uri = local_storage.upload_file(local_file, "gs://logs/log.txt")
+
+        assert local_storage.size(uri) == 10
+        assert local_storage.read(uri) == b"0123456789"
+        assert local_storage.read_range(uri, start=2, end=5) == b"234"
+        assert local_storage.read_range(uri, start=-3) == b"789"
+        assert local_storage.read_range(uri, start=-100) == b"0123456789"
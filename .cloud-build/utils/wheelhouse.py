@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A shared wheelhouse of the packages that notebooks install with pip.
+
+The requirements of each selected notebook are resolved on their own, so that
+one notebook's pins do not constrain another's, into one shared folder of
+wheels. The folder is named after a hash of the requirements and uploaded as
+an archive that every notebook build extracts. Install lines whose
+requirements are in the wheelhouse are rewritten to install from it, falling
+back to their original index.
+"""
+
+import concurrent.futures
+
+import dataclasses
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tarfile
+import tempfile
+import time
+import uuid
+import zipfile
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from . import storage
+
+WHEELHOUSES_PREFIX = "wheelhouses"
+
+# Where notebook builds extract the wheelhouse archive
+BUILD_WHEELHOUSE_PATH = "/workspace/wheelhouse"
+
+# A wheelhouse is rebuilt this often, so that unpinned requirements pick up
+# new releases
+WHEELHOUSE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Written into a wheelhouse folder once it is complete, listing what it holds
+MANIFEST_FILE_NAME = "requirements.txt"
+
+_INSTALL_COMMAND = re.compile(
+    r"^(\s*[!%]\s*(?:sudo\s+)?(?:pip3?|python[0-9.]*\s+-m\s+pip3?)\s+install)(?=\s|$)"
+)
+
+# A named requirement, e.g. google-cloud-aiplatform[tensorboard]>=1.10
+_REQUIREMENT = re.compile(
+    r"^[A-Za-z0-9][A-Za-z0-9._-]*(\[[A-Za-z0-9._,-]*\])?([<>=!~]=?[A-Za-z0-9.*+!,<>=~-]+)?$"
+)
+
+# Options that install from somewhere other than an index, so lines with them
+# are left alone
+_SOURCE_OPTIONS = {
+    "-r",
+    "--requirement",
+    "-c",
+    "--constraint",
+    "-e",
+    "--editable",
+    "-i",
+    "--index-url",
+    "--extra-index-url",
+    "-f",
+    "--find-links",
+    "--no-index",
+    "-t",
+    "--target",
+    "--prefix",
+    "--root",
+}
+
+# Options followed by a separate value
+_VALUE_OPTIONS = {
+    "--timeout",
+    "--retries",
+    "--upgrade-strategy",
+    "--progress-bar",
+    "--cache-dir",
+    "--log",
+    "--only-binary",
+    "--no-binary",
+    "--trusted-host",
+    "--proxy",
+}
+
+_SHELL_OPERATORS = {"&&", "||", ";", "|", "&"}
+
+
+@dataclasses.dataclass
+class Wheelhouse:
+    key: str
+    archive_uri: str
+    # The requirements the wheelhouse can install without an index
+    requirements: List[str]
+
+
+def iter_logical_lines(source: str) -> Iterator[Tuple[int, str]]:
+    """
+    Yields the index of the first line of each logical line along with the
+    logical line, joining lines continued with a backslash
+    """
+    lines = source.split("\n")
+    index = 0
+    while index < len(lines):
+        start = index
+        logical_line = lines[index]
+        while logical_line.rstrip().endswith("\\") and index + 1 < len(lines):
+            index += 1
+            logical_line = logical_line.rstrip()[:-1] + " " + lines[index]
+
+        yield start, logical_line
+        index += 1
+
+
+def parse_install_line(line: str) -> Optional[List[str]]:
+    """
+    Returns the requirements of a pip install line, or None if the line is
+    not one that can be served from a wheelhouse
+    """
+    match = _INSTALL_COMMAND.match(line)
+    if not match:
+        return None
+
+    try:
+        arguments = shlex.split(line[match.end() :], comments=True)
+    except ValueError:
+        return None
+
+    requirements = []
+    arguments_iter = iter(arguments)
+    for argument in arguments_iter:
+        option = argument.split("=", 1)[0]
+        if argument in _SHELL_OPERATORS or option in _SOURCE_OPTIONS:
+            return None
+
+        # Variables such as $USER_FLAG and {USER_FLAG} expand to options
+        if argument.startswith(("$", "{")):
+            continue
+
+        if argument in _VALUE_OPTIONS:
+            next(arguments_iter, None)
+            continue
+
+        if argument.startswith("-"):
+            continue
+
+        requirement = "".join(argument.split())
+        if not _REQUIREMENT.match(requirement):
+            return None
+        requirements.append(requirement)
+
+    return requirements or None
+
+
+def extract_requirements(source: str) -> List[str]:
+    """Returns the requirements of the pip install lines of a cell's source"""
+    requirements = []
+    for _, logical_line in iter_logical_lines(source):
+        requirements += parse_install_line(logical_line) or []
+
+    return requirements
+
+
+def notebook_requirements(notebook_path: str) -> List[str]:
+    """Returns the requirements installed by the code cells of a notebook"""
+    try:
+        with open(notebook_path, encoding="utf-8") as f:
+            cells = json.load(f).get("cells", [])
+    except ValueError:
+        # Pre-processing reports the notebook as broken
+        return []
+
+    requirements = []
+    for cell in cells:
+        if cell.get("cell_type") != "code":
+            continue
+
+        source = cell.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+        requirements += extract_requirements(source)
+
+    return sorted(set(requirements))
+
+
+def file_requirements(requirements_filepath: str) -> List[str]:
+    """Returns the named requirements of a requirements file"""
+    with open(requirements_filepath, encoding="utf-8") as f:
+        lines = [line.split("#", 1)[0].strip() for line in f]
+
+    return sorted(
+        {"".join(line.split()) for line in lines if _REQUIREMENT.match("".join(line.split()))}
+    )
+
+
+def rewrite_install_lines(
+    source: str, wheelhouse_path: str, available_requirements: Set[str]
+) -> str:
+    """
+    Rewrites the pip install lines whose requirements are all available to
+    install from the wheelhouse. Shell (!) lines install without an index and
+    run the original command if that fails, e.g. because the wheelhouse could
+    not be extracted. Magic (%pip) lines cannot fall back, so they keep their
+    index and only gain the wheelhouse as a source.
+    """
+    lines = source.split("\n")
+    for start, logical_line in iter_logical_lines(source):
+        requirements = parse_install_line(logical_line)
+        if not requirements or not set(requirements) <= available_requirements:
+            continue
+
+        command = logical_line.strip()
+        # A comment would swallow the fallback command
+        if command.startswith("!") and "#" not in command:
+            end = start
+            while lines[end].rstrip().endswith("\\") and end + 1 < len(lines):
+                end += 1
+            lines[end] += f" || {command[1:].strip()}"
+            options = f"--no-index --find-links={wheelhouse_path}"
+        else:
+            options = f"--find-links={wheelhouse_path}"
+
+        lines[start] = _INSTALL_COMMAND.sub(
+            lambda match: f"{match.group(1)} {options}", lines[start], count=1
+        )
+
+    return "\n".join(lines)
+
+
+def python_version() -> str:
+    return f"{sys.version_info.major}.{sys.version_info.minor}"
+
+
+def wheelhouse_key(
+    requirement_sets: Iterable[Iterable[str]], now: Optional[float] = None
+) -> str:
+    """
+    Hashes the requirements along with the interpreter and platform, which
+    decide which wheels get built, and the current WHEELHOUSE_TTL_SECONDS
+    period, after which the key changes
+    """
+    if now is None:
+        now = time.time()
+    digest = hashlib.sha256()
+    digest.update(
+        json.dumps(
+            {
+                "requirement_sets": sorted(
+                    {tuple(sorted(set(requirements))) for requirements in requirement_sets}
+                ),
+                "python_version": python_version(),
+                "platform": sysconfig.get_platform(),
+                "period": int(now // WHEELHOUSE_TTL_SECONDS),
+            }
+        ).encode("utf-8")
+    )
+
+    return digest.hexdigest()
+
+
+def _pip_wheel(
+    requirements: List[str], wheel_dir: str, local_index: Optional[str]
+) -> bool:
+    command = [sys.executable, "-m", "pip", "wheel", "-q", "--wheel-dir", wheel_dir]
+    if local_index:
+        command += ["--no-index", "--find-links", local_index]
+
+    process = subprocess.run(
+        command + requirements, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    if process.returncode != 0:
+        print(
+            f"Could not build wheels for {requirements}:\n"
+            f"{process.stdout.decode('utf-8', errors='replace')}"
+        )
+
+    return process.returncode == 0
+
+
+def build_wheelhouse(
+    requirement_sets: List[List[str]],
+    wheelhouse_dir: str,
+    local_index: Optional[str] = None,
+) -> Tuple[List[str], bool]:
+    """
+    Builds the wheels of all requirement sets into wheelhouse_dir and returns
+    the requirements it can install, and whether it holds all of them. Each
+    set is resolved on its own, concurrently, so the wheelhouse may hold
+    several versions of a package, e.g. for a pinned and an unpinned
+    requirement. A complete wheelhouse_dir is reused as is, while one missing
+    requirement sets, e.g. because pip failed transiently, is rebuilt the
+    next time.
+
+    If local_index is set, wheels are only taken from that local folder.
+    """
+    manifest_path = os.path.join(wheelhouse_dir, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            return f.read().split(), True
+
+    requirement_sets = sorted(
+        {tuple(sorted(set(requirements))) for requirements in requirement_sets if requirements}
+    )
+
+    partial_dir = wheelhouse_dir + ".partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+
+    def build_set(index: int, requirements: Tuple[str, ...]) -> bool:
+        # Each set gets its own folder, so a failed set leaves no wheels behind
+        set_dir = os.path.join(partial_dir, f".set-{index}")
+        if not _pip_wheel(list(requirements), set_dir, local_index):
+            return False
+
+        for file_name in os.listdir(set_dir):
+            target = os.path.join(partial_dir, file_name)
+            if not os.path.exists(target):
+                os.replace(os.path.join(set_dir, file_name), target)
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=os.cpu_count() or 1
+    ) as executor:
+        is_built = list(
+            executor.map(build_set, range(len(requirement_sets)), requirement_sets)
+        )
+
+    for index in range(len(requirement_sets)):
+        shutil.rmtree(os.path.join(partial_dir, f".set-{index}"), ignore_errors=True)
+
+    available_requirements = sorted(
+        {
+            requirement
+            for requirements, built in zip(requirement_sets, is_built)
+            if built
+            for requirement in requirements
+        }
+    )
+    is_complete = all(is_built)
+
+    if is_complete:
+        with open(os.path.join(partial_dir, MANIFEST_FILE_NAME), "w", encoding="utf-8") as f:
+            f.write("".join(f"{requirement}\n" for requirement in available_requirements))
+
+    # Only a fully written wheelhouse ever appears at wheelhouse_dir
+    shutil.rmtree(wheelhouse_dir, ignore_errors=True)
+    os.replace(partial_dir, wheelhouse_dir)
+
+    return available_requirements, is_complete
+
+
+def prepare_wheelhouse(
+    requirement_sets: List[List[str]],
+    cache_dir: str,
+    staging_bucket: str,
+    storage_backend: storage.StorageBackend,
+    local_index: Optional[str] = None,
+) -> Optional[Wheelhouse]:
+    """
+    Returns the uploaded wheelhouse of the requirement sets, building and
+    uploading it unless a wheelhouse with the same key already was. A
+    wheelhouse missing some requirement sets is uploaded for this run only,
+    under a unique name and without a manifest, so it is never reused.
+    """
+    if not any(requirement_sets):
+        return None
+
+    key = wheelhouse_key(requirement_sets)
+    archive_uri = "/".join([staging_bucket, WHEELHOUSES_PREFIX, f"{key}.tar.gz"])
+    manifest_uri = "/".join([staging_bucket, WHEELHOUSES_PREFIX, f"{key}.txt"])
+
+    # The manifest is uploaded last, so its presence means the archive is complete
+    if storage_backend.exists(manifest_uri):
+        print(f"Reusing wheelhouse at {archive_uri}")
+        return Wheelhouse(
+            key=key,
+            archive_uri=archive_uri,
+            requirements=storage_backend.read(manifest_uri).decode("utf-8").split(),
+        )
+
+    wheelhouse_dir = os.path.join(cache_dir, key)
+    requirements, is_complete = build_wheelhouse(
+        requirement_sets, wheelhouse_dir, local_index=local_index
+    )
+    if not is_complete:
+        archive_uri = "/".join(
+            [staging_bucket, WHEELHOUSES_PREFIX, f"{key}-{uuid.uuid4().hex}.tar.gz"]
+        )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_archive = os.path.join(temp_dir, "wheelhouse.tar.gz")
+        with tarfile.open(local_archive, "w:gz") as tar:
+            for file_name in sorted(os.listdir(wheelhouse_dir)):
+                tar.add(os.path.join(wheelhouse_dir, file_name), arcname=file_name)
+        storage_backend.upload_file(local_archive, archive_uri)
+
+        if is_complete:
+            storage_backend.upload_file(
+                os.path.join(wheelhouse_dir, MANIFEST_FILE_NAME), manifest_uri
+            )
+
+    print(
+        f"Uploaded {'' if is_complete else 'incomplete '}wheelhouse of "
+        f"{len(requirements)} requirements to {archive_uri}"
+    )
+
+    return Wheelhouse(key=key, archive_uri=archive_uri, requirements=requirements)
+
+
+def test_rewrite_install_lines():
+    source = "\n".join(
+        [
+            "! pip3 install -U google-cloud-storage $USER_FLAG -q",
+            "! pip3 install {USER_FLAG} --upgrade google-cloud-aiplatform \\",
+            "    'tensorflow>=2.8' -q",
+            "%pip install -U --user -r requirements.txt",
+            "!pip install torch",
+        ]
+    )
+
+    assert extract_requirements(source) == [
+        "google-cloud-storage",
+        "google-cloud-aiplatform",
+        "tensorflow>=2.8",
+        "torch",
+    ]
+    assert rewrite_install_lines(
+        source,
+        "/wheels",
+        {"google-cloud-storage", "google-cloud-aiplatform", "tensorflow>=2.8"},
+    ).split("\n") == [
+        "! pip3 install --no-index --find-links=/wheels -U google-cloud-storage $USER_FLAG -q"
+        " || pip3 install -U google-cloud-storage $USER_FLAG -q",
+        "! pip3 install --no-index --find-links=/wheels {USER_FLAG} --upgrade google-cloud-aiplatform \\",
+        "    'tensorflow>=2.8' -q"
+        " || pip3 install {USER_FLAG} --upgrade google-cloud-aiplatform      'tensorflow>=2.8' -q",
+        "%pip install -U --user -r requirements.txt",
+        "!pip install torch",
+    ]
+    assert rewrite_install_lines(
+        "%pip install -U torch\n!pip install torch  # for training", "/wheels", {"torch"}
+    ).split("\n") == [
+        "%pip install --find-links=/wheels -U torch",
+        "!pip install --find-links=/wheels torch  # for training",
+    ]
+
+
+def _write_wheel(index_dir: str, name: str, version: str):
+    """Writes a minimal pure-Python wheel, as a local package index would hold"""
+    dist_info = f"{name}-{version}.dist-info"
+    with zipfile.ZipFile(
+        os.path.join(index_dir, f"{name}-{version}-py3-none-any.whl"), "w"
+    ) as wheel:
+        wheel.writestr(f"{name}/__init__.py", "")
+        wheel.writestr(
+            f"{dist_info}/METADATA",
+            f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+        )
+        wheel.writestr(
+            f"{dist_info}/WHEEL",
+            "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+        )
+        wheel.writestr(f"{dist_info}/RECORD", "")
+
+
+def test_prepare_wheelhouse_offline():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_dir = os.path.join(temp_dir, "index")
+        os.makedirs(index_dir)
+        _write_wheel(index_dir, "demo_a", "1.0")
+        _write_wheel(index_dir, "demo_b", "2.0")
+        local_storage = storage.LocalStorage(os.path.join(temp_dir, "gcs"))
+
+        # The conflicting pin is dropped, and the rest is still resolved for
+        # this run, but the incomplete wheelhouse is not kept for reuse
+        requirement_sets = [["demo_a"], ["demo_a", "demo_b==2.0"], ["demo_b==3.0"]]
+        wheelhouse = prepare_wheelhouse(
+            requirement_sets,
+            cache_dir=os.path.join(temp_dir, "cache"),
+            staging_bucket="gs://staging",
+            storage_backend=local_storage,
+            local_index=index_dir,
+        )
+
+        assert wheelhouse.requirements == ["demo_a", "demo_b==2.0"]
+        with tarfile.open(local_storage.local_path(wheelhouse.archive_uri)) as tar:
+            assert sorted(tar.getnames()) == [
+                "demo_a-1.0-py3-none-any.whl",
+                "demo_b-2.0-py3-none-any.whl",
+            ]
+        assert not local_storage.exists(
+            f"gs://staging/{WHEELHOUSES_PREFIX}/{wheelhouse.key}.txt"
+        )
+        assert not os.path.exists(
+            os.path.join(temp_dir, "cache", wheelhouse.key, MANIFEST_FILE_NAME)
+        )
+
+        requirement_sets = requirement_sets[:2]
+        wheelhouse = prepare_wheelhouse(
+            requirement_sets,
+            cache_dir=os.path.join(temp_dir, "cache"),
+            staging_bucket="gs://staging",
+            storage_backend=local_storage,
+            local_index=index_dir,
+        )
+        assert wheelhouse.archive_uri.endswith(f"/{wheelhouse.key}.tar.gz")
+
+        # An uploaded wheelhouse is reused without building
+        shutil.rmtree(index_dir)
+        assert (
+            prepare_wheelhouse(
+                requirement_sets,
+                cache_dir=os.path.join(temp_dir, "other_cache"),
+                staging_bucket="gs://staging",
+                storage_backend=local_storage,
+            )
+            == wheelhouse
+        )
+
+        # Until the key expires
+        now = time.time()
+        assert wheelhouse_key(requirement_sets, now=now) != wheelhouse_key(
+            requirement_sets, now=now + WHEELHOUSE_TTL_SECONDS
+        )
+
+
+def test_pins_do_not_constrain_other_sets():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_dir = os.path.join(temp_dir, "index")
+        os.makedirs(index_dir)
+        _write_wheel(index_dir, "demo_b", "1.0")
+        _write_wheel(index_dir, "demo_b", "2.0")
+
+        # One notebook pins an old version while another takes the latest
+        wheelhouse_dir = os.path.join(temp_dir, "wheelhouse")
+        requirements, is_complete = build_wheelhouse(
+            [["demo_b<2.0"], ["demo_b"]], wheelhouse_dir, local_index=index_dir
+        )
+
+        assert (requirements, is_complete) == (["demo_b", "demo_b<2.0"], True)
+        assert sorted(os.listdir(wheelhouse_dir)) == [
+            "demo_b-1.0-py3-none-any.whl",
+            "demo_b-2.0-py3-none-any.whl",
+            MANIFEST_FILE_NAME,
+        ]
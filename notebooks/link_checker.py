@@ -0,0 +1,304 @@
+"""
+Checks notebook links concurrently, with a persistent cache of their status.
+
+Every URL is checked once however many notebooks use it. Requests run on a
+bounded thread pool driven by asyncio, at most per_host_limit at a time per
+host, and reuse keep-alive connections. Rate limited (429) and server
+error (5xx) responses are retried, honoring Retry-After. Only definitive
+statuses are kept in a JSON cache file for ttl, so that repeated reviews
+only check new or expired links.
+
+For tests, stub_url sends every request to a local StubServer instead of
+the network.
+"""
+
+import asyncio
+import concurrent.futures
+import email.utils
+import http.client
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+from datetime import timedelta
+
+MAX_REDIRECTS = 5
+
+# Retries of a rate limited or failing request, and the longest wait between them
+MAX_RETRIES = 3
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+def is_ok(status):
+    return status is not None and 200 <= status < 400
+
+
+def is_transient(status):
+    """Rate limited or a server error, which says nothing about the link"""
+    return status is not None and (status == 429 or status >= 500)
+
+
+def is_broken(status):
+    """The link could not be fetched, or the server says it does not exist"""
+    return not is_ok(status) and not is_transient(status)
+
+
+def is_cacheable(status):
+    return is_ok(status) or status in [404, 410]
+
+
+def retry_after_seconds(value):
+    """Parses a Retry-After header, in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class LinkChecker:
+    def __init__(self, cache_file=None, ttl=timedelta(days=1), per_host_limit=8,
+                 max_connections=32, timeout=30, retry_backoff=1.0, stub_url=None):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.per_host_limit = per_host_limit
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retry_backoff = retry_backoff
+        self.stub_url = stub_url
+        self.requests = 0
+
+        self._cache = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                try:
+                    self._cache = json.load(f)
+                except ValueError:
+                    print("Ignoring corrupted link cache:", cache_file)
+
+        # Idle keep-alive connections by (scheme, host)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def status(self, url):
+        """Returns the cached status of a link, or checks it"""
+        return self.check([url])[url]
+
+    def check(self, urls):
+        """
+        Returns the HTTP status of every link, or None if it could not be
+        fetched or redirects too many times
+        """
+        now = time.time()
+        statuses = {}
+        missing = []
+        for url in dict.fromkeys(urls):
+            entry = self._cache.get(url)
+            if entry and now - entry['checked'] < self.ttl.total_seconds():
+                statuses[url] = entry['status']
+            else:
+                missing.append(url)
+
+        if missing:
+            fetched = asyncio.run(self._check_all(missing))
+            for url, status in fetched.items():
+                statuses[url] = status
+                # Network errors, rate limits and server errors are often transient
+                if is_cacheable(status):
+                    self._cache[url] = {'status': status, 'checked': now}
+            self.save()
+
+        return statuses
+
+    def save(self):
+        if self.cache_file:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self._cache, f, indent=1, sort_keys=True)
+
+    async def _check_all(self, urls):
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_connections)
+        host_limits = {}
+
+        async def fetch_once(url):
+            parts = urllib.parse.urlsplit(self._target(url))
+            key = (parts.scheme, parts.netloc)
+            if key not in host_limits:
+                host_limits[key] = asyncio.Semaphore(self.per_host_limit)
+
+            for attempt in range(MAX_RETRIES + 1):
+                async with host_limits[key]:
+                    status, headers = await loop.run_in_executor(executor, self._request, parts)
+                if not is_transient(status) or attempt == MAX_RETRIES:
+                    return status, headers
+
+                delay = retry_after_seconds(headers.get('Retry-After'))
+                if delay is None:
+                    delay = self.retry_backoff * 2 ** attempt
+                await asyncio.sleep(min(delay, MAX_RETRY_AFTER_SECONDS))
+
+        async def fetch(url):
+            for _ in range(MAX_REDIRECTS + 1):
+                status, headers = await fetch_once(url)
+                location = headers.get('Location')
+                if status is None or not 300 <= status < 400 or not location:
+                    return status
+                url = urllib.parse.urljoin(url, location)
+            # A redirect loop, or a chain too long to follow
+            return None
+
+        try:
+            statuses = await asyncio.gather(*[fetch(url) for url in urls])
+        finally:
+            executor.shutdown(wait=False)
+            with self._lock:
+                for connections in self._idle.values():
+                    for connection in connections:
+                        connection.close()
+                self._idle.clear()
+
+        return dict(zip(urls, statuses))
+
+    def _target(self, url):
+        if not self.stub_url:
+            return url
+        parts = urllib.parse.urlsplit(url)
+        return f"{self.stub_url}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else '')
+
+    def _request(self, parts):
+        """Sends a HEAD request, or a GET if HEAD is not allowed, on a pooled connection"""
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        with self._lock:
+            self.requests += 1
+            connections = self._idle.setdefault(key, [])
+            connection = connections.pop() if connections else None
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            connection = connection_class(parts.netloc, timeout=self.timeout)
+
+        try:
+            for method in ['HEAD', 'GET']:
+                connection.request(method, path, headers={'User-Agent': 'notebook-template-review'})
+                response = connection.getresponse()
+                response.read()
+                if response.status not in [405, 501]:
+                    break
+        except Exception:
+            connection.close()
+            return None, {}
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle[key].append(connection)
+
+        # The headers are looked up case-insensitively
+        return response.status, response.msg
+
+
+class StubServer:
+    """
+    A local HTTP server answering 404, or with the status given for a URL.
+    A status is a code, or a code and headers. A list of statuses is
+    answered in turn, repeating the last one.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.requests = []
+        self.connections = 0
+
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                stub.connections += 1
+
+            def do_HEAD(self):
+                url = 'https://' + self.path[1:]
+                stub.requests.append(url)
+                status = stub.statuses.get(url, 404)
+                if isinstance(status, list):
+                    status = status.pop(0) if len(status) > 1 else status[0]
+                headers = {}
+                if isinstance(status, tuple):
+                    status, headers = status
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = do_HEAD
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def test_link_checker_dedups_limits_and_caches(tmp_path):
+    good = 'https://github.com/GoogleCloudPlatform/vertex-ai-samples/blob/main/notebooks/good.ipynb'
+    moved = 'https://github.com/GoogleCloudPlatform/vertex-ai-samples/blob/main/notebooks/moved.ipynb'
+    bad = 'https://github.com/GoogleCloudPlatform/vertex-ai-samples/blob/main/notebooks/bad.ipynb'
+    cache_file = str(tmp_path / 'links.json')
+
+    with StubServer({good: 200, moved: (301, {'Location': good})}) as stub:
+        checker = LinkChecker(cache_file=cache_file, per_host_limit=2, stub_url=stub.url)
+        statuses = checker.check([good, moved, bad] * 10)
+        assert statuses == {good: 200, moved: 200, bad: 404}
+        assert sorted(stub.requests) == sorted([good, good, moved, bad])
+        # Connections are reused, and there are at most two per host
+        assert stub.connections <= 2
+
+        # Another review reads the statuses from the cache
+        checker = LinkChecker(cache_file=cache_file, stub_url=stub.url)
+        assert [is_ok(checker.status(url)) for url in [good, moved, bad]] == [True, True, False]
+        assert checker.requests == 0
+
+
+def test_link_checker_retries_and_skips_transient_statuses(tmp_path):
+    limited = 'https://github.com/limited.ipynb'
+    down = 'https://github.com/down.ipynb'
+    loop = 'https://github.com/loop.ipynb'
+    cache_file = str(tmp_path / 'links.json')
+
+    with StubServer({
+        limited: [(429, {'Retry-After': '0'}), 200],
+        down: 503,
+        loop: (302, {'Location': loop}),
+    }) as stub:
+        checker = LinkChecker(cache_file=cache_file, retry_backoff=0.01, stub_url=stub.url)
+        statuses = checker.check([limited, down, loop])
+        assert statuses == {limited: 200, down: 503, loop: None}
+        assert stub.requests.count(down) == MAX_RETRIES + 1
+        assert [is_broken(statuses[url]) for url in [limited, down, loop]] == [False, False, True]
+
+        # Only the definitive status is cached
+        checker = LinkChecker(cache_file=cache_file, retry_backoff=0.01, stub_url=stub.url)
+        checker.check([limited, down, loop])
+        assert checker.requests == (MAX_RETRIES + 1) + (MAX_REDIRECTS + 1)
@@ -0,0 +1,82 @@
+"""
+Caches the review of notebooks by their content.
+
+A review is stored as the list of events it produced, e.g. errors, keyed by
+the notebook path and a hash of its content and of the rules that reviewed
+it. An unchanged notebook replays its stored events instead of being
+reviewed again. Entries expire after ttl, since link errors depend on the
+state of the links rather than on the notebook.
+"""
+
+import hashlib
+import json
+import os
+import time
+from datetime import timedelta
+
+
+def content_key(content, ruleset_version):
+    digest = hashlib.sha256()
+    digest.update(ruleset_version.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(content)
+    return digest.hexdigest()
+
+
+class LintCache:
+    def __init__(self, cache_file=None, ruleset_version='', ttl=timedelta(days=1)):
+        self.cache_file = cache_file
+        self.ruleset_version = ruleset_version
+        self.ttl = ttl
+
+        self._entries = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                try:
+                    self._entries = json.load(f)
+                except ValueError:
+                    print("Ignoring corrupted lint cache:", cache_file)
+        # Content keys by path, so that every notebook is hashed once per run
+        self._keys = {}
+
+    def key(self, path):
+        if path not in self._keys:
+            with open(path, 'rb') as f:
+                self._keys[path] = content_key(f.read(), self.ruleset_version)
+        return self._keys[path]
+
+    def get(self, path):
+        """Returns the stored events of an unchanged notebook, or None"""
+        entry = self._entries.get(path)
+        if (
+            entry is None
+            or entry['key'] != self.key(path)
+            or time.time() - entry['checked'] >= self.ttl.total_seconds()
+        ):
+            return None
+        return entry['events']
+
+    def put(self, path, events):
+        self._entries[path] = {'key': self.key(path), 'checked': time.time(), 'events': events}
+
+    def save(self):
+        if self.cache_file:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self._entries, f)
+
+
+def test_lint_cache_replays_unchanged_notebooks(tmp_path):
+    notebook = tmp_path / 'notebook.ipynb'
+    notebook.write_text('{"cells": []}')
+    cache_file = str(tmp_path / 'lint.json')
+
+    cache = LintCache(cache_file, ruleset_version='1')
+    assert cache.get(str(notebook)) is None
+    cache.put(str(notebook), [['error', 0, 'missing copyright cell']])
+    cache.save()
+
+    assert LintCache(cache_file, ruleset_version='1').get(str(notebook)) == [['error', 0, 'missing copyright cell']]
+    # New rules, or an edited notebook, are reviewed again
+    assert LintCache(cache_file, ruleset_version='2').get(str(notebook)) is None
+    notebook.write_text('{"cells": [], "metadata": {}}')
+    assert LintCache(cache_file, ruleset_version='1').get(str(notebook)) is None
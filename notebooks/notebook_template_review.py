@@ -1,11 +1,15 @@
 
 import argparse
+import hashlib
 import json
 import os
 import sys
-import urllib.request
+import tempfile
 import csv
 
+from lint_cache import LintCache
+from link_checker import LinkChecker, is_broken
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--notebook-dir', dest='notebook_dir',
                     default=None, type=str, help='Notebook directory')
@@ -31,6 +35,14 @@ parser.add_argument('--web', dest='web', action='store_true',
                     default=False, help='Output format in HTML')
 parser.add_argument('--repo', dest='repo', action='store_true', 
                     default=False, help='Output format in Markdown')
+parser.add_argument('--link-cache', dest='link_cache',
+                    default=os.path.join(tempfile.gettempdir(), 'notebook_link_cache.json'), type=str,
+                    help='File caching link statuses across reviews')
+parser.add_argument('--lint-cache', dest='lint_cache',
+                    default=os.path.join(tempfile.gettempdir(), 'notebook_lint_cache.json'), type=str,
+                    help='File caching the review of unchanged notebooks (empty to disable)')
+parser.add_argument('--link-stub-url', dest='link_stub_url',
+                    default=None, type=str, help='Check links against a local HTTP stub (offline mode)')
 args = parser.parse_args()
 
 if args.errors_codes:
@@ -54,30 +66,113 @@ ERROR_LINK_GIT_BAD = 7
 ERROR_LINK_COLAB_BAD = 8
 ERROR_LINK_WORKBENCH_BAD = 9
 
+# Cells searched for links ahead of the review
+NUM_LINK_CELLS = 6
+
+# Any change to the review rules in this file invalidates cached reviews
+with open(__file__, 'rb') as f:
+    RULESET_VERSION = hashlib.sha256(f.read()).hexdigest()
+
 # globals
 num_errors = 0
 last_tag = ''
+link_checker = LinkChecker(cache_file=args.link_cache, stub_url=args.link_stub_url)
+link_statuses = {}
+lint_cache = LintCache(cache_file=args.lint_cache or None, ruleset_version=RULESET_VERSION)
+# The events of the notebook being reviewed, while it is recorded for the cache
+recorded_events = None
+
+def skip_dir(entry):
+    return entry.name[0] == '.' or entry.name in ['src', 'images', 'sample_data']
 
 def parse_dir(directory):
     entries = os.scandir(directory)
     for entry in entries:
         if entry.is_dir():
-            if entry.name[0] == '.':
-                continue
-            if entry.name == 'src' or entry.name == 'images' or entry.name == 'sample_data':
+            if skip_dir(entry):
                 continue
             print("\n##", entry.name, "\n")
             parse_dir(entry.path)
         elif entry.name.endswith('.ipynb'):
             parse_notebook(entry.path)
 
+def list_dir(directory):
+    notebooks = []
+    for entry in os.scandir(directory):
+        if entry.is_dir():
+            if not skip_dir(entry):
+                notebooks += list_dir(entry.path)
+        elif entry.name.endswith('.ipynb'):
+            notebooks.append(entry.path)
+    return notebooks
+
+def extract_link(line):
+    """Returns the kind and URL of a GitHub, Colab or Workbench link, or None"""
+    if '<a href="https://github.com' in line:
+        return 'git', line.strip()[9:-2].replace('" target="_blank', '')
+    if '<a href="https://colab.research.google.com/' in line:
+        return 'colab', 'https://github.com/' + line.strip()[50:-2].replace('" target="_blank', '')
+    if '<a href="https://console.cloud.google.com/vertex-ai/workbench/' in line:
+        return 'workbench', line.strip()[91:-2].replace('" target="_blank', '')
+    return None
+
+def check_links(notebooks):
+    """Checks the links of all notebooks at once, before they are reviewed"""
+    urls = []
+    for path in notebooks:
+        if args.lint_cache and os.path.isfile(path) and lint_cache.get(path) is not None:
+            continue
+        try:
+            with open(path, 'r') as f:
+                cells = json.load(f)['cells']
+        except:
+            continue
+        for cell in cells[:NUM_LINK_CELLS]:
+            for line in cell['source']:
+                link = extract_link(line)
+                if link:
+                    urls.append(link[1])
+    link_statuses.update(link_checker.check(urls))
+
+def is_link_ok(url):
+    """Links that are rate limited or hit server errors are not reported as bad"""
+    if url not in link_statuses:
+        link_statuses[url] = link_checker.status(url)
+    return not is_broken(link_statuses[url])
+
 def parse_notebook(path):
+    global recorded_events
+
+    if not args.lint_cache:
+        review_notebook(path)
+        return
+
+    events = lint_cache.get(path)
+    if events is None:
+        recorded_events = []
+        try:
+            if not review_notebook(path):
+                return
+            events = recorded_events
+        finally:
+            recorded_events = None
+        lint_cache.put(path, events)
+        return
+
+    for event in events:
+        if event[0] == 'error':
+            report_error(path, event[1], event[2])
+        elif event[0] == 'index':
+            add_index(path, tag, *event[1])
+
+def review_notebook(path):
+    """Reviews a notebook, and returns whether it could be read"""
     with open(path, 'r') as f:
         try:
             content = json.load(f)
         except:
             print("Corrupted notebook:", path)
-            return
+            return False
         
         cells = content['cells']
         
@@ -111,32 +206,27 @@ def parse_notebook(path):
         workbench_link = None
         for line in cell['source']:
             source += line
-            if '<a href="https://github.com' in line:
-                git_link = line.strip()[9:-2].replace('" target="_blank', '')
-                try:
-                    code = urllib.request.urlopen(git_link).getcode()
-                except Exception as e:
+            link = extract_link(line)
+            if link and link[0] == 'git':
+                git_link = link[1]
+                if not is_link_ok(git_link):
                     # if new notebook
                     derived_link = os.path.join('https://github.com/GoogleCloudPlatform/vertex-ai-samples/blob/main/notebooks/', path)
                     if git_link != derived_link:
                         report_error(path, ERROR_LINK_GIT_BAD, f"bad GitHub link: {git_link}")
                     
-            if '<a href="https://colab.research.google.com/' in line:
-                colab_link = 'https://github.com/' + line.strip()[50:-2].replace('" target="_blank', '')
-                try:
-                    code = urllib.request.urlopen(colab_link).getcode()
-                except Exception as e:
+            if link and link[0] == 'colab':
+                colab_link = link[1]
+                if not is_link_ok(colab_link):
                     # if new notebook
                     derived_link = os.path.join('https://colab.research.google.com/github/GoogleCloudPlatform/vertex-ai-samples/blob/main/notebooks', path)
                     if colab_link != derived_link:
                         report_error(path, ERROR_LINK_COLAB_BAD, f"bad Colab link: {colab_link}")
                     
 
-            if '<a href="https://console.cloud.google.com/vertex-ai/workbench/' in line:
-                workbench_link = line.strip()[91:-2].replace('" target="_blank', '')
-                try:
-                    code = urllib.request.urlopen(workbench_link).getcode()
-                except Exception as e:
+            if link and link[0] == 'workbench':
+                workbench_link = link[1]
+                if not is_link_ok(workbench_link):
                     derived_link = os.path.join('https://console.cloud.google.com/vertex-ai/workbench/deploy-notebook?download_url=https://raw.githubusercontent.com/GoogleCloudPlatform/vertex-ai-samples/main/notebooks/', path)
                     if colab_link != workbench_link:
                         report_error(path, ERROR_LINK_WORKBENCH_BAD, f"bad Workbench link: {workbench_link}")
@@ -295,6 +385,8 @@ def parse_notebook(path):
             report_error(path, 34, "Region section not found")
         '''
 
+    return True
+
 
 def get_cell(path, cells, nth):
     while empty_cell(path, cells, nth):
@@ -391,6 +483,9 @@ def check_sentence_case(path, heading):
 def report_error(notebook, code, msg):
     global num_errors
     
+    if recorded_events is not None:
+        recorded_events.append(['error', code, msg])
+
     if args.errors:
         if args.errors_codes:
             if str(code) not in args.errors_codes:
@@ -475,6 +570,9 @@ def parse_objective(path, cell):
 def add_index(path, tag, title, desc, uses, steps, git_link, colab_link, workbench_link):
     global last_tag
     
+    if recorded_events is not None:
+        recorded_events.append(['index', [title, desc, uses, steps, git_link, colab_link, workbench_link]])
+
     if not args.web and not args.repo:
         return
     
@@ -540,21 +638,24 @@ if args.notebook_dir:
         print("Error: not a directory:", args.notebook_dir)
         exit(1)
     tag = ''
+    check_links(list_dir(args.notebook_dir))
     parse_dir(args.notebook_dir)
 elif args.notebook:
     if not os.path.isfile(args.notebook):
         print("Error: not a notebook:", args.notebook)
         exit(1)
     tag = ''
+    check_links([args.notebook])
     parse_notebook(args.notebook)
 elif args.notebook_file:
     if not os.path.isfile(args.notebook_file):
         print("Error: file does not exist", args.notebook_file)
     else:
         with open(args.notebook_file, 'r') as csvfile:
-            reader = csv.reader(csvfile)
+            rows = list(csv.reader(csvfile))
+            check_links([row[1] for row in rows[1:]])
             heading = True
-            for row in reader:
+            for row in rows:
                 if heading:
                     heading = False
                 else:
@@ -571,5 +672,7 @@ else:
 
 if args.web:
     print('</table>\n')
+
+lint_cache.save()
     
 exit(num_errors)